@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the IPEs, DYFI loading and map rendering on synthetic inputs
+
+Each case runs at every requested size (cells or events) on inputs from
+synthetic.py, with DYFI cells square in UTM as in the GA products unless
+--cells lonlat. It is timed once untraced, then run again under tracemalloc
+for its peak allocated memory (numpy arrays included). The basemap cache,
+tile pyramids and loaded places are cleared before both runs, so each
+measures the same cold render; tile worker processes are outside
+tracemalloc, so their peak resident memory is reported separately. Results
+go to JSON with the machine details, so runs can be compared across commits
+and hardware. Usage:
+
+    python run_benchmarks.py --sizes 1000 10000 100000 --output results.json
+    python run_benchmarks.py --cases ipe load --sizes 1000000 --no-memory
+"""
+
+import os
+import sys
+import gc
+import glob
+import json
+import shutil
+import time
+import platform
+import argparse
+import resource
+import tracemalloc
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+
+from synthetic import synthetic_dyfi, synthetic_catalog
+from mmi import batch_ipe, IPE_MODELS
+from dyfi_io import load_dyfi
+from dyfi_events import WOODS_POINT
+
+CASES = ['ipe', 'load', 'static', 'interactive']
+
+# each setup function takes (size, workdir, cells) and returns the callable to measure and its item count
+def setup_ipe(size, workdir, cells, ndist=100, chunk=10000):
+    # all registered IPEs for a catalogue of size events at ndist distances each
+    catalog = synthetic_catalog(size, seed=1)
+    rjb = np.logspace(0., 3., ndist)
+
+    def run():
+        for c0 in range(0, size, chunk):
+            batch_ipe(catalog['mag'][c0:c0 + chunk], catalog['eqdep'][c0:c0 + chunk],
+                      catalog['vs30'][c0:c0 + chunk], rjb)
+
+    return run, size * ndist * len(IPE_MODELS)
+
+def _dyfi_file(size, workdir, cells):
+    # synthetic DYFI file of size cells, generated once per size and cell layout
+    path = os.path.join(workdir, f'synthetic_{cells}_{size}.geojson')
+    if not os.path.exists(path):
+        synthetic_dyfi(path, size, seed=1, cells=cells)
+
+    return path
+
+def setup_load(size, workdir, cells):
+    path = _dyfi_file(size, workdir, cells)
+
+    return (lambda: load_dyfi(path)), size
+
+def setup_static(size, workdir, cells):
+    import matplotlib.pyplot as plt
+    from DYFI_MAP import make_static_map
+
+    dyfi = load_dyfi(_dyfi_file(size, workdir, cells))
+    outfile = os.path.join(workdir, f'static_{size}.jpg')
+
+    def run():
+        fig, _ = make_static_map(dyfi, WOODS_POINT, outfile=outfile, dpi=100)
+        plt.close(fig)
+
+    return run, size
+
+def setup_interactive(size, workdir, cells):
+    from DYFI_map_int import make_interactive_map
+
+    dyfi = load_dyfi(_dyfi_file(size, workdir, cells))
+    outfile = os.path.join(workdir, f'interactive_{size}.html')
+
+    return (lambda: make_interactive_map(dyfi, WOODS_POINT, output_file=outfile)), size
+
+# setup function and throughput unit per case
+SETUP = {'ipe': (setup_ipe, 'evaluations'), 'load': (setup_load, 'cells'),
+         'static': (setup_static, 'cells'), 'interactive': (setup_interactive, 'cells')}
+
+def clear_caches(workdir):
+    # drop the basemap cache, tile pyramids and loaded places so the next run starts cold
+    from dyfi_places import _loaded
+
+    shutil.rmtree(os.path.join(workdir, 'basemaps'), ignore_errors=True)
+    for tiles_dir in glob.glob(os.path.join(workdir, '*_tiles')):
+        shutil.rmtree(tiles_dir, ignore_errors=True)
+    _loaded.clear()
+
+def _children_peak_mb():
+    # peak RSS (MB) of any finished child process so far, e.g. tile workers (ru_maxrss is KB on Linux)
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    return peak / 2.**20 if sys.platform == 'darwin' else peak / 2.**10
+
+def measure(run, workdir, memory=True):
+    '''
+    Wall time of one run and, if memory, the tracemalloc peak (MB) of a
+    second run and the peak RSS (MB) of child processes. Caches are cleared
+    before each run.
+    '''
+    clear_caches(workdir)
+    gc.collect()
+    t0 = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - t0
+
+    peak = workers_peak = None
+    if memory:
+        clear_caches(workdir)
+        gc.collect()
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1] / 2.**20
+        tracemalloc.stop()
+        workers_peak = _children_peak_mb()
+
+    return elapsed, peak, workers_peak
+
+def run_benchmarks(cases=CASES, sizes=(1000, 10000, 100000), workdir='bench_data', memory=True, cells='utm'):
+    '''
+    Run every case at every size and return the results as a list of dicts
+    with seconds, throughput (items per second), peak_mb and
+    workers_peak_mb (a high-water mark over all child processes so far).
+    '''
+    os.makedirs(workdir, exist_ok=True)
+
+    # keep rendered basemaps in workdir, where clear_caches can remove them
+    os.environ['DYFI_BASEMAP_CACHE'] = os.path.join(workdir, 'basemaps')
+
+    results = []
+    for case in cases:
+        setup, unit = SETUP[case]
+        for size in sizes:
+            run, nitem = setup(size, workdir, cells)
+            elapsed, peak, workers_peak = measure(run, workdir, memory)
+            results.append({'case': case, 'size': size, 'cells': cells, 'unit': unit, 'items': nitem,
+                            'seconds': elapsed, 'throughput': nitem / elapsed, 'peak_mb': peak,
+                            'workers_peak_mb': workers_peak})
+            print(f"{case:12s} {size:>9d}: {elapsed:8.3f} s, {nitem / elapsed:12.0f} {unit}/s"
+                  + (f", peak {peak:.1f} MB, workers {workers_peak:.1f} MB" if peak is not None else ''))
+
+    return results
+
+def machine_info():
+    # platform details recorded with the results
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'matplotlib': matplotlib.__version__}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000])
+    parser.add_argument('--workdir', default='bench_data', help='directory for synthetic inputs and outputs')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced run for peak memory')
+    parser.add_argument('--cells', choices=('utm', 'lonlat'), default='utm',
+                        help='synthetic cell layout: UTM squares (polygons) or a lon/lat lattice (raster mesh)')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.cases, args.sizes, args.workdir, not args.no_memory, args.cells)
+
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'machine': machine_info(),
+              'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024., 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    print(f"Results saved as {args.output}")
+
+if __name__ == '__main__':
+    main()
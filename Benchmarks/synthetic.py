@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic DYFI feature collections and earthquake catalogues for benchmarking
+
+synthetic_dyfi writes a GeoJSON file in the layout of the GA DYFI products
+(square polygon cells with intensityFine, nresp and a centre point), with
+cells either square in UTM, as GA grids them, or square in lon/lat, and
+with
+intensities from an IPE plus scatter and response counts that fall off with
+distance. Features are written one at a time, so 10^6 cell files are
+generated in bounded memory. synthetic_catalog draws events over
+south-eastern Australia.
+"""
+
+import os
+import sys
+import json
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'MMI_Attenuation'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DYFI_Reports'))
+from mmi import ipe
+from fault_distance import haversine
+from dyfi_events import WOODS_POINT
+
+KM_PER_DEG = 111.195
+
+def utm_transformer(lon, lat):
+    # pyproj transformer from lon/lat to the WGS84 UTM zone holding (lon, lat)
+    from pyproj import Transformer
+
+    zone = int((lon + 180.) // 6.) + 1
+    epsg = (32700 if lat < 0 else 32600) + zone
+
+    return Transformer.from_crs('EPSG:4326', f'EPSG:{epsg}', always_xy=True)
+
+def synthetic_dyfi(outfile, ncell, event=WOODS_POINT, cell_km=1., model='AW07_CEUS', seed=None, cells='utm',
+                   chunk=1 << 16):
+    '''
+    Write a DYFI FeatureCollection of about ncell square cells of cell_km
+    around the event and return the number of cells written. cells is 'utm'
+    for squares in the event's UTM zone, as in the GA products (drawn as
+    polygons), or 'lonlat' for squares on a lon/lat lattice (drawn as a
+    raster mesh).
+    '''
+    rng = np.random.default_rng(seed)
+    nside = int(np.ceil(np.sqrt(ncell)))
+
+    # lattice of cell indices around the epicentre, trimmed to ncell
+    i, j = np.divmod(np.arange(ncell), nside)
+    u = j - nside / 2. + 0.5
+    v = i - nside / 2. + 0.5
+
+    if cells == 'utm':
+        utm = utm_transformer(event['eqlo'], event['eqla'])
+        e0, n0 = utm.transform(event['eqlo'], event['eqla'])
+        size = cell_km * 1000.
+
+        def corners(k):
+            # lon/lat of the corners of cells k, as (ncorner, len(k)) arrays
+            x = e0 + u[k] * size + np.array([-0.5, 0.5, 0.5, -0.5, -0.5])[:, None] * size
+            y = n0 + v[k] * size + np.array([-0.5, -0.5, 0.5, 0.5, -0.5])[:, None] * size
+            return utm.transform(x, y, direction='INVERSE')
+
+        lon, lat = utm.transform(e0 + u * size, n0 + v * size, direction='INVERSE')
+    elif cells == 'lonlat':
+        dlat = cell_km / KM_PER_DEG
+        dlon = dlat / np.cos(np.radians(event['eqla']))
+        lon = event['eqlo'] + u * dlon
+        lat = event['eqla'] + v * dlat
+
+        def corners(k):
+            x = lon[k] + np.array([-0.5, 0.5, 0.5, -0.5, -0.5])[:, None] * dlon
+            y = lat[k] + np.array([-0.5, -0.5, 0.5, 0.5, -0.5])[:, None] * dlat
+            return x, y
+    else:
+        raise ValueError(f"Unknown cell layout {cells}; use 'utm' or 'lonlat'")
+
+    repi = haversine(lon, lat, event['eqlo'], event['eqla'])
+    rrup = np.sqrt(repi**2 + event['eqdep']**2)
+    intensity = np.clip(ipe(model, event['mag'], rrup)[0] + rng.normal(0., 0.5, ncell), 1., 10.)
+    nresp = 1 + rng.poisson(50. / (1. + rrup / 20.))
+
+    with open(outfile, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+        for c0 in range(0, ncell, chunk):
+            # cell corners a chunk at a time, so memory stays bounded
+            k = np.arange(c0, min(c0 + chunk, ncell))
+            x, y = corners(k)
+            for m, kk in enumerate(k):
+                feature = {'type': 'Feature', 'id': f'c{kk}',
+                           'geometry': {'type': 'Polygon', 'coordinates': [np.column_stack((x[:, m], y[:, m])).tolist()]},
+                           'properties': {'center': {'type': 'Point', 'coordinates': [lon[kk], lat[kk]]},
+                                          'intensityFine': round(float(intensity[kk]), 2), 'nresp': int(nresp[kk]),
+                                          'name': f'c{kk}'}}
+                f.write(json.dumps(feature))
+                f.write(',\n' if kk < ncell - 1 else '\n')
+        f.write(']}\n')
+
+    return ncell
+
+def synthetic_catalog(nevent, seed=None, outfile=None):
+    '''
+    Catalogue of nevent events as a dict of arrays (mag, eqdep, eqla, eqlo,
+    vs30), optionally saved as CSV.
+    '''
+    rng = np.random.default_rng(seed)
+
+    # truncated Gutenberg-Richter magnitudes with b = 1 between 3 and 7.5
+    u = rng.uniform(0., 1., nevent)
+    mag = 3. - np.log10(1. - u * (1. - 10.**-4.5))
+
+    catalog = {'mag': mag, 'eqdep': rng.uniform(2., 30., nevent),
+               'eqla': rng.uniform(-39., -33., nevent), 'eqlo': rng.uniform(141., 150., nevent),
+               'vs30': rng.choice([400., 760.], nevent)}
+
+    if outfile is not None:
+        np.savetxt(outfile, np.column_stack([catalog[key] for key in catalog]), delimiter=',',
+                   header=','.join(catalog), comments='', fmt='%.4f')
+
+    return catalog
@@ -2,225 +2,267 @@ import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import matplotlib as mpl
 from matplotlib.colors import ListedColormap
-from numpy import mean, percentile, array
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-import json
 import sys
 import os
-from matplotlib_scalebar.scalebar import ScaleBar
-from matplotlib.patheffects import withStroke
-from cartopy.io import shapereader
 import matplotlib.patheffects as path_effects
-from adjustText import adjust_text
-import random
-import numpy as np
-
-mpl.style.use('classic')
-
-# Get the GeoJSON file path from command line argument or prompt the user
-if len(sys.argv) > 1:
-    jsonFilePath = sys.argv[1]
-else:
-    # Prompt the user for the file path
-    jsonFilePath = input("Enter the path to the GeoJSON file: ")
-
-# Check if the provided file path exists
-if not os.path.exists(jsonFilePath):
-    print("The file does not exist. Please check the path.")
-    sys.exit(1)
-
-# Load GeoJSON data
-with open(jsonFilePath) as f:
-    data = json.load(f)
-
-dyfi_dict = []
-for feature in data['features']:
-    tmp = {'geometry': feature['geometry']['coordinates'][0],
-           'centroid': feature['properties']['center']['coordinates'],
-           'intensity': feature['properties']['intensityFine'],
-           'nresp': feature['properties']['nresp']}
-    
-    # append to list
-    dyfi_dict.append(tmp)
-        
-###############################################################################
-# set eq details
-###############################################################################
-
-# Prompt the user to enter the zoom level
-zoom_factor = float(input("Enter the zoom factor (e.g., 1 for default zoom, 0.5 for closer zoom, 2 for farther view): "))
-
-# Set eq details
-mag = 5.9
-eqdep = 12.0
-eqla = -37.5063
-eqlo = 146.4022
-degrng = 5.9 * zoom_factor  # Adjust zoom level based on user input
-latoff = -0.0
-lonoff = -1.2
-mstr = '5.9'
-place = 'Woods Point, VIC'
-evid = '2021-09-21'
-
-# Set the map extent to center around the earthquake
-# Adjust the bounds based on `degrng` for zoom
-urcrnrlat = eqla + degrng
-llcrnrlat = eqla - degrng
-urcrnrlon = eqlo + degrng
-llcrnrlon = eqlo - degrng
-
-# Set up figure
-fig = plt.figure(figsize=(10, 12))
-ax = plt.axes(projection=ccrs.PlateCarree())
-ax.set_extent([llcrnrlon, urcrnrlon, llcrnrlat, urcrnrlat], crs=ccrs.PlateCarree())
-
-
-# Add map features
-ax.add_feature(cfeature.LAND, facecolor='0.9')
-ax.add_feature(cfeature.OCEAN, facecolor='lightskyblue')
-ax.add_feature(cfeature.COASTLINE)
-ax.add_feature(cfeature.BORDERS, linestyle=':')
-ax.add_feature(cfeature.LAKES, facecolor='lightskyblue')
-ax.add_feature(cfeature.RIVERS)
-ax.add_feature(cfeature.STATES, linestyle='-', edgecolor='black')
-
-# Add gridlines without visible lines but keep labels
-gl = ax.gridlines(draw_labels=True, linewidth=0, dms=True, x_inline=False, y_inline=False)
-gl.top_labels = False
-gl.right_labels = False
-
-# Ask user for population size threshold
-pop_threshold = int(input("Enter the minimum population size for cities to be plotted: "))
-
-# Use Natural Earth data for populated places
-shpfilename = shapereader.natural_earth(resolution='10m', category='cultural', name='populated_places')
-
-# Read populated places and plot cities, ensuring they don't overlap with the earthquake symbol
-buffer_radius = 1  # Buffer radius to avoid overlap with the earthquake star
-reader = shapereader.Reader(shpfilename)
-
-
-preferred_offset = (-0.3, -0.3)  # Preferred initial offset for placing labels (bottom-left)
-
-texts = []
-# Adjust text placement closer to the city markers
-for record in reader.records():
-    city_name = record.attributes['NAME']
-    lat = record.geometry.y
-    lon = record.geometry.x
-
-    # Calculate distance from earthquake epicenter
-    distance = np.sqrt((lat - eqla)**2 + (lon - eqlo)**2)
-
-    # Only plot cities that meet the population threshold and are within the map extent
-    if record.attributes['POP_MAX'] > pop_threshold and \
-            (llcrnrlat <= lat <= urcrnrlat) and (llcrnrlon <= lon <= urcrnrlon):
-
-        # Plot the city marker
-        ax.plot(lon, lat, 'o', color='black', markersize=5, transform=ccrs.PlateCarree(), zorder=1100)
-
-        # Place the text closer to the city marker with a smaller offset
-        text = ax.text(lon + 0.05, lat + 0.05, city_name,
-                       fontsize=10, weight='bold', color='black',
-                       path_effects=[path_effects.withStroke(linewidth=3, foreground='white')],
-                       transform=ccrs.PlateCarree(), zorder=1100)
-        texts.append(text)
-
-# Adjust text to avoid overlaps, allowing further movement if the initial placement causes issues
-adjust_text(
-    texts,
-    only_move={'points': 'xy', 'texts': 'xy'},  # Allow text to be adjusted in both x and y directions
-    expand_text=(1.2, 1.2),  # Expand space around text labels slightly
-    force_text=(5, 5),  # Reduce the force to move texts compared to the original
-    avoid_points=[(eqlo, eqla)],  # Avoid the earthquake location
-    arrowprops=None
-)
-
-
-
-
-
-# Add scale bar
-scalebar = ScaleBar(100, location='lower left', scale_loc='top', units='km', length_fraction=0.2,
-                    box_alpha=0.8, color='black', font_properties={'size': 'large'})
-ax.add_artist(scalebar)
-
-# Custom colormap definition
-colors = [
-    (255, 255, 255),  # Intensity 1
-    (239, 242, 255),  # Intensity 2
-    (176, 217, 255),  # Intensity 3
-    (136, 249, 255),  # Intensity 4
-    (122, 255, 147),  # Intensity 5
-    (255, 241, 0),    # Intensity 6
-    (255, 172, 0),    # Intensity 7
-    (255, 36, 0),     # Intensity 8
-    (200, 0, 0),      # Intensity 9
-    (164, 0, 0)       # Intensity 10
-]
-
-# Normalize RGB values to [0, 1]
-colors = [(r/255.0, g/255.0, b/255.0) for r, g, b in colors]
-
-# Create a custom ListedColormap
-custom_cmap = ListedColormap(colors, name='custom_cmap')
-
-##########################################################################################
-# plt dyfi
-##########################################################################################
-
-# loop thru grid cells values and plt MMI
-nresp = 0
-min_resp = 0
-for dyfi in dyfi_dict:        
-    # add to list greater than minObs
-    if dyfi['nresp'] > min_resp:
-        
-        # now plot
-        pltx = array(dyfi['geometry'])[:, 0]
-        plty = array(dyfi['geometry'])[:, 1]
-        
-        ax.fill(pltx, plty, fc=colors[int(round(dyfi['intensity'])) - 1], ec='0.45', lw=0.25, transform=ccrs.PlateCarree(), zorder=100)
-        
-    nresp += dyfi['nresp']
-        
-##########################################################################################
-# annotate
-##########################################################################################
-
-# plt earthquake epicentre
-x, y = eqlo, eqla
-ax.plot(x, y, '*', color='red', markersize=25, markerfacecolor='None', mew=1.5, transform=ccrs.PlateCarree(), zorder=1000)
-
-# Add the number of responses text and set a higher zorder to ensure it stays on top
-plttxt = 'Number of Responses = ' + str(nresp)
-x, y = llcrnrlon + 0.02 * (urcrnrlon - llcrnrlon), urcrnrlat - 0.02 * (urcrnrlat - llcrnrlat)
-props = dict(boxstyle='round', facecolor='w', alpha=1, edgecolor='black', linewidth=1.5)  # Make the box more prominent
-ax.text(x, y, plttxt, size=16, ha='left', va='top', bbox=props, transform=ccrs.PlateCarree(), zorder=2000)
-
-
-##########################################################################################
-# make colorbar
-##########################################################################################
-
-# set colourbar
-plt.gcf().subplots_adjust(bottom=0.15)
-cax = fig.add_axes([0.15, 0.15, 0.7, 0.02]) # setup colorbar axes to be better positioned
-
-norm = mpl.colors.Normalize(vmin=0.5, vmax=10.5)
-cb = plt.colorbar(cm.ScalarMappable(norm=norm, cmap=custom_cmap), cax=cax, orientation='horizontal')
-
-# set cb labels
-ticks = range(1, 11)
-rom_num = ['I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X']
-cb.set_ticks(ticks)
-cb.set_ticklabels(rom_num)
-
-# Add colorbar label
-titlestr = 'Macroseismic Intensity'
-cb.set_label(titlestr, fontsize=16)
-
-# Save the figure
-plt.savefig('_'.join((evid.replace('-', ''), place.split(',')[0].replace(' ', '_'), 'gridded_mmi_data_gridded.jpg')), format='jpg', bbox_inches='tight', dpi=300)
-plt.show()
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'MMI_Attenuation'))
+from mmi_grid import load_scenario_grid
+from dyfi_io import load_dyfi
+from dyfi_render import MMI_RGB, plot_dyfi_cells
+from dyfi_places import load_places, query_places
+from label_placer import place_labels
+from dyfi_events import WOODS_POINT, event_extent, output_stem
+from dyfi_aggregate import aggregate_grid, grid_cells
+from pipeline_stats import stage, enable_from_argv
+import product_cache
+
+# modules whose code changes the static map, for the product cache key
+STATIC_MAP_CODE = ['DYFI_MAP.py', 'dyfi_render.py', 'dyfi_places.py', 'label_placer.py', 'basemap_cache.py',
+                   'dyfi_aggregate.py']
+
+def static_map_key(source, event, zoom_factor=1., pop_threshold=0, scenarioFilePath=None, dpi=300,
+                   cache_basemap=True, cell_size=None):
+    # product cache key of a static map; source is a digest of the DYFI cells (file or arrays)
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = [product_cache.file_digest(os.path.join(here, name)) for name in STATIC_MAP_CODE]
+    scenario = product_cache.file_digest(scenarioFilePath) if scenarioFilePath is not None else None
+
+    return product_cache.product_key('static map', source=source,
+                                     event={k: v for k, v in event.items() if k != 'geojson'}, zoom_factor=zoom_factor,
+                                     pop_threshold=pop_threshold, scenario=scenario, dpi=dpi,
+                                     cache_basemap=cache_basemap, cell_size=cell_size, code=code,
+                                     matplotlib=mpl.__version__)
+
+def label_obstacles(nresp_text, scalebar):
+    # display boxes of the response count text and scale bar, laid out now so labels can be kept clear of them
+    ax = nresp_text.axes
+    ax.apply_aspect()
+    renderer = ax.figure.canvas.get_renderer()
+    nresp_text.update_bbox_position_size(renderer)
+    scalebar.draw(renderer)
+
+    return [nresp_text.get_bbox_patch().get_window_extent(renderer).extents, scalebar.info.window_extent.extents]
+
+def label_places(ax, places, eqlo, eqla, obstacles):
+    '''
+    Label places in order of population, dropping labels that would overlap
+    the markers, the earthquake star, the obstacle boxes or a more populous
+    place's label. Returns the text artists.
+    '''
+    import cartopy.crs as ccrs
+
+    return place_labels(ax, places['lon'], places['lat'], places['name'], transform=ccrs.PlateCarree(),
+                        avoid=[(eqlo, eqla)], avoid_size=25, obstacles=obstacles, marker_size=5, fontsize=10,
+                        weight='bold', color='black',
+                        path_effects=[path_effects.withStroke(linewidth=3, foreground='white')], zorder=1100)
+
+def make_static_map(dyfi, event, zoom_factor=1., pop_threshold=0, scenarioFilePath=None, outfile=None,
+                    dpi=300, cache_basemap=True, cell_size=None, cache=False, source=None,
+                    artists=None):
+    '''
+    Draw the DYFI map of an event (see dyfi_events) and save it to outfile,
+    by default <evid>_<place>_gridded_mmi_data_gridded.jpg. The Natural Earth
+    basemap is reused from the on-disk cache if cache_basemap. If cell_size
+    (km) is given, the cells are re-aggregated to squares of that size (see
+    dyfi_aggregate) before drawing. With cache, an unchanged map is served
+    from the product cache instead (see product_cache); source is a digest of
+    the GeoJSON file, else the arrays are hashed. If artists is a dict, it
+    is filled with the axes, cells artist and response count text for live
+    updates (see dyfi_watch). Returns the figure (None if served from the
+    cache) and the output file name.
+    '''
+    if outfile is None:
+        outfile = output_stem(event) + '_gridded_mmi_data_gridded.jpg'
+
+    if cache:
+        key = static_map_key(source or product_cache.array_digest(dyfi), event, zoom_factor, pop_threshold,
+                             scenarioFilePath, dpi, cache_basemap, cell_size)
+        if product_cache.restore(key, [outfile]):
+            return None, outfile
+
+    # cartopy and the basemap cache are only loaded when a map is drawn
+    import cartopy.crs as ccrs
+    import cartopy.feature as cfeature
+    from matplotlib_scalebar.scalebar import ScaleBar
+    from basemap_cache import BASEMAP_FEATURES, add_basemap
+
+    mpl.style.use('classic')
+
+    ###############################################################################
+    # set eq details
+    ###############################################################################
+
+    eqla = event['eqla']
+    eqlo = event['eqlo']
+
+    # Set the map extent to center around the earthquake, degrng (adjusted for zoom) each way
+    llcrnrlon, urcrnrlon, llcrnrlat, urcrnrlat = event_extent(event, zoom_factor)
+
+    # Set up figure
+    fig = plt.figure(figsize=(10, 12))
+    ax = plt.axes(projection=ccrs.PlateCarree())
+    ax.set_extent([llcrnrlon, urcrnrlon, llcrnrlat, urcrnrlat], crs=ccrs.PlateCarree())
+
+
+    # Leave room for the colorbar now so the basemap and labels are laid out
+    # against the final axes position
+    fig.subplots_adjust(bottom=0.15)
+
+    # Add map features, from the basemap cache when the same map was drawn before
+    with stage('basemap', cached=cache_basemap):
+        if cache_basemap:
+            add_basemap(ax, dpi=dpi)
+        else:
+            for name, kwargs in BASEMAP_FEATURES:
+                ax.add_feature(getattr(cfeature, name), **kwargs)
+
+    # Add gridlines without visible lines but keep labels
+    gl = ax.gridlines(draw_labels=True, linewidth=0, dms=True, x_inline=False, y_inline=False)
+    gl.top_labels = False
+    gl.right_labels = False
+
+    # Add the number of responses text and set a higher zorder to ensure it stays on top
+    nresp = dyfi['nresp'].sum()
+    plttxt = 'Number of Responses = ' + str(nresp)
+    x, y = llcrnrlon + 0.02 * (urcrnrlon - llcrnrlon), urcrnrlat - 0.02 * (urcrnrlat - llcrnrlat)
+    props = dict(boxstyle='round', facecolor='w', alpha=1, edgecolor='black', linewidth=1.5)  # Make the box more prominent
+    nresp_text = ax.text(x, y, plttxt, size=16, ha='left', va='top', bbox=props, transform=ccrs.PlateCarree(), zorder=2000)
+
+    # Add scale bar
+    scalebar = ScaleBar(100, location='lower left', scale_loc='top', units='km', length_fraction=0.2,
+                        box_alpha=0.8, color='black', font_properties={'size': 'large'})
+    ax.add_artist(scalebar)
+
+    # Use Natural Earth data for populated places, from the indexed cache
+    with stage('places') as s:
+        places = query_places(load_places(), [llcrnrlon, urcrnrlon, llcrnrlat, urcrnrlat], pop_threshold)
+
+        # Plot the city markers
+        ax.plot(places['lon'], places['lat'], 'o', color='black', markersize=5, transform=ccrs.PlateCarree(), zorder=1100)
+        s.count(places=len(places['name']))
+
+    # Label cities in order of population, keeping clear of the response count box and scale bar
+    with stage('labels') as s:
+        texts = label_places(ax, places, eqlo, eqla, label_obstacles(nresp_text, scalebar))
+        s.count(labelled=len(texts))
+
+
+    # Custom colormap definition
+    colors = MMI_RGB
+
+    # Normalize RGB values to [0, 1]
+    colors = [(r/255.0, g/255.0, b/255.0) for r, g, b in colors]
+
+    # Create a custom ListedColormap
+    custom_cmap = ListedColormap(colors, name='custom_cmap')
+
+    ##########################################################################################
+    # plt scenario intensity
+    ##########################################################################################
+
+    if scenarioFilePath is not None:
+        with stage('scenario') as s:
+            grid, header = load_scenario_grid(scenarioFilePath)
+
+            # subsample very fine grids so only the displayed resolution is read from disk
+            step = max(1, max(grid.shape) // 2000)
+
+            ax.imshow(grid[::step, ::step], extent=header['extent'], origin='upper', cmap=custom_cmap,
+                      vmin=0.5, vmax=10.5, alpha=0.5, interpolation='nearest', transform=ccrs.PlateCarree(), zorder=50)
+            s.count(pixels=grid[::step, ::step].size)
+
+    ##########################################################################################
+    # plt dyfi
+    ##########################################################################################
+
+    # plt all grid cells with MMI colours as a single artist
+    min_resp = 0
+    with stage('cells') as s:
+        if cell_size is not None:
+            keep = dyfi['nresp'] > min_resp
+            dyfi = grid_cells(aggregate_grid(dyfi['lon'][keep], dyfi['lat'][keep], dyfi['intensity'][keep],
+                                             dyfi['nresp'][keep], cell_size, origin=(eqlo, eqla)))
+        cells = plot_dyfi_cells(ax, dyfi, colors, min_resp=min_resp, transform=ccrs.PlateCarree(), zorder=100)
+        s.count(cells=int((dyfi['nresp'] > min_resp).sum()))
+
+    ##########################################################################################
+    # annotate
+    ##########################################################################################
+
+    # plt earthquake epicentre
+    x, y = eqlo, eqla
+    ax.plot(x, y, '*', color='red', markersize=25, markerfacecolor='None', mew=1.5, transform=ccrs.PlateCarree(), zorder=1000)
+
+
+
+    ##########################################################################################
+    # make colorbar
+    ##########################################################################################
+
+    # set colourbar
+    cax = fig.add_axes([0.15, 0.15, 0.7, 0.02]) # setup colorbar axes to be better positioned
+
+    norm = mpl.colors.Normalize(vmin=0.5, vmax=10.5)
+    cb = plt.colorbar(cm.ScalarMappable(norm=norm, cmap=custom_cmap), cax=cax, orientation='horizontal')
+
+    # set cb labels
+    ticks = range(1, 11)
+    rom_num = ['I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X']
+    cb.set_ticks(ticks)
+    cb.set_ticklabels(rom_num)
+
+    # Add colorbar label
+    titlestr = 'Macroseismic Intensity'
+    cb.set_label(titlestr, fontsize=16)
+
+    # Save the figure
+    with stage('savefig', dpi=dpi):
+        fig.savefig(outfile, format='jpg', bbox_inches='tight', dpi=dpi)
+
+    if cache:
+        product_cache.store(key, [outfile])
+
+    if artists is not None:
+        artists.update(ax=ax, cells=cells, nresp_text=nresp_text, scalebar=scalebar, places=places, labels=texts,
+                       epicentre=(eqlo, eqla), colors=colors, min_resp=min_resp, transform=ccrs.PlateCarree(), dpi=dpi)
+
+    return fig, outfile
+
+if __name__ == '__main__':
+    # Per-stage timings with --stats or PIPELINE_STATS=1
+    enable_from_argv()
+
+    # Get the GeoJSON file path from command line argument or prompt the user
+    if len(sys.argv) > 1:
+        jsonFilePath = sys.argv[1]
+    else:
+        # Prompt the user for the file path
+        jsonFilePath = input("Enter the path to the GeoJSON file: ")
+
+    # Check if the provided file path exists
+    if not os.path.exists(jsonFilePath):
+        print("The file does not exist. Please check the path.")
+        sys.exit(1)
+
+    # Optional scenario grid from mmi_grid.py to plot as a background intensity layer
+    scenarioFilePath = sys.argv[2] if len(sys.argv) > 2 else None
+
+    # Load GeoJSON data into arrays
+    with stage('load dyfi') as s:
+        dyfi = load_dyfi(jsonFilePath)
+        s.count(cells=len(dyfi['lon']))
+
+    # Prompt the user to enter the zoom level
+    zoom_factor = float(input("Enter the zoom factor (e.g., 1 for default zoom, 0.5 for closer zoom, 2 for farther view): "))
+
+    # Ask user for population size threshold
+    pop_threshold = int(input("Enter the minimum population size for cities to be plotted: "))
+
+    # Map the Woods Point event
+    fig, outfile = make_static_map(dyfi, WOODS_POINT, zoom_factor=zoom_factor, pop_threshold=pop_threshold,
+                                   scenarioFilePath=scenarioFilePath, cache=True,
+                                   source=product_cache.file_digest(jsonFilePath))
+    if fig is None:
+        print(f"{outfile} is unchanged (served from the product cache)")
+    plt.show()
@@ -7,136 +7,217 @@ Created on Thu Mar 28 16:32:05 2019
 import json
 import sys
 import os
-import folium
-from folium.plugins import MarkerCluster
 import numpy as np
-
-# Get the GeoJSON file path from command line argument or prompt the user
-if len(sys.argv) > 1:
-    jsonFilePath = sys.argv[1]
-else:
-    # Prompt the user for the file path
-    jsonFilePath = input("Enter the path to the GeoJSON file: ")
-
-# Check if the provided file path exists
-if not os.path.exists(jsonFilePath):
-    print("The file does not exist. Please check the path.")
-    sys.exit(1)
-
-# Load GeoJSON data
-with open(jsonFilePath) as f:
-    data = json.load(f)
-
-dyfi_dict = []
-for feature in data['features']:
-    tmp = {'geometry': feature['geometry']['coordinates'][0],
-           'centroid': feature['properties']['center']['coordinates'],
-           'intensity': feature['properties']['intensityFine'],
-           'nresp': feature['properties']['nresp']}
-    
-    # append to list
-    dyfi_dict.append(tmp)
-        
-###############################################################################
-# set eq details
-###############################################################################
-
-# Woods Point
-mag  = 5.9
-eqdep = 12.0
-eqla = -37.5063
-eqlo = 146.4022
-degrng = 5.9
-latoff = -0.0
-lonoff = -1.2
-mstr = '5.9'
-place = 'Woods Point, VIC'
-evid = '2021-09-21'
-
-##########################################################################################
-# Set up interactive map using folium
-##########################################################################################
-
-# Create a folium map centered at the earthquake location
-m = folium.Map(location=[eqla, eqlo], zoom_start=7, tiles='OpenStreetMap')
-
-# Add earthquake epicenter marker
-folium.Marker(
-    location=[eqla, eqlo],
-    popup=f"<strong>Earthquake Epicenter</strong><br>Magnitude: {mag}",
-    icon=folium.Icon(color='red', icon='star')
-).add_to(m)
-
-# Add scale bar using the `MeasureControl` plugin from folium
-folium.plugins.MeasureControl(primary_length_unit='kilometers').add_to(m)
-
-# Custom colormap definition
-colors = [
-    '#FFFFFF',  # Intensity 1
-    '#EFF2FF',  # Intensity 2
-    '#B0D9FF',  # Intensity 3
-    '#88F9FF',  # Intensity 4
-    '#7AFF93',  # Intensity 5
-    '#FFF100',  # Intensity 6
-    '#FFAC00',  # Intensity 7
-    '#FF2400',  # Intensity 8
-    '#C80000',  # Intensity 9
-    '#A40000'   # Intensity 10
-]
-
-##########################################################################################
-# Plot DYFI data
-##########################################################################################
-
-# Marker cluster for all dyfi points
-marker_cluster = MarkerCluster().add_to(m)
-
-# Loop through each DYFI dictionary entry and add polygons
-for dyfi in dyfi_dict:
-    if dyfi['nresp'] > 0:
-        intensity_index = int(np.clip(round(dyfi['intensity']) - 1, 0, len(colors) - 1))
-        color = colors[intensity_index]
-        polygon_coords = [[lat, lon] for lon, lat in dyfi['geometry']]
-        folium.Polygon(
-            locations=polygon_coords,
-            color=color,
-            weight=0.5,
-            fill=True,
-            fill_color=color,
-            fill_opacity=0.6
-        ).add_to(marker_cluster)
-
-##########################################################################################
-# Annotate with population centers
-##########################################################################################
-
-# Ask user for population size threshold
-pop_threshold = int(input("Enter the minimum population size for cities to be plotted: "))
-
-# Use Natural Earth data for populated places (10m resolution)
-from cartopy.io import shapereader
-shpfilename = shapereader.natural_earth(resolution='10m', category='cultural', name='populated_places')
-reader = shapereader.Reader(shpfilename)
-for record in reader.records():
-    # Get latitude, longitude, and name of the city
-    city_name = record.attributes['NAME']
-    lat = record.geometry.y
-    lon = record.geometry.x
-
-    # Only plot cities with population over user-defined threshold within the current map extent
-    if record.attributes['POP_MAX'] > pop_threshold:
-        folium.Marker(
-            location=[lat, lon],
-            popup=f"<strong>{city_name}</strong>",
-            icon=folium.Icon(color='blue', icon='info-sign')
-        ).add_to(m)
-
-##########################################################################################
-# Save the interactive map
-##########################################################################################
-
-# Save the folium map to an HTML file
-output_file = '_'.join((evid.replace('-', ''), place.split(',')[0].replace(' ', '_'), 'interactive_map.html'))
-m.save(output_file)
-
-print(f"Interactive map saved as {output_file}")
+from dyfi_io import load_dyfi, dyfi_geojson
+from dyfi_places import load_places, query_places
+from dyfi_tiles import dyfi_tiles, scenario_tiles
+from dyfi_events import WOODS_POINT, event_extent, output_stem
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'MMI_Attenuation'))
+from pipeline_stats import stage, enable_from_argv
+import product_cache
+
+# modules whose code changes the interactive map, for the product cache key
+INTERACTIVE_MAP_CODE = ['DYFI_map_int.py', 'dyfi_io.py', 'dyfi_places.py']
+
+def interactive_map_key(source, event, pop_threshold=0, coord_precision=4, simplify_cells=True,
+                        external_cells=False, max_vector_cells=50000):
+    # product cache key of an interactive map; source is a digest of the DYFI cells (file or arrays)
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = [product_cache.file_digest(os.path.join(here, name)) for name in INTERACTIVE_MAP_CODE]
+
+    return product_cache.product_key('interactive map', source=source,
+                                     event={k: v for k, v in event.items() if k != 'geojson'}, pop_threshold=pop_threshold,
+                                     coord_precision=coord_precision, simplify_cells=simplify_cells,
+                                     external_cells=external_cells, max_vector_cells=max_vector_cells, code=code,
+                                     folium=product_cache.package_version('folium'))
+
+def interactive_outputs(output_file, external_cells=False):
+    # files written for an interactive map drawn with vector cells
+    return [output_file] + ([output_file.replace('.html', '_cells.geojson')] if external_cells else [])
+
+def make_interactive_map(dyfi, event, pop_threshold=0, output_file=None, coord_precision=4,
+                         simplify_cells=True, external_cells=False, max_vector_cells=50000, tile_workers=None,
+                         cache=False, source=None, scenarioFilePath=None):
+    '''
+    Build the folium map of an event (see dyfi_events) and save it to
+    output_file, by default <evid>_<place>_interactive_map.html. Cell
+    coordinates are rounded to coord_precision decimal places, simplified if
+    simplify_cells, and written to a separate GeoJSON file if external_cells.
+    With cache, an unchanged map is served from the product cache (see
+    product_cache); source is a digest of the GeoJSON file, else the arrays
+    are hashed. If scenarioFilePath (a mmi_grid.py grid file) is given, the
+    scenario intensities are added as a tile layer under the cells. Maps drawn
+    from tiles are not cached, as the tile pyramids are already only redrawn
+    where the cells or grid changed. Returns the output file name.
+    '''
+    if output_file is None:
+        output_file = output_stem(event) + '_interactive_map.html'
+
+    # Events with more cells than max_vector_cells are drawn from a pre-rendered tile pyramid
+    use_tiles = np.count_nonzero(dyfi['nresp'] > 0) > max_vector_cells
+
+    cache = cache and not use_tiles and scenarioFilePath is None
+    if cache:
+        key = interactive_map_key(source or product_cache.array_digest(dyfi), event, pop_threshold, coord_precision,
+                                  simplify_cells, external_cells, max_vector_cells)
+        if product_cache.restore(key, interactive_outputs(output_file, external_cells)):
+            return output_file
+
+    # folium is only loaded when a map is built
+    import folium
+    import folium.plugins
+    from folium.utilities import JsCode
+
+    # event details
+    mag = event['mag']
+    eqla = event['eqla']
+    eqlo = event['eqlo']
+
+    ##########################################################################################
+    # Set up interactive map using folium
+    ##########################################################################################
+
+    # Create a folium map centered at the earthquake location
+    m = folium.Map(location=[eqla, eqlo], zoom_start=7, tiles='OpenStreetMap')
+
+    # Add earthquake epicenter marker
+    folium.Marker(
+        location=[eqla, eqlo],
+        popup=f"<strong>Earthquake Epicenter</strong><br>Magnitude: {mag}",
+        icon=folium.Icon(color='red', icon='star')
+    ).add_to(m)
+
+    # Add scale bar using the `MeasureControl` plugin from folium
+    folium.plugins.MeasureControl(primary_length_unit='kilometers').add_to(m)
+
+    # Custom colormap definition
+    colors = [
+        '#FFFFFF',  # Intensity 1
+        '#EFF2FF',  # Intensity 2
+        '#B0D9FF',  # Intensity 3
+        '#88F9FF',  # Intensity 4
+        '#7AFF93',  # Intensity 5
+        '#FFF100',  # Intensity 6
+        '#FFAC00',  # Intensity 7
+        '#FF2400',  # Intensity 8
+        '#C80000',  # Intensity 9
+        '#A40000'   # Intensity 10
+    ]
+
+    ##########################################################################################
+    # Plot scenario intensity
+    ##########################################################################################
+
+    if scenarioFilePath is not None:
+        # Tiles are only redrawn where the grid changed since the last run
+        scenario_dir = output_file.replace('.html', '_scenario_tiles')
+        with stage('scenario tiles'):
+            scenario_tiles(scenarioFilePath, scenario_dir, zooms=range(4, 10), workers=tile_workers)
+
+        folium.TileLayer(tiles=os.path.basename(scenario_dir) + '/{z}/{x}/{y}.png', attr='Scenario', name='Scenario',
+                         overlay=True, min_zoom=4, max_zoom=18, max_native_zoom=9).add_to(m)
+
+    ##########################################################################################
+    # Plot DYFI data
+    ##########################################################################################
+
+    if use_tiles:
+        # Tiles are only redrawn where the cells changed since the last run
+        tiles_dir = output_file.replace('.html', '_tiles')
+        with stage('tiles', cells=int(np.count_nonzero(dyfi['nresp'] > 0))):
+            dyfi_tiles(dyfi, tiles_dir, zooms=range(4, 12), min_resp=0, workers=tile_workers)
+
+        folium.TileLayer(tiles=os.path.basename(tiles_dir) + '/{z}/{x}/{y}.png', attr='DYFI', name='DYFI', overlay=True, 
+                         min_zoom=4, max_zoom=18, max_native_zoom=11).add_to(m)
+
+    # All cells with responses as a single GeoJSON layer
+    if not use_tiles:
+        with stage('geojson cells') as s:
+            cells = dyfi_geojson(dyfi, min_resp=0, precision=coord_precision, simplify=simplify_cells)
+            s.count(cells=len(cells['features']))
+            if external_cells:
+                cells_file = output_file.replace('.html', '_cells.geojson')
+                with open(cells_file, 'w') as f:
+                    json.dump(cells, f, separators=(',', ':'))
+                cells = cells_file
+
+        # Style each cell in the browser from its intensity class
+        cell_style = JsCode("""
+            function(feature) {
+                var colors = %s;
+                var color = colors[feature.properties.mmi - 1];
+                return {color: color, weight: 0.5, fill: true, fillColor: color, fillOpacity: 0.6};
+            }""" % json.dumps(colors))
+
+        layer = folium.GeoJson(cells, name='DYFI', embed=not external_cells, style=cell_style)
+        if external_cells:
+            # link the cells file relative to the HTML
+            layer.embed_link = os.path.basename(cells_file)
+        layer.add_to(m)
+
+    ##########################################################################################
+    # Annotate with population centers
+    ##########################################################################################
+
+    # Use Natural Earth data for populated places (10m resolution) within the static map's
+    # extent, from the indexed cache
+    with stage('place markers') as s:
+        places = query_places(load_places(), event_extent(event), pop_threshold)
+        for city_name, lat, lon in zip(places['name'], places['lat'], places['lon']):
+            folium.Marker(
+                location=[lat, lon],
+                popup=f"<strong>{city_name}</strong>",
+                icon=folium.Icon(color='blue', icon='info-sign')
+            ).add_to(m)
+        s.count(places=len(places['name']))
+
+    # Let the scenario layer be switched off
+    if scenarioFilePath is not None:
+        folium.LayerControl().add_to(m)
+
+    ##########################################################################################
+    # Save the interactive map
+    ##########################################################################################
+
+    # Save the folium map to an HTML file
+    with stage('save html'):
+        m.save(output_file)
+
+    if cache:
+        product_cache.store(key, interactive_outputs(output_file, external_cells))
+
+    return output_file
+
+if __name__ == '__main__':
+    # Per-stage timings with --stats or PIPELINE_STATS=1
+    enable_from_argv()
+
+    # Get the GeoJSON file path from command line argument or prompt the user
+    if len(sys.argv) > 1:
+        jsonFilePath = sys.argv[1]
+    else:
+        # Prompt the user for the file path
+        jsonFilePath = input("Enter the path to the GeoJSON file: ")
+
+    # Check if the provided file path exists
+    if not os.path.exists(jsonFilePath):
+        print("The file does not exist. Please check the path.")
+        sys.exit(1)
+
+    # Load GeoJSON data into arrays
+    with stage('load dyfi') as s:
+        dyfi = load_dyfi(jsonFilePath)
+        s.count(cells=len(dyfi['lon']))
+
+    # Optional scenario grid from mmi_grid.py to add as a tile layer
+    scenarioFilePath = sys.argv[2] if len(sys.argv) > 2 else None
+
+    # Ask user for population size threshold
+    pop_threshold = int(input("Enter the minimum population size for cities to be plotted: "))
+
+    # Map the Woods Point event
+    output_file = make_interactive_map(dyfi, WOODS_POINT, pop_threshold=pop_threshold, cache=True,
+                                       source=product_cache.file_digest(jsonFilePath), scenarioFilePath=scenarioFilePath)
+
+    print(f"Interactive map saved as {output_file}")
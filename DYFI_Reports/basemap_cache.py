@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of rendered cartopy basemaps
+
+The Natural Earth features under a static map are rasterised once for a given
+map extent, projection, axes size and dpi into a PNG, then drawn back with
+imshow on later runs. Only the cached image is read when the same region is
+mapped again, so the features are not clipped and projected every time.
+Gridlines, cells and annotations stay live on top.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import matplotlib
+from PIL import Image
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import cartopy
+import cartopy.feature as cfeature
+
+# features and styles of the basemap, bottom to top
+BASEMAP_FEATURES = [('LAND', {'facecolor': '0.9'}),
+                    ('OCEAN', {'facecolor': 'lightskyblue'}),
+                    ('COASTLINE', {}),
+                    ('BORDERS', {'linestyle': ':'}),
+                    ('LAKES', {'facecolor': 'lightskyblue'}),
+                    ('RIVERS', {}),
+                    ('STATES', {'linestyle': '-', 'edgecolor': 'black'})]
+
+CACHE_DIR = os.environ.get('DYFI_BASEMAP_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'dyfi_basemaps'))
+
+def axes_pixels(ax, dpi):
+    # (width, height) of the axes in output pixels at dpi
+    ax.apply_aspect()
+    pos = ax.get_position()
+    fig = ax.figure
+
+    return int(round(pos.width * fig.get_figwidth() * dpi)), int(round(pos.height * fig.get_figheight() * dpi))
+
+def basemap_key(ax, dpi, features=BASEMAP_FEATURES):
+    # hash of everything that changes the rendered basemap
+    spec = {'extent': np.round(ax.get_extent(), 9).tolist(),
+            'projection': ax.projection.proj4_init,
+            'size': axes_pixels(ax, dpi),
+            'dpi': dpi,
+            'features': features,
+            'linewidth': [matplotlib.rcParams['lines.linewidth'], matplotlib.rcParams['patch.linewidth']],
+            'versions': [matplotlib.__version__, cartopy.__version__]}
+
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+def render_basemap(ax, dpi, outfile, features=BASEMAP_FEATURES):
+    # rasterise the features over the extent of ax into a PNG of the axes size
+    width, height = axes_pixels(ax, dpi)
+    x0, x1, y0, y1 = ax.get_extent()
+
+    fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    bax = fig.add_axes([0, 0, 1, 1], projection=ax.projection)
+    bax.set_aspect('auto')
+    bax.set_xlim(x0, x1)
+    bax.set_ylim(y0, y1)
+    bax.set_axis_off()
+
+    for name, kwargs in features:
+        bax.add_feature(getattr(cfeature, name), **kwargs)
+
+    # write to a temporary file first so concurrent renders never see a partial image
+    tmpfile = f'{outfile}.{os.getpid()}.tmp'
+    fig.savefig(tmpfile, format='png', dpi=dpi)
+    os.replace(tmpfile, outfile)
+
+def add_basemap(ax, dpi=300, features=BASEMAP_FEATURES, cachedir=CACHE_DIR, zorder=0):
+    '''
+    Draw the basemap under ax from the cache, rendering it first if needed.
+    Call after the extent and figure layout are final; dpi should match the
+    dpi the figure is saved at. Returns the image artist.
+    '''
+    os.makedirs(cachedir, exist_ok=True)
+    cachefile = os.path.join(cachedir, basemap_key(ax, dpi, features) + '.png')
+    if not os.path.exists(cachefile):
+        render_basemap(ax, dpi, cachefile, features)
+
+    x0, x1, y0, y1 = ax.get_extent()
+    img = ax.imshow(np.asarray(Image.open(cachefile)), extent=(x0, x1, y0, y1), origin='upper', transform=ax.projection,
+                    interpolation='none', zorder=zorder)
+
+    # keep the extent imshow may have autoscaled
+    ax.set_xlim(x0, x1)
+    ax.set_ylim(y0, y1)
+
+    return img
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Re-aggregation of DYFI cells or responses into coarser bins
+
+Points (cell centroids or individual responses) with an intensity and a
+weight (nresp, or 1 per response) are binned into square km grids or into
+log-spaced distance bins from the epicentre. Per bin, the weighted mean,
+weighted median, point count and total weight all come from one pass over
+the points: one sort by (bin, intensity), then bincount and cumulative-sum
+reductions over the sorted arrays, with no Python loop over bins.
+
+Square grids use an equirectangular projection about an origin (the
+epicentre), which is accurate enough for the few hundred km of a felt area.
+Aggregated grids convert back to the load_dyfi struct-of-arrays layout, so
+they can be drawn with dyfi_render.plot_dyfi_cells or written with
+dyfi_io.dyfi_geojson.
+"""
+
+import sys
+import numpy as np
+
+EARTH_RADIUS = 6371.  # km
+KM_PER_DEG = np.pi * EARTH_RADIUS / 180.
+
+def epicentral_distance(lon, lat, eqlo, eqla):
+    # great-circle distance (km) from the epicentre
+    dlon = np.radians(lon - eqlo)
+    dlat = np.radians(lat - eqla)
+    a = np.sin(dlat / 2)**2 + np.cos(np.radians(eqla)) * np.cos(np.radians(lat)) * np.sin(dlon / 2)**2
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.)))
+
+def binned_stats(bins, values, weights, nbin=None):
+    '''
+    Weighted mean, weighted median, count and weight sum of values in each
+    integer bin. Bins with no points get nan mean and median. The median is
+    the smallest value whose cumulative weight reaches half its bin's weight.
+    '''
+    bins = np.asarray(bins, dtype=np.int64)
+    values = np.asarray(values, dtype=float)
+    weights = np.broadcast_to(np.asarray(weights, dtype=float), values.shape)
+    if nbin is None:
+        nbin = int(bins.max()) + 1 if len(bins) else 0
+
+    count = np.bincount(bins, minlength=nbin)
+    wsum = np.bincount(bins, weights=weights, minlength=nbin)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(bins, weights=values * weights, minlength=nbin) / wsum
+
+    # sort by bin then value (a stable sort on bins of the value order, faster than lexsort);
+    # the median is the first point of its bin whose cumulative weight reaches half the bin weight
+    order = np.argsort(values)
+    order = order[np.argsort(bins[order], kind='stable')]
+    sbins = bins[order]
+    cumw = np.cumsum(weights[order])
+    start = np.cumsum(count) - count
+    within = cumw - np.concatenate(([0.], cumw))[start][sbins]
+    short = np.bincount(sbins, weights=within < wsum[sbins] * (0.5 - 1e-12), minlength=nbin).astype(np.int64)
+
+    median = np.full(nbin, np.nan)
+    filled = count > 0
+    median[filled] = values[order][start[filled] + short[filled]]
+
+    return {'mean': mean, 'median': median, 'count': count, 'weight': wsum}
+
+def square_bins(lon, lat, size, origin):
+    '''
+    Integer bin of every point on a grid of size km squares aligned to origin
+    (lon, lat), plus the (ix, iy) grid indices of each occupied bin.
+    '''
+    coslat = np.cos(np.radians(origin[1]))
+    ix = np.floor((lon - origin[0]) * KM_PER_DEG * coslat / size).astype(np.int64)
+    iy = np.floor((lat - origin[1]) * KM_PER_DEG / size).astype(np.int64)
+    if len(ix) == 0:
+        return ix, ix, iy
+
+    # pack to one key, then number the occupied bins 0..nbin-1, by a lookup table when the
+    # bounding grid is small and by sorting the keys otherwise
+    ny = iy.max() - iy.min() + 1
+    nx = ix.max() - ix.min() + 1
+    key = (ix - ix.min()) * ny + (iy - iy.min())
+    if nx * ny <= max(4 * len(key), 1 << 20):
+        hit = np.bincount(key, minlength=nx * ny) > 0
+        occupied = np.flatnonzero(hit)
+        bins = (np.cumsum(hit) - 1)[key]
+    else:
+        occupied, bins = np.unique(key, return_inverse=True)
+
+    return bins, occupied // ny + ix.min(), occupied % ny + iy.min()
+
+def aggregate_grid(lon, lat, intensity, weights=1., size=10., origin=None):
+    '''
+    Aggregate points into size km squares. Returns a dict with the lon/lat
+    centre and bounds of every occupied square, plus the binned statistics.
+    origin defaults to the weighted centroid of the points.
+    '''
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    if origin is None:
+        w = np.broadcast_to(np.asarray(weights, dtype=float), lon.shape)
+        origin = (np.average(lon, weights=w), np.average(lat, weights=w))
+
+    bins, ix, iy = square_bins(lon, lat, size, origin)
+    stats = binned_stats(bins, intensity, weights, len(ix))
+
+    dlon = size / (KM_PER_DEG * np.cos(np.radians(origin[1])))
+    dlat = size / KM_PER_DEG
+    stats['lon0'] = origin[0] + ix * dlon
+    stats['lat0'] = origin[1] + iy * dlat
+    stats['lon'] = stats['lon0'] + dlon / 2.
+    stats['lat'] = stats['lat0'] + dlat / 2.
+    stats['dlon'] = dlon
+    stats['dlat'] = dlat
+    stats['size'] = size
+
+    return stats
+
+def aggregate_distance(lon, lat, intensity, weights=1., eqlo=0., eqla=0., eqdep=None,
+                       rmin=1., rmax=1000., nbin_per_decade=10):
+    '''
+    Aggregate points into log-spaced distance bins from the epicentre, or
+    hypocentral distance if eqdep is given. Points outside [rmin, rmax) are
+    dropped. Returns the binned statistics with the bin edges and
+    geometric-centre distances.
+    '''
+    dist = epicentral_distance(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float), eqlo, eqla)
+    if eqdep is not None:
+        dist = np.sqrt(dist**2 + eqdep**2)
+
+    nbin = int(np.ceil(np.log10(rmax / rmin) * nbin_per_decade))
+    edges = rmin * 10.**(np.arange(nbin + 1) / nbin_per_decade)
+    bins = np.searchsorted(edges, dist, side='right') - 1
+    keep = (bins >= 0) & (bins < nbin)
+
+    weights = np.broadcast_to(np.asarray(weights, dtype=float), dist.shape)
+    stats = binned_stats(bins[keep], np.asarray(intensity, dtype=float)[keep], weights[keep], nbin)
+    stats['edges'] = edges
+    stats['dist'] = np.sqrt(edges[:-1] * edges[1:])
+
+    return stats
+
+def grid_cells(grid, statistic='mean'):
+    '''
+    Aggregated squares as a load_dyfi style struct-of-arrays dict, with the
+    chosen statistic as intensity and the summed weight as nresp.
+    '''
+    n = len(grid['lon'])
+    x0, y0 = grid['lon0'], grid['lat0']
+    x1, y1 = x0 + grid['dlon'], y0 + grid['dlat']
+    coords = np.stack([np.column_stack(c) for c in ((x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0))], axis=1)
+
+    return {'intensity': grid[statistic], 'nresp': np.rint(grid['weight']).astype(np.int64),
+            'lon': grid['lon'], 'lat': grid['lat'],
+            'coords': coords.reshape(-1, 2), 'offsets': np.arange(n + 1, dtype=np.int64) * 5}
+
+def pyramid(lon, lat, intensity, weights=1., sizes=(1., 10., 25.), origin=None):
+    # aggregate_grid at each square size (km), keyed by size
+    return {size: aggregate_grid(lon, lat, intensity, weights, size, origin) for size in sizes}
+
+####################################################################################
+# Pyramid and distance bins for a DYFI GeoJSON file
+
+if __name__ == '__main__':
+    from dyfi_io import load_dyfi
+    from dyfi_events import WOODS_POINT, output_stem
+
+    dyfi = load_dyfi(sys.argv[1])
+    event = WOODS_POINT
+    keep = dyfi['nresp'] > 0
+    lon, lat, mmi, nresp = dyfi['lon'][keep], dyfi['lat'][keep], dyfi['intensity'][keep], dyfi['nresp'][keep]
+
+    for size, grid in pyramid(lon, lat, mmi, nresp, origin=(event['eqlo'], event['eqla'])).items():
+        print(f"{size:g} km: {len(grid['lon'])} squares from {len(lon)} cells")
+
+    dist = aggregate_distance(lon, lat, mmi, nresp, event['eqlo'], event['eqla'], event['eqdep'])
+    filled = dist['count'] > 0
+    np.savetxt(output_stem(event) + '_binned_mmi.csv',
+               np.column_stack((dist['dist'], dist['mean'], dist['median'], dist['count'], dist['weight']))[filled],
+               delimiter=',', header='rhypo,mean,median,count,nresp', comments='', fmt='%.4f')
+    print(f"Distance-binned intensities saved as {output_stem(event)}_binned_mmi.csv")
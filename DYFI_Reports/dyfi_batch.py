@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Headless batch rendering of DYFI maps
+
+Renders the static (DYFI_MAP.py) and interactive (DYFI_map_int.py) maps for
+every event in a directory or manifest (see dyfi_events) across a process
+pool, with the Agg backend and no prompts. Usage:
+
+    python dyfi_batch.py events/ --outdir maps --workers 8
+    python dyfi_batch.py manifest.json --products static
+
+Per-event zoom, pop_threshold and scenario (a mmi_grid.py grid file) keys in
+the metadata override the command line defaults.
+"""
+
+import os
+import sys
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+matplotlib.use('Agg')
+
+from dyfi_events import load_manifest, find_events, output_stem
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'MMI_Attenuation'))
+
+def cached_products(event, stem, products, zoom, pop_threshold, source):
+    # output files of the requested products if all are unchanged in the product cache, else None
+    import product_cache
+    outputs = []
+
+    if 'static' in products:
+        from DYFI_MAP import static_map_key
+        key = static_map_key(source, event, event.get('zoom', zoom), pop_threshold, event.get('scenario'))
+        outputs.append(stem + '_gridded_mmi_data_gridded.jpg')
+        if not product_cache.restore(key, outputs[-1:]):
+            return None
+
+    if 'interactive' in products:
+        # maps with a scenario tile layer are not cached
+        if event.get('scenario') is not None:
+            return None
+        from DYFI_map_int import interactive_map_key, interactive_outputs
+        key = interactive_map_key(source, event, pop_threshold)
+        outputs.append(stem + '_interactive_map.html')
+        if not product_cache.restore(key, interactive_outputs(outputs[-1])):
+            return None
+
+    return outputs
+
+def render_event(event, outdir, products=('static', 'interactive'), zoom=1., pop_threshold=0, stats=False,
+                 cache=True):
+    '''
+    Render the requested products of one event into outdir, with a
+    per-stage timing report (see pipeline_stats) if stats. With cache,
+    products unchanged since an earlier run are served from the product
+    cache, without loading the GeoJSON if all of them are. Returns
+    (geojson, output files, error message or None).
+    '''
+    import matplotlib.pyplot as plt
+    from dyfi_io import load_dyfi
+    import pipeline_stats
+    import product_cache
+
+    outputs = []
+    stem = os.path.join(outdir, output_stem(event))
+    if stats:
+        pipeline_stats.enable()
+        pipeline_stats.reset()
+
+    try:
+        pop_threshold = event.get('pop_threshold', pop_threshold)
+        source = product_cache.file_digest(event['geojson']) if cache else None
+        if cache:
+            with pipeline_stats.stage('product cache') as s:
+                cached = cached_products(event, stem, products, zoom, pop_threshold, source)
+                s.count(hit=cached is not None)
+            if cached is not None:
+                outputs.extend(cached)
+                return event['geojson'], outputs, None
+
+        with pipeline_stats.stage('load dyfi') as s:
+            dyfi = load_dyfi(event['geojson'])
+            s.count(cells=len(dyfi['lon']))
+
+        if 'static' in products:
+            from DYFI_MAP import make_static_map
+            fig, outfile = make_static_map(dyfi, event, zoom_factor=event.get('zoom', zoom), pop_threshold=pop_threshold,
+                                           scenarioFilePath=event.get('scenario'),
+                                           outfile=stem + '_gridded_mmi_data_gridded.jpg',
+                                           cache=cache, source=source)
+            if fig is not None:
+                plt.close(fig)
+            outputs.append(outfile)
+
+        if 'interactive' in products:
+            from DYFI_map_int import make_interactive_map
+            # tiles are rendered serially inside a pool worker
+            outputs.append(make_interactive_map(dyfi, event, pop_threshold=pop_threshold,
+                                                output_file=stem + '_interactive_map.html', tile_workers=1,
+                                                cache=cache, source=source, scenarioFilePath=event.get('scenario')))
+
+    except Exception:
+        return event['geojson'], outputs, traceback.format_exc()
+
+    finally:
+        if stats:
+            outputs.append(pipeline_stats.write_report(stem + '_stats.json'))
+            pipeline_stats.reset()
+
+    return event['geojson'], outputs, None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render DYFI maps for a directory or manifest of events.')
+    parser.add_argument('source', help='directory of GeoJSON files with .event.json sidecars, or a JSON manifest')
+    parser.add_argument('--outdir', default='.', help='output directory (default: current directory)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--products', nargs='+', choices=('static', 'interactive'), default=['static', 'interactive'])
+    parser.add_argument('--zoom', type=float, default=1., help='default zoom factor for the static map')
+    parser.add_argument('--pop-threshold', type=int, default=0, help='default minimum population of labelled places')
+    parser.add_argument('--stats', action='store_true', help='write a per-stage timing report for every event')
+    parser.add_argument('--no-cache', action='store_true', help='rebuild every product, ignoring the product cache')
+    args = parser.parse_args(argv)
+
+    if os.path.isdir(args.source):
+        events = find_events(args.source)
+    else:
+        events = load_manifest(args.source)
+
+    if not events:
+        print(f'No events found in {args.source}')
+        return 1
+
+    os.makedirs(args.outdir, exist_ok=True)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(render_event, event, args.outdir, args.products, args.zoom, args.pop_threshold,
+                               args.stats, not args.no_cache)
+                   for event in events]
+        for future in as_completed(futures):
+            geojson, outputs, error = future.result()
+            if error is None:
+                print(f"{geojson}: {', '.join(outputs)}")
+            else:
+                failed += 1
+                print(f'{geojson}: FAILED\n{error}')
+
+    print(f'{len(events) - failed} of {len(events)} events rendered')
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
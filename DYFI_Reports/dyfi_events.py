@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Event metadata for the DYFI map scripts
+
+An event is a dict with the keys of WOODS_POINT below. Batch runs read
+events either from a manifest (a JSON list of event dicts, each with a
+'geojson' path relative to the manifest) or from a directory of GeoJSON
+files with a sidecar <name>.event.json holding each event's metadata. An
+optional 'scenario' grid path is relative to the same file.
+"""
+
+import os
+import json
+from glob import glob
+
+# Woods Point
+WOODS_POINT = {'mag': 5.9,
+               'eqdep': 12.0,
+               'eqla': -37.5063,
+               'eqlo': 146.4022,
+               'degrng': 5.9,
+               'place': 'Woods Point, VIC',
+               'evid': '2021-09-21'}
+
+EVENT_KEYS = ('mag', 'eqdep', 'eqla', 'eqlo', 'place', 'evid')
+
+def check_event(event):
+    # raise if an event is missing metadata the maps need
+    missing = [key for key in EVENT_KEYS if key not in event]
+    if missing:
+        raise ValueError(f"Event {event.get('geojson', event)} is missing {', '.join(missing)}")
+
+    return event
+
+def event_extent(event, zoom_factor=1.):
+    # map extent [lon0, lon1, lat0, lat1] of degrng (default mag) degrees around the epicentre
+    degrng = event.get('degrng', event['mag']) * zoom_factor
+
+    return [event['eqlo'] - degrng, event['eqlo'] + degrng, event['eqla'] - degrng, event['eqla'] + degrng]
+
+def output_stem(event):
+    # file name prefix of an event's products, e.g. 20210921_Woods_Point
+    return '_'.join((event['evid'].replace('-', ''), event['place'].split(',')[0].replace(' ', '_')))
+
+def load_manifest(manifestFilePath):
+    # events listed in a JSON manifest, with geojson and scenario paths made absolute
+    with open(manifestFilePath) as f:
+        events = json.load(f)
+
+    base = os.path.dirname(os.path.abspath(manifestFilePath))
+    for event in events:
+        check_event(event)
+        event['geojson'] = os.path.join(base, event['geojson'])
+        if event.get('scenario') is not None:
+            event['scenario'] = os.path.join(base, event['scenario'])
+
+    return events
+
+def find_events(directory):
+    # events for every GeoJSON file in a directory with a sidecar .event.json
+    events = []
+    for jsonFilePath in sorted(glob(os.path.join(directory, '*.geojson'))):
+        eventFilePath = os.path.splitext(jsonFilePath)[0] + '.event.json'
+        if not os.path.exists(eventFilePath):
+            print(f'Skipping {jsonFilePath}: no event metadata in {eventFilePath}')
+            continue
+
+        with open(eventFilePath) as f:
+            event = check_event(json.load(f))
+        event['geojson'] = jsonFilePath
+        if event.get('scenario') is not None:
+            # relative to the sidecar, like the GeoJSON file
+            event['scenario'] = os.path.join(os.path.dirname(os.path.abspath(eventFilePath)), event['scenario'])
+        events.append(event)
+
+    return events
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming loader for DYFI GeoJSON feature collections
+
+Features are decoded one at a time from a buffered read of the file and
+packed straight into flat arrays, so large national-scale exports never exist
+as a list of per-feature dicts. The result is a struct-of-arrays dict:
+
+    intensity : intensityFine per cell (float)
+    nresp     : number of responses per cell (int)
+    lon, lat  : cell centroid (float)
+    coords    : (nvert, 2) lon/lat of all polygon exterior rings, concatenated
+    offsets   : (ncell + 1) index into coords; cell i is coords[offsets[i]:offsets[i+1]]
+
+dyfi_geojson writes the arrays back out as a compact FeatureCollection for
+web maps.
+"""
+
+import re
+import json
+from array import array
+import numpy as np
+
+FEATURES_START = re.compile(r'"features"\s*:\s*\[')
+
+def iter_features(jsonFilePath, chunk_size=1 << 20):
+    '''
+    Yield the features of a GeoJSON FeatureCollection one at a time without
+    loading the whole collection.
+    '''
+    decoder = json.JSONDecoder()
+
+    with open(jsonFilePath) as f:
+        buf = ''
+        pos = 0
+
+        # find the start of the features array
+        while True:
+            match = FEATURES_START.search(buf)
+            if match:
+                pos = match.end()
+                break
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buf += chunk
+
+        eof = False
+        while True:
+            # skip whitespace and separators between features
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+
+            if pos < len(buf) and buf[pos] == ']':
+                return
+
+            try:
+                if pos >= len(buf):
+                    raise ValueError
+                feature, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # feature is incomplete, so read more
+                if eof:
+                    raise ValueError(f'Truncated GeoJSON file: {jsonFilePath}')
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+
+            yield feature
+            pos = end
+
+def load_dyfi(jsonFilePath):
+    # parse a DYFI GeoJSON file into a struct-of-arrays dict
+    intensity = array('d')
+    nresp = array('q')
+    lon = array('d')
+    lat = array('d')
+    coords = array('d')
+    offsets = array('q', [0])
+
+    for feature in iter_features(jsonFilePath):
+        props = feature['properties']
+        ring = feature['geometry']['coordinates'][0]
+
+        intensity.append(props['intensityFine'])
+        nresp.append(props['nresp'])
+        clon, clat = props['center']['coordinates'][:2]
+        lon.append(clon)
+        lat.append(clat)
+
+        for vert in ring:
+            coords.append(vert[0])
+            coords.append(vert[1])
+        offsets.append(offsets[-1] + len(ring))
+
+    return {'intensity': np.frombuffer(intensity, dtype=float),
+            'nresp': np.frombuffer(nresp, dtype=np.int64),
+            'lon': np.frombuffer(lon, dtype=float),
+            'lat': np.frombuffer(lat, dtype=float),
+            'coords': np.frombuffer(coords, dtype=float).reshape(-1, 2),
+            'offsets': np.frombuffer(offsets, dtype=np.int64)}
+
+def cell_polygon(dyfi, i):
+    # (nvert, 2) lon/lat vertices of cell i
+    return dyfi['coords'][dyfi['offsets'][i]:dyfi['offsets'][i + 1]]
+
+def _ring_neighbours(ring, counts, starts):
+    # previous and next vertex of every vertex of open rings stored back to back
+    k = np.arange(len(ring)) - starts[ring]
+
+    return starts[ring] + (k - 1) % counts[ring], starts[ring] + (k + 1) % counts[ring]
+
+def _keep_vertices(verts, ring, nring, drop):
+    # apply a vertex drop mask, keeping whole rings that would fall below 3 vertices
+    kept = np.bincount(ring[~drop], minlength=nring)
+    drop &= (kept >= 3)[ring]
+
+    return verts[~drop], ring[~drop]
+
+def simplify_rings(coords, offsets, precision=4):
+    '''
+    Quantise closed rings to precision decimal places and drop repeated and
+    collinear vertices. Returns new (coords, offsets) with rings still closed.
+    '''
+    scale = 10.**precision
+    q = np.rint(coords * scale).astype(np.int64)
+    nring = len(offsets) - 1
+    if nring == 0:
+        return coords[:0], offsets[:1]
+
+    # work on open rings (drop the closing vertex)
+    is_last = np.zeros(len(q), dtype=bool)
+    is_last[offsets[1:] - 1] = True
+    verts = q[~is_last]
+    ring = np.repeat(np.arange(nring), np.diff(offsets) - 1)
+
+    # repeated vertices
+    counts = np.bincount(ring, minlength=nring)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    prev, _ = _ring_neighbours(ring, counts, starts)
+    verts, ring = _keep_vertices(verts, ring, nring, (verts == verts[prev]).all(axis=1))
+
+    # collinear vertices
+    counts = np.bincount(ring, minlength=nring)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    prev, nxt = _ring_neighbours(ring, counts, starts)
+    a = verts - verts[prev]
+    b = verts[nxt] - verts
+    verts, ring = _keep_vertices(verts, ring, nring, a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0] == 0)
+
+    # close the rings again
+    counts = np.bincount(ring, minlength=nring)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    new_offsets = np.concatenate(([0], np.cumsum(counts + 1)))
+    out = np.empty((len(verts) + nring, 2), dtype=np.int64)
+    pos = np.arange(len(verts)) + ring
+    out[pos] = verts
+    out[new_offsets[1:] - 1] = verts[starts]
+
+    return out / scale, new_offsets
+
+def cell_properties(dyfi, idx):
+    # GeoJSON properties (intensity class, intensity and nresp) of cells idx
+    mmi = np.clip(np.rint(dyfi['intensity'][idx]), 1, 10).astype(int).tolist()
+    intensity = np.round(dyfi['intensity'][idx], 1).tolist()
+    nresp = dyfi['nresp'][idx].tolist()
+
+    return [{'mmi': m, 'intensity': x, 'nresp': n} for m, x, n in zip(mmi, intensity, nresp)]
+
+def dyfi_geojson(dyfi, min_resp=0, precision=4, simplify=False):
+    '''
+    FeatureCollection dict of cells with nresp > min_resp, with coordinates
+    rounded to precision decimal places (4 is ~10 m) and, if simplify,
+    repeated and collinear vertices removed. Each feature carries an integer
+    id and the properties mmi (intensity class 1-10), intensity and nresp.
+    '''
+    idx = np.where(dyfi['nresp'] > min_resp)[0]
+    starts = dyfi['offsets'][idx]
+    stops = dyfi['offsets'][idx + 1]
+
+    # gather the selected rings into one buffer
+    nvert = stops - starts
+    offsets = np.concatenate(([0], np.cumsum(nvert)))
+    vert = np.repeat(starts - offsets[:-1], nvert) + np.arange(offsets[-1])
+    coords = dyfi['coords'][vert]
+
+    if simplify:
+        coords, offsets = simplify_rings(coords, offsets, precision)
+    else:
+        coords = np.round(coords, precision)
+
+    properties = cell_properties(dyfi, idx)
+    coords = coords.tolist()
+    offsets = offsets.tolist()
+
+    features = []
+    for i in range(len(idx)):
+        features.append({'type': 'Feature', 'id': i,
+                         'geometry': {'type': 'Polygon', 'coordinates': [coords[offsets[i]:offsets[i + 1]]]},
+                         'properties': properties[i]})
+
+    return {'type': 'FeatureCollection', 'features': features}
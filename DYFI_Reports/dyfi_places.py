@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Cached, spatially indexed Natural Earth populated places
+
+The 10m populated_places shapefile is converted once into a compact .npz of
+name, lon, lat and population, sorted by a 1-degree grid cell with the start
+offset of every cell stored alongside. An extent + population query then only
+touches the rows of cells inside the extent instead of scanning every record.
+"""
+
+import os
+import numpy as np
+
+CELL_DEG = 1.
+NCOLS = int(360 / CELL_DEG)
+NROWS = int(180 / CELL_DEG)
+
+# places loaded in this process, keyed by cache file
+_loaded = {}
+
+def cell_index(lon, lat):
+    # column and row of the index cell holding each point
+    col = np.clip(np.floor((np.asarray(lon) + 180.) / CELL_DEG).astype(int), 0, NCOLS - 1)
+    row = np.clip(np.floor((np.asarray(lat) + 90.) / CELL_DEG).astype(int), 0, NROWS - 1)
+
+    return col, row
+
+def build_places_cache(shpfilename, cachefile):
+    # convert the shapefile to the columnar, cell-sorted cache
+    from cartopy.io import shapereader
+
+    names = []
+    lons = []
+    lats = []
+    pops = []
+    for record in shapereader.Reader(shpfilename).records():
+        names.append(record.attributes['NAME'])
+        lons.append(record.geometry.x)
+        lats.append(record.geometry.y)
+        pops.append(record.attributes['POP_MAX'])
+
+    lon = np.array(lons, dtype=float)
+    lat = np.array(lats, dtype=float)
+    pop = np.array(pops, dtype=np.int64)
+
+    # sort by cell, then by descending population within each cell
+    col, row = cell_index(lon, lat)
+    key = row * NCOLS + col
+    order = np.lexsort((-pop, key))
+    cell_start = np.searchsorted(key[order], np.arange(NROWS * NCOLS + 1))
+
+    # write through a temporary file so concurrent readers never see a partial cache
+    tmpfile = f'{cachefile}.{os.getpid()}.tmp'
+    with open(tmpfile, 'wb') as f:
+        np.savez(f, name=np.array(names, dtype=str)[order], lon=lon[order], lat=lat[order],
+                 pop=pop[order], cell_start=cell_start)
+    os.replace(tmpfile, cachefile)
+
+def load_places(shpfilename=None, cachefile=None):
+    '''
+    Return the populated places as a dict of arrays, building the cache next
+    to the shapefile on first use or when the shapefile is newer.
+    '''
+    if shpfilename is None:
+        from cartopy.io import shapereader
+        shpfilename = shapereader.natural_earth(resolution='10m', category='cultural', name='populated_places')
+
+    if cachefile is None:
+        cachefile = os.path.splitext(shpfilename)[0] + '_places.npz'
+
+    if cachefile in _loaded:
+        return _loaded[cachefile]
+
+    if not os.path.exists(cachefile) or os.path.getmtime(cachefile) < os.path.getmtime(shpfilename):
+        build_places_cache(shpfilename, cachefile)
+
+    with np.load(cachefile) as npz:
+        places = {key: npz[key] for key in npz.files}
+
+    _loaded[cachefile] = places
+
+    return places
+
+def query_places(places, extent=None, pop_threshold=0):
+    '''
+    Places with POP_MAX > pop_threshold inside extent [lon0, lon1, lat0, lat1]
+    (or anywhere if extent is None), as a dict of arrays ordered by descending
+    population.
+    '''
+    if extent is None:
+        idx = np.arange(len(places['pop']))
+    else:
+        col0, row0 = cell_index(extent[0], extent[2])
+        col1, row1 = cell_index(extent[1], extent[3])
+
+        # each grid row of the extent is one contiguous slice of the cache
+        rows = np.arange(row0, row1 + 1)
+        starts = places['cell_start'][rows * NCOLS + col0]
+        stops = places['cell_start'][rows * NCOLS + col1 + 1]
+        idx = np.concatenate([np.arange(a, b) for a, b in zip(starts, stops)])
+
+        lon = places['lon'][idx]
+        lat = places['lat'][idx]
+        inside = (extent[0] <= lon) & (lon <= extent[1]) & (extent[2] <= lat) & (lat <= extent[3])
+        idx = idx[inside]
+
+    idx = idx[places['pop'][idx] > pop_threshold]
+    idx = idx[np.argsort(-places['pop'][idx], kind='stable')]
+
+    return {key: places[key][idx] for key in ('name', 'lon', 'lat', 'pop')}
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Batched drawing of DYFI cells on a map axes
+
+All cells are drawn as one artist with colours looked up from the intensity
+array. Cells that are axis-aligned rectangles on a single lon/lat lattice are
+drawn as one raster mesh; anything else is drawn as one PolyCollection.
+"""
+
+import numpy as np
+from matplotlib.colors import ListedColormap, to_rgba
+from matplotlib.collections import PolyCollection
+
+# DYFI intensity colour table (0-255 RGB)
+MMI_RGB = [
+    (255, 255, 255),  # Intensity 1
+    (239, 242, 255),  # Intensity 2
+    (176, 217, 255),  # Intensity 3
+    (136, 249, 255),  # Intensity 4
+    (122, 255, 147),  # Intensity 5
+    (255, 241, 0),    # Intensity 6
+    (255, 172, 0),    # Intensity 7
+    (255, 36, 0),     # Intensity 8
+    (200, 0, 0),      # Intensity 9
+    (164, 0, 0)       # Intensity 10
+]
+
+def intensity_index(intensity, ncolours=10):
+    # colour table index for each cell (intensity 1 -> 0)
+    return np.clip(np.rint(intensity).astype(int) - 1, 0, ncolours - 1)
+
+def cell_bounds(dyfi):
+    # lon/lat bounding box of every cell
+    starts = dyfi['offsets'][:-1]
+    x = dyfi['coords'][:, 0]
+    y = dyfi['coords'][:, 1]
+
+    return np.minimum.reduceat(x, starts), np.maximum.reduceat(x, starts), \
+           np.minimum.reduceat(y, starts), np.maximum.reduceat(y, starts)
+
+def regular_grid(dyfi, idx, rtol=1e-6, max_fill=25.):
+    '''
+    Return (lon_edges, lat_edges, col, row) if cells idx are axis-aligned
+    rectangles of one size on a common lattice, otherwise None. max_fill caps
+    the ratio of mesh size to cell count so sparse lattices are not meshed.
+    '''
+    if len(idx) == 0:
+        return None
+
+    bounds = cell_bounds(dyfi)
+    xmin, xmax, ymin, ymax = [b[idx] for b in bounds]
+    dx = xmax[0] - xmin[0]
+    dy = ymax[0] - ymin[0]
+    if dx <= 0 or dy <= 0:
+        return None
+
+    tol = rtol * max(abs(dx), abs(dy), 1.)
+    if np.ptp(xmax - xmin) > tol or np.ptp(ymax - ymin) > tol:
+        return None
+
+    # every vertex must be a corner of its cell's bounding box
+    nvert = np.diff(dyfi['offsets'])
+    vert_cell = np.repeat(np.arange(len(nvert)), nvert)
+    sel = np.zeros(len(nvert), dtype=bool)
+    sel[idx] = True
+    vsel = sel[vert_cell]
+    vx = dyfi['coords'][vsel, 0]
+    vy = dyfi['coords'][vsel, 1]
+    vxmin, vxmax, vymin, vymax = [b[vert_cell[vsel]] for b in bounds]
+    on_x = (np.abs(vx - vxmin) <= tol) | (np.abs(vx - vxmax) <= tol)
+    on_y = (np.abs(vy - vymin) <= tol) | (np.abs(vy - vymax) <= tol)
+    if not (on_x.all() and on_y.all()):
+        return None
+
+    # cells must sit on a common lattice
+    x0 = xmin.min()
+    y0 = ymin.min()
+    colf = (xmin - x0) / dx
+    rowf = (ymin - y0) / dy
+    col = np.rint(colf).astype(int)
+    row = np.rint(rowf).astype(int)
+    if np.abs(colf - col).max() > 1e-3 or np.abs(rowf - row).max() > 1e-3:
+        return None
+
+    ncol = col.max() + 1
+    nrow = row.max() + 1
+    if ncol * nrow > max_fill * len(idx):
+        return None
+
+    return x0 + dx * np.arange(ncol + 1), y0 + dy * np.arange(nrow + 1), col, row
+
+def plot_dyfi_cells(ax, dyfi, colors, min_resp=0, transform=None, zorder=100,
+                    edgecolor='0.45', linewidth=0.25):
+    '''
+    Draw all cells with nresp > min_resp as a single artist, returning it.
+    colors is the intensity colour table (intensity 1 first). The artist's
+    dyfi_cells and dyfi_slots attributes hold the drawn cell indices and
+    their positions in the artist, for update_dyfi_cells.
+    '''
+    idx = np.where(dyfi['nresp'] > min_resp)[0]
+    cidx = intensity_index(dyfi['intensity'][idx], len(colors))
+    kwargs = {} if transform is None else {'transform': transform}
+
+    grid = regular_grid(dyfi, idx)
+    if grid is not None:
+        lon_edges, lat_edges, col, row = grid
+        img = np.ma.masked_all((len(lat_edges) - 1, len(lon_edges) - 1))
+        img[row, col] = cidx
+
+        # only outline occupied cells
+        edges = np.zeros(img.shape + (4,))
+        edges[row, col] = to_rgba(edgecolor)
+
+        mesh = ax.pcolormesh(lon_edges, lat_edges, img, cmap=ListedColormap(colors), vmin=-0.5,
+                             vmax=len(colors) - 0.5, edgecolors=edges.reshape(-1, 4), linewidth=linewidth,
+                             zorder=zorder, **kwargs)
+        mesh.dyfi_cells = idx
+        mesh.dyfi_slots = row * (len(lon_edges) - 1) + col
+
+        return mesh
+
+    # cells with a common vertex count go in as one (ncell, nvert, 2) array;
+    # GeoJSON rings are already closed
+    nvert = np.diff(dyfi['offsets'])
+    if len(nvert) == 0:
+        # no cells in the file: an empty collection
+        verts = []
+    elif (nvert == nvert[0]).all():
+        verts = dyfi['coords'].reshape(len(nvert), nvert[0], 2)[idx]
+    else:
+        verts = np.split(dyfi['coords'], dyfi['offsets'][1:-1])
+        verts = [verts[i] for i in idx]
+
+    # skip the per-path reprojection when the data are already in map coordinates
+    if transform is not None and getattr(ax, 'projection', None) == transform:
+        kwargs['transform'] = ax.transData
+
+    coll = PolyCollection(verts, closed=isinstance(verts, np.ndarray), facecolors=np.asarray(colors)[cidx],
+                          edgecolors=edgecolor, linewidths=linewidth, zorder=zorder, **kwargs)
+    ax.add_collection(coll, autolim=False)
+    coll.dyfi_cells = idx
+    coll.dyfi_slots = np.arange(len(idx))
+
+    return coll
+
+def update_dyfi_cells(artist, slots, intensity, colors):
+    '''
+    Recolour drawn cells in place from their new intensities. slots are the
+    cells' positions in the artist (from its dyfi_slots attribute).
+    '''
+    cidx = intensity_index(np.asarray(intensity), len(colors))
+
+    if hasattr(artist, 'get_array') and artist.get_array() is not None:
+        # raster mesh: colour table indices in the flattened masked image
+        img = artist.get_array()
+        img[np.unravel_index(slots, img.shape)] = cidx
+        artist.set_array(img)
+    else:
+        facecolors = artist.get_facecolors()
+        facecolors[slots] = np.array([to_rgba(c) for c in colors])[cidx]
+        artist.set_facecolors(facecolors)
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+XYZ (slippy map) PNG tile pyramids for DYFI cells and scenario grids
+
+Cells are binned to the Web Mercator tiles they touch at each zoom level and
+every tile is rasterised independently, so tiles are rendered in parallel
+across a process pool. A manifest of per-tile input hashes is kept in the
+tile directory and only tiles whose inputs changed are redrawn.
+"""
+
+import os
+import sys
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'MMI_Attenuation'))
+from dyfi_render import MMI_RGB
+
+TILE_SIZE = 256
+
+def mercator(lon, lat):
+    # lon/lat to Web Mercator world coordinates in [0, 1], y down from the north
+    lat = np.clip(lat, -85.0511, 85.0511)
+    x = (np.asarray(lon) + 180.) / 360.
+    y = (1. - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2.
+
+    return x, y
+
+def tile_bounds(z, x, y):
+    # lon/lat bounds [lon0, lon1, lat0, lat1] of a tile
+    n = 2.**z
+    lon0 = x / n * 360. - 180.
+    lon1 = (x + 1) / n * 360. - 180.
+    lat1 = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+    lat0 = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 1) / n))))
+
+    return [lon0, lon1, lat0, lat1]
+
+def tile_path(outdir, z, x, y):
+    return os.path.join(outdir, str(z), str(x), str(y) + '.png')
+
+def _cell_tiles(xmin, xmax, ymin, ymax, z):
+    # every (cell, tile x, tile y) pair where a cell bounding box touches a tile
+    n = 2**z
+    tx0 = np.clip(np.floor(xmin * n).astype(np.int64), 0, n - 1)
+    tx1 = np.clip(np.floor(xmax * n).astype(np.int64), 0, n - 1)
+    ty0 = np.clip(np.floor(ymin * n).astype(np.int64), 0, n - 1)
+    ty1 = np.clip(np.floor(ymax * n).astype(np.int64), 0, n - 1)
+
+    nx = tx1 - tx0 + 1
+    ny = ty1 - ty0 + 1
+    count = nx * ny
+    cell = np.repeat(np.arange(len(xmin)), count)
+    k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+
+    return cell, tx0[cell] + k % nx[cell], ty0[cell] + k // nx[cell]
+
+def _render_cells(job):
+    # worker: rasterise the cells of one tile
+    z, x, y, coords, offsets, rgba, outline, path = job
+    n = 2**z
+
+    # world to tile pixel coordinates
+    px = (coords[:, 0] * n - x) * TILE_SIZE
+    py = (coords[:, 1] * n - y) * TILE_SIZE
+
+    img = Image.new('RGBA', (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    for i in range(len(offsets) - 1):
+        pts = list(zip(px[offsets[i]:offsets[i + 1]].tolist(), py[offsets[i]:offsets[i + 1]].tolist()))
+        draw.polygon(pts, fill=tuple(rgba[i]), outline=outline)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    img.save(path, optimize=True)
+
+    return path
+
+def _render_grid(job):
+    # worker: sample a memory-mapped scenario grid at the tile pixel centres
+    from mmi_grid import load_scenario_grid
+
+    z, x, y, gridfile, lut, path = job
+    grid, header = load_scenario_grid(gridfile)
+    lon0, lon1, lat0, lat1 = header['extent']
+    nrows, ncols = grid.shape
+
+    n = 2**z
+    p = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    lon = (x + p) / n * 360. - 180.
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + p) / n))))
+    col = np.floor((lon - lon0) / (lon1 - lon0) * ncols).astype(int)
+    row = np.floor((lat1 - lat) / (lat1 - lat0) * nrows).astype(int)
+
+    inside = ((row >= 0) & (row < nrows))[:, None] & ((col >= 0) & (col < ncols))[None, :]
+    vals = np.asarray(grid[np.clip(row, 0, nrows - 1)][:, np.clip(col, 0, ncols - 1)])
+    cidx = np.clip(np.rint(vals).astype(int) - 1, 0, len(lut) - 1)
+
+    rgba = np.asarray(lut, dtype=np.uint8)[cidx]
+    rgba[~inside | np.isnan(vals)] = 0
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.fromarray(rgba, 'RGBA').save(path, optimize=True)
+
+    return path
+
+def _load_manifest(outdir):
+    manifest_file = os.path.join(outdir, 'manifest.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            return json.load(f)
+
+    return {}
+
+def _save_manifest(outdir, manifest):
+    os.makedirs(outdir, exist_ok=True)
+    with open(os.path.join(outdir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+def _run_jobs(func, jobs, workers):
+    # render jobs serially or across a process pool
+    if workers == 1 or len(jobs) < 2:
+        return [func(job) for job in jobs]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, jobs, chunksize=max(1, len(jobs) // (4 * (workers or os.cpu_count())))))
+
+def _prune(outdir, manifest, zooms, current):
+    # remove tiles at these zooms that no longer have any input
+    for key in list(manifest):
+        z, x, y = map(int, key.split('/'))
+        if z in zooms and key not in current:
+            path = tile_path(outdir, z, x, y)
+            if os.path.exists(path):
+                os.remove(path)
+            del manifest[key]
+
+def dyfi_tiles(dyfi, outdir, zooms=range(4, 12), min_resp=0, colors=MMI_RGB, alpha=153, workers=None):
+    '''
+    Render cells with nresp > min_resp into outdir/{z}/{x}/{y}.png for each
+    zoom level, redrawing only tiles whose cells changed since the last run.
+    Returns the list of tiles written.
+    '''
+    idx = np.where(dyfi['nresp'] > min_resp)[0]
+    starts = dyfi['offsets'][idx]
+    nvert = dyfi['offsets'][idx + 1] - starts
+
+    # world coordinates of the selected rings
+    offsets = np.concatenate(([0], np.cumsum(nvert)))
+    vert = np.repeat(starts - offsets[:-1], nvert) + np.arange(offsets[-1])
+    mx, my = mercator(dyfi['coords'][vert, 0], dyfi['coords'][vert, 1])
+    world = np.column_stack((mx, my))
+
+    xmin = np.minimum.reduceat(mx, offsets[:-1]) if len(idx) else mx
+    xmax = np.maximum.reduceat(mx, offsets[:-1]) if len(idx) else mx
+    ymin = np.minimum.reduceat(my, offsets[:-1]) if len(idx) else my
+    ymax = np.maximum.reduceat(my, offsets[:-1]) if len(idx) else my
+
+    lut = np.array([c + (alpha,) for c in colors], dtype=np.uint8)
+    cidx = np.clip(np.rint(dyfi['intensity'][idx]).astype(int) - 1, 0, len(colors) - 1)
+    rgba = lut[cidx]
+
+    manifest = _load_manifest(outdir)
+    current = set()
+    jobs = []
+    for z in zooms:
+        cell, tx, ty = _cell_tiles(xmin, xmax, ymin, ymax, z)
+        order = np.lexsort((cell, ty, tx))
+        cell, tx, ty = cell[order], tx[order], ty[order]
+        bounds = np.flatnonzero(np.diff(tx) | np.diff(ty)) + 1
+
+        # outline cells only once they are a few pixels across
+        cell_px = np.median(xmax - xmin) * 2**z * TILE_SIZE if len(idx) else 0.
+        outline = (115, 115, 115, 255) if cell_px > 6 else None
+
+        for group in np.split(np.arange(len(cell)), bounds):
+            if len(group) == 0:
+                continue
+            cells = cell[group]
+            x, y = int(tx[group[0]]), int(ty[group[0]])
+
+            # gather the rings of the cells in this tile
+            n = nvert[cells]
+            toffs = np.concatenate(([0], np.cumsum(n)))
+            tvert = np.repeat(offsets[cells] - toffs[:-1], n) + np.arange(toffs[-1])
+            tcoords = world[tvert]
+
+            digest = hashlib.sha1(tcoords.tobytes() + rgba[cells].tobytes() + repr(outline).encode()).hexdigest()
+            key = f'{z}/{x}/{y}'
+            current.add(key)
+            path = tile_path(outdir, z, x, y)
+            if manifest.get(key) == digest and os.path.exists(path):
+                continue
+
+            manifest[key] = digest
+            jobs.append((z, x, y, tcoords, toffs, rgba[cells], outline, path))
+
+    _prune(outdir, manifest, set(zooms), current)
+    written = _run_jobs(_render_cells, jobs, workers)
+    _save_manifest(outdir, manifest)
+
+    return written
+
+def scenario_tiles(gridfile, outdir, zooms=range(4, 10), colors=MMI_RGB, alpha=128, workers=None):
+    '''
+    Render a scenario grid written by mmi_grid.scenario_grid into a tile
+    pyramid, redrawing only tiles whose part of the grid changed.
+    '''
+    from mmi_grid import load_scenario_grid
+
+    grid, header = load_scenario_grid(gridfile)
+    lon0, lon1, lat0, lat1 = header['extent']
+    nrows, ncols = grid.shape
+    lut = [c + (alpha,) for c in colors]
+
+    manifest = _load_manifest(outdir)
+    current = set()
+    jobs = []
+    for z in zooms:
+        n = 2**z
+        (x0, x1), (y1, y0) = [np.clip(np.floor(np.asarray(v) * n).astype(int), 0, n - 1)
+                              for v in mercator([lon0, lon1], [lat0, lat1])]
+
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                # grid window under this tile
+                b = tile_bounds(z, x, y)
+                c0 = int(np.clip(np.floor((b[0] - lon0) / (lon1 - lon0) * ncols), 0, ncols))
+                c1 = int(np.clip(np.ceil((b[1] - lon0) / (lon1 - lon0) * ncols), 0, ncols))
+                r0 = int(np.clip(np.floor((lat1 - b[3]) / (lat1 - lat0) * nrows), 0, nrows))
+                r1 = int(np.clip(np.ceil((lat1 - b[2]) / (lat1 - lat0) * nrows), 0, nrows))
+
+                window = np.ascontiguousarray(grid[r0:r1, c0:c1]).tobytes()
+                digest = hashlib.sha1(window + json.dumps([header['extent'], lut]).encode()).hexdigest()
+                key = f'{z}/{x}/{y}'
+                current.add(key)
+                path = tile_path(outdir, z, x, y)
+                if manifest.get(key) == digest and os.path.exists(path):
+                    continue
+
+                manifest[key] = digest
+                jobs.append((z, x, y, gridfile, lut, path))
+
+    _prune(outdir, manifest, set(zooms), current)
+    written = _run_jobs(_render_grid, jobs, workers)
+    _save_manifest(outdir, manifest)
+
+    return written
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Live update of the DYFI maps of an event as new responses arrive
+
+Polls a DYFI GeoJSON file and, each time it changes, diffs the new cells
+against the previous load. Cells are matched by their rounded centroid, so
+a cell keeps its identity when the file is reordered. Only what changed is
+redrawn:
+
+    static map       the figure stays open; changed cells are recoloured in
+                     place (update_dyfi_cells) and the response count
+                     retitled, then the figure is saved again. The cells
+                     artist is rebuilt only when cells appear or disappear.
+    interactive map  written once with the cells in a separate GeoJSON file;
+                     later updates patch the properties of changed cells and
+                     rewrite only that file. Maps drawn from tiles redraw
+                     only the tiles whose cells changed.
+
+Usage:
+
+    python dyfi_watch.py felt_reports.geojson --interval 2
+    python dyfi_watch.py felt_reports.geojson --event event.json --products static
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+import matplotlib
+matplotlib.use('Agg')
+
+from dyfi_io import load_dyfi, dyfi_geojson, cell_properties
+from dyfi_render import plot_dyfi_cells, update_dyfi_cells
+from dyfi_events import WOODS_POINT, check_event, output_stem
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'MMI_Attenuation'))
+from pipeline_stats import stage, enable_from_argv
+
+def cell_keys(dyfi, precision=5):
+    # integer key of every cell from its centroid rounded to precision decimal places
+    scale = 10**precision
+    ilon = np.rint(dyfi['lon'] * scale).astype(np.int64) + 180 * scale
+    ilat = np.rint(dyfi['lat'] * scale).astype(np.int64) + 90 * scale
+
+    return ilon * (180 * scale + 1) + ilat
+
+def diff_cells(old, new):
+    '''
+    Compare two loads of a DYFI file by cell key. Returns a dict with the
+    new-file indices of added and changed (intensity or nresp) cells, the
+    old-file indices of removed cells, and old_index, the old index of every
+    new cell (-1 if added).
+    '''
+    okeys, nkeys = cell_keys(old), cell_keys(new)
+    old_index = np.full(len(nkeys), -1, dtype=np.int64)
+    if len(okeys):
+        order = np.argsort(okeys)
+        pos = np.minimum(np.searchsorted(okeys[order], nkeys), len(okeys) - 1)
+        old_index = np.where(okeys[order[pos]] == nkeys, order[pos], -1)
+
+    matched = old_index >= 0
+    changed = np.zeros(len(nkeys), dtype=bool)
+    changed[matched] = (old['intensity'][old_index[matched]] != new['intensity'][matched]) \
+                       | (old['nresp'][old_index[matched]] != new['nresp'][matched])
+
+    found = np.zeros(len(okeys), dtype=bool)
+    found[old_index[matched]] = True
+
+    return {'added': np.where(~matched)[0], 'changed': np.where(changed)[0],
+            'removed': np.where(~found)[0], 'old_index': old_index}
+
+def match_drawn(drawn_old, old_index, drawn):
+    '''
+    Position in drawn_old (old-file indices of previously drawn cells) of
+    each cell in drawn (new-file indices), or None if the set of drawn
+    cells changed. Either set may be empty.
+    '''
+    if len(drawn) != len(drawn_old):
+        return None
+    if len(drawn) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    pos = np.full(max(drawn_old.max(initial=-1), old_index.max(initial=-1)) + 1, -1, dtype=np.int64)
+    pos[drawn_old] = np.arange(len(drawn_old))
+    old = old_index[drawn]
+    match = np.where(old >= 0, pos[np.maximum(old, 0)], -1)
+
+    return match if np.all(match >= 0) else None
+
+def update_static(state, dyfi, diff):
+    '''
+    Bring the open static map in state up to date with dyfi and save it.
+    Drawn cells are recoloured in place unless the set of drawn cells changed,
+    and places are labelled again if the response count box changed size.
+    Returns the number of cells recoloured, or -1 if the artist was rebuilt.
+    '''
+    from DYFI_MAP import label_obstacles, label_places
+
+    art = state['artists']
+    cells = art['cells']
+    drawn = np.where(dyfi['nresp'] > art['min_resp'])[0]
+    match = match_drawn(cells.dyfi_cells, diff['old_index'], drawn)
+
+    if match is not None:
+        with stage('recolour cells') as s:
+            slots = cells.dyfi_slots[match]
+            recolour = np.isin(drawn, diff['changed'])
+            if recolour.any():
+                update_dyfi_cells(cells, slots[recolour], dyfi['intensity'][drawn[recolour]], art['colors'])
+            cells.dyfi_cells, cells.dyfi_slots = drawn, slots
+            s.count(cells=int(recolour.sum()))
+        nupdated = int(recolour.sum())
+    else:
+        with stage('cells', cells=len(drawn)):
+            zorder = cells.get_zorder()
+            cells.remove()
+            art['cells'] = plot_dyfi_cells(art['ax'], dyfi, art['colors'], min_resp=art['min_resp'],
+                                           transform=art['transform'], zorder=zorder)
+        nupdated = -1
+
+    text = art['nresp_text']
+    old_text = text.get_text()
+    text.set_text('Number of Responses = ' + str(dyfi['nresp'].sum()))
+    if len(text.get_text()) != len(old_text):
+        # the box changed size: place the labels again around it
+        with stage('labels') as s:
+            for label in art['labels']:
+                label.remove()
+            art['labels'] = label_places(art['ax'], art['places'], *art['epicentre'],
+                                         label_obstacles(text, art['scalebar']))
+            s.count(labelled=len(art['labels']))
+
+    with stage('savefig', dpi=art['dpi']):
+        state['fig'].savefig(state['outfile'], format='jpg', bbox_inches='tight', dpi=art['dpi'])
+
+    return nupdated
+
+def _encode(features):
+    return [json.dumps(feature, separators=(',', ':')) for feature in features]
+
+def _write_features(encoded, path):
+    # FeatureCollection from encoded features, written through a temporary
+    # file so the browser never reads a partial file
+    tmpfile = f'{path}.{os.getpid()}.tmp'
+    with open(tmpfile, 'w') as f:
+        f.write('{"type":"FeatureCollection","features":[')
+        f.write(','.join(encoded))
+        f.write(']}')
+    os.replace(tmpfile, path)
+
+def update_interactive(state, dyfi, diff=None, pop_threshold=0, max_vector_cells=50000):
+    '''
+    Bring the interactive map up to date with dyfi: rewrite the external
+    cells file, or the changed tiles, and rebuild the HTML only on the first
+    call or when the map switches between vector cells and tiles. While the
+    set of cells is unchanged, only the features of changed cells are
+    re-encoded.
+    '''
+    from DYFI_map_int import make_interactive_map
+    from dyfi_tiles import dyfi_tiles
+
+    output_file = state['html']
+    cells_file = output_file.replace('.html', '_cells.geojson')
+    drawn = np.where(dyfi['nresp'] > 0)[0]
+    use_tiles = np.count_nonzero(dyfi['nresp'] > 0) > max_vector_cells
+
+    if state.get('use_tiles') != use_tiles:
+        make_interactive_map(dyfi, state['event'], pop_threshold=pop_threshold, output_file=output_file,
+                             external_cells=True, max_vector_cells=max_vector_cells)
+        state['use_tiles'] = use_tiles
+        if not use_tiles:
+            with open(cells_file) as f:
+                state['features'] = json.load(f)['features']
+            state['encoded'] = _encode(state['features'])
+            state['feature_cells'] = drawn
+    elif use_tiles:
+        with stage('tiles', cells=int(np.count_nonzero(dyfi['nresp'] > 0))):
+            dyfi_tiles(dyfi, output_file.replace('.html', '_tiles'), zooms=range(4, 12), min_resp=0)
+    else:
+        with stage('geojson cells') as s:
+            # feature i of the cells file is cell feature_cells[i]
+            match = None if diff is None else match_drawn(state['feature_cells'], diff['old_index'], drawn)
+            if match is None:
+                state['features'] = dyfi_geojson(dyfi, min_resp=0, precision=4, simplify=True)['features']
+                state['encoded'] = _encode(state['features'])
+                state['feature_cells'] = drawn
+                s.count(cells=len(drawn))
+            else:
+                features, encoded = state['features'], state['encoded']
+                changed = np.isin(drawn, diff['changed'])
+                for i, props in zip(match[changed].tolist(), cell_properties(dyfi, drawn[changed])):
+                    features[i]['properties'] = props
+                    encoded[i] = json.dumps(features[i], separators=(',', ':'))
+                state['feature_cells'] = np.empty_like(drawn)
+                state['feature_cells'][match] = drawn
+                s.count(cells=int(changed.sum()))
+            _write_features(state['encoded'], cells_file)
+
+    return output_file
+
+def _file_state(path):
+    st = os.stat(path)
+
+    return st.st_mtime_ns, st.st_size
+
+def watch(jsonFilePath, event, outdir='.', products=('static', 'interactive'), interval=2., pop_threshold=0,
+          zoom_factor=1., max_updates=None):
+    '''
+    Render the maps of jsonFilePath, then poll it every interval seconds and
+    update them incrementally whenever it changes. A change is only read once
+    the file has stopped growing for one poll; a file that fails to load (e.g.
+    mid-write) is retried at the next poll. Stops after max_updates updates,
+    if given, or on Ctrl-C.
+    '''
+    import matplotlib.pyplot as plt
+    from DYFI_MAP import make_static_map
+
+    stem = os.path.join(outdir, output_stem(event))
+    state = {'event': event, 'outfile': stem + '_gridded_mmi_data_gridded.jpg',
+             'html': stem + '_interactive_map.html'}
+
+    t0 = time.perf_counter()
+    state['dyfi'] = dyfi = load_dyfi(jsonFilePath)
+    if 'static' in products:
+        state['artists'] = {}
+        state['fig'], _ = make_static_map(dyfi, event, zoom_factor=zoom_factor, pop_threshold=pop_threshold,
+                                          outfile=state['outfile'], artists=state['artists'])
+    if 'interactive' in products:
+        update_interactive(state, dyfi, pop_threshold=pop_threshold)
+    print(f"{len(dyfi['lon'])} cells rendered in {time.perf_counter() - t0:.1f} s")
+
+    seen = pending = _file_state(jsonFilePath)
+    nupdate = 0
+    try:
+        while max_updates is None or nupdate < max_updates:
+            time.sleep(interval)
+            try:
+                current = _file_state(jsonFilePath)
+            except OSError:
+                continue
+            if current == seen:
+                continue
+            if current != pending:
+                # still being written
+                pending = current
+                continue
+
+            t0 = time.perf_counter()
+            try:
+                with stage('load dyfi'):
+                    new = load_dyfi(jsonFilePath)
+            except ValueError:
+                continue
+            seen = current
+
+            diff = diff_cells(state['dyfi'], new)
+            if not (len(diff['added']) or len(diff['changed']) or len(diff['removed'])):
+                continue
+
+            nupdated = update_static(state, new, diff) if 'static' in products else 0
+            if 'interactive' in products:
+                update_interactive(state, new, diff, pop_threshold)
+            state['dyfi'] = new
+            nupdate += 1
+
+            redraw = 'cells redrawn' if nupdated < 0 else f'{nupdated} cells recoloured'
+            print(f"{time.strftime('%H:%M:%S')}: {len(diff['added'])} added, {len(diff['changed'])} changed, "
+                  f"{len(diff['removed'])} removed; {redraw}; {new['nresp'].sum()} responses; "
+                  f"updated in {time.perf_counter() - t0:.2f} s")
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        if 'fig' in state:
+            plt.close(state['fig'])
+
+    return state
+
+####################################################################################
+# Watch a DYFI GeoJSON file (default event Woods Point)
+
+if __name__ == '__main__':
+    # Per-stage timings with --stats or PIPELINE_STATS=1
+    enable_from_argv()
+
+    parser = argparse.ArgumentParser(description='Update DYFI maps as new responses arrive in a GeoJSON file.')
+    parser.add_argument('geojson', help='DYFI GeoJSON file to watch')
+    parser.add_argument('--event', default=None, help='event JSON file (default: Woods Point)')
+    parser.add_argument('--outdir', default='.', help='output directory (default: current directory)')
+    parser.add_argument('--products', nargs='+', choices=('static', 'interactive'), default=['static', 'interactive'])
+    parser.add_argument('--interval', type=float, default=2., help='seconds between polls of the file')
+    parser.add_argument('--zoom', type=float, default=1., help='zoom factor for the static map')
+    parser.add_argument('--pop-threshold', type=int, default=0, help='minimum population of labelled places')
+    args = parser.parse_args()
+
+    if args.event is None:
+        event = WOODS_POINT
+    else:
+        with open(args.event) as f:
+            event = check_event(json.load(f))
+
+    os.makedirs(args.outdir, exist_ok=True)
+    watch(args.geojson, event, args.outdir, args.products, args.interval, args.pop_threshold, args.zoom)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Greedy, bounded-time placement of map labels
+
+Labels are taken in priority order (e.g. descending population) and each is
+tried at a fixed list of candidate positions around its point. Placed label
+boxes, point markers and avoided symbols are kept in a uniform grid over
+display space, so each candidate is only checked against nearby boxes.
+Labels with no free candidate are dropped. Run time grows linearly with the
+number of labels, unlike iterative repulsion.
+"""
+
+import numpy as np
+from matplotlib.font_manager import FontProperties
+from matplotlib.textpath import text_to_path
+
+# candidate anchors in priority order: (x sign, y sign, ha, va)
+CANDIDATES = [(1, 1, 'left', 'bottom'),     # upper right
+              (1, -1, 'left', 'top'),       # lower right
+              (-1, 1, 'right', 'bottom'),   # upper left
+              (-1, -1, 'right', 'top'),     # lower left
+              (1, 0, 'left', 'center'),     # right
+              (-1, 0, 'right', 'center'),   # left
+              (0, 1, 'center', 'bottom'),   # above
+              (0, -1, 'center', 'top')]     # below
+
+# glyph advance widths in points, keyed by (character, font properties)
+_char_width = {}
+
+def text_width(text, prop):
+    # width of a text string in points from cached per-character widths
+    # (kerning is ignored, which is well inside the label padding)
+    key = prop.get_fontconfig_pattern()
+    width = 0.
+    for ch in text:
+        if (ch, key) not in _char_width:
+            _char_width[(ch, key)] = text_to_path.get_text_width_height_descent(ch, prop, ismath=False)[0]
+        width += _char_width[(ch, key)]
+
+    return width
+
+class BoxGrid:
+    # uniform grid of axis-aligned boxes in display coordinates
+    def __init__(self, cell):
+        self.cell = cell
+        self.cells = {}
+
+    def _keys(self, box):
+        i0, j0 = int(box[0] // self.cell), int(box[1] // self.cell)
+        i1, j1 = int(box[2] // self.cell), int(box[3] // self.cell)
+
+        return [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+
+    def overlaps(self, box):
+        for key in self._keys(box):
+            for other in self.cells.get(key, ()):
+                if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                    return True
+
+        return False
+
+    def add(self, box):
+        for key in self._keys(box):
+            self.cells.setdefault(key, []).append(box)
+
+def place_labels(ax, lons, lats, names, transform=None, avoid=(), avoid_size=25., obstacles=(),
+                 marker_size=5., offset=4., pad=1.5, fontsize=10, **text_kwargs):
+    '''
+    Label points (lons, lats) with names, which should be in priority order.
+    avoid is a list of (lon, lat) symbols of avoid_size points to keep clear
+    (e.g. the epicentre star), obstacles a list of (x0, y0, x1, y1) display
+    boxes to keep clear (e.g. a text box or scale bar) and pad is the
+    clearance around each label in points. Returns the list of text artists
+    placed.
+    '''
+    if len(names) == 0:
+        return []
+
+    # fix the final axes position before working in display coordinates
+    ax.apply_aspect()
+    trans = ax.transData if transform is None else transform._as_mpl_transform(ax)
+    pt = ax.figure.dpi / 72.
+
+    xy = trans.transform(np.column_stack((lons, lats)))
+    bbox = ax.bbox.extents
+
+    prop = FontProperties(size=fontsize, weight=text_kwargs.get('weight', 'normal'),
+                          family=text_kwargs.get('family'))
+    height = (fontsize + 2 * pad) * pt
+    grid = BoxGrid(2 * height)
+
+    # reserve the markers and avoided symbols
+    r = marker_size * pt / 2.
+    for x, y in xy:
+        grid.add((x - r, y - r, x + r, y + r))
+    if len(avoid) > 0:
+        r = avoid_size * pt / 2.
+        for x, y in trans.transform(np.asarray(avoid, dtype=float).reshape(-1, 2)):
+            grid.add((x - r, y - r, x + r, y + r))
+    for box in obstacles:
+        grid.add(tuple(box))
+
+    texts = []
+    off = offset * pt
+    for (x, y), lon, lat, name in zip(xy, lons, lats, names):
+        if not (bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]):
+            continue
+
+        width = (text_width(name, prop) + 2 * pad) * pt
+        for sx, sy, ha, va in CANDIDATES:
+            # box corner from the anchor and alignment
+            x0 = x + sx * off - {'left': pad * pt, 'right': width - pad * pt, 'center': width / 2.}[ha]
+            y0 = y + sy * off - {'bottom': pad * pt, 'top': height - pad * pt, 'center': height / 2.}[va]
+            box = (x0, y0, x0 + width, y0 + height)
+
+            if box[0] < bbox[0] or box[2] > bbox[2] or box[1] < bbox[1] or box[3] > bbox[3]:
+                continue
+            if grid.overlaps(box):
+                continue
+
+            grid.add(box)
+            texts.append(ax.annotate(name, (lon, lat), xycoords=trans, xytext=(sx * offset, sy * offset), textcoords='offset points',
+                                     ha=ha, va=va, fontsize=fontsize, **text_kwargs))
+            break
+
+    return texts
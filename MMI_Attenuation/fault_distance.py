@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorised source-to-site distance metrics for a rectangular finite rupture
+
+Rupture length and width come from the Wells and Coppersmith (1994) magnitude
+scaling relations. The rupture is centred along strike on the hypocentre, its
+top edge sits at ztor, and it dips to the right of strike (Aki-Richards
+convention). Sites are projected onto a local azimuthal-equidistant plane
+about the epicentre, so every metric is computed on whole site arrays at once.
+"""
+
+from numpy import radians, degrees, sin, cos, arcsin, arctan2, sqrt, hypot, \
+                  clip, maximum, asarray
+
+# Wells and Coppersmith (1994) log10(length) = a + b*M for subsurface rupture
+# length (RLD) and downdip rupture width (RW), in km
+WC94 = {'SS':  {'RLD': (-2.57, 0.62), 'RW': (-0.76, 0.27)},
+        'R':   {'RLD': (-2.42, 0.58), 'RW': (-1.61, 0.41)},
+        'N':   {'RLD': (-1.88, 0.50), 'RW': (-1.14, 0.35)},
+        'All': {'RLD': (-2.44, 0.59), 'RW': (-1.01, 0.32)}}
+
+EARTH_RADIUS = 6371.
+
+def haversine(lon, lat, eqlon, eqlat):
+    # great-circle distance in km
+    dlat = radians(lat - eqlat)
+    dlon = radians(lon - eqlon)
+    a = sin(dlat / 2)**2 + cos(radians(eqlat)) * cos(radians(lat)) * sin(dlon / 2)**2
+
+    return 2 * EARTH_RADIUS * arcsin(sqrt(a))
+
+def azimuth(lon, lat, eqlon, eqlat):
+    # initial bearing from the epicentre to each site, in degrees from north
+    phi1 = radians(eqlat)
+    phi2 = radians(lat)
+    dlon = radians(lon - eqlon)
+    y = sin(dlon) * cos(phi2)
+    x = cos(phi1) * sin(phi2) - sin(phi1) * cos(phi2) * cos(dlon)
+
+    return degrees(arctan2(y, x)) % 360.
+
+def destination(eqlon, eqlat, azim, dist):
+    # lon, lat of points dist km from the epicentre along bearing azim
+    phi1 = radians(eqlat)
+    delta = asarray(dist) / EARTH_RADIUS
+    theta = radians(azim)
+    phi2 = arcsin(sin(phi1) * cos(delta) + cos(phi1) * sin(delta) * cos(theta))
+    lam2 = radians(eqlon) + arctan2(sin(theta) * sin(delta) * cos(phi1),
+                                    cos(delta) - sin(phi1) * sin(phi2))
+
+    return (degrees(lam2) + 180.) % 360. - 180., degrees(phi2)
+
+def slip_type(rake):
+    # Wells and Coppersmith slip class from rake
+    if rake is None:
+        return 'All'
+    rake = (rake + 180.) % 360. - 180.
+    if -45. <= rake <= 45. or rake >= 135. or rake <= -135.:
+        return 'SS'
+
+    return 'R' if rake > 0 else 'N'
+
+def rupture_dimensions(mag, rake=None):
+    # rupture length and width (km) from magnitude
+    coeffs = WC94[slip_type(rake)]
+    a, b = coeffs['RLD']
+    length = 10**(a + b * mag)
+    a, b = coeffs['RW']
+    width = 10**(a + b * mag)
+
+    return length, width
+
+def rupture_plane(mag, eqdep, ztor=0., dip=90., rake=None, zbot=None):
+    '''
+    Rupture geometry for an event, returning a dict with the length, width and
+    final ztor, plus the along-strike and horizontal down-dip offsets (km) of the
+    top-edge start corner relative to the epicentre.
+
+    The width is limited to the seismogenic depth zbot if given, and ztor is
+    moved where needed so the hypocentre lies on the rupture.
+    '''
+    length, width = rupture_dimensions(mag, rake)
+    sindip = sin(radians(dip))
+    cosdip = cos(radians(dip))
+
+    if zbot is not None:
+        width = min(width, (zbot - ztor) / sindip)
+
+    # keep the hypocentre on the rupture plane
+    ztor = min(ztor, eqdep)
+    if eqdep - ztor > width * sindip:
+        ztor = eqdep - width * sindip
+
+    # down-dip distance from the top edge to the hypocentre
+    vhyp = (eqdep - ztor) / sindip
+
+    return {'length': length, 'width': width, 'ztor': ztor, 'dip': dip,
+            'u0': -length / 2., 'w0': -vhyp * cosdip}
+
+def rupture_distances(lon, lat, eqlon, eqlat, eqdep, mag, ztor=0., strike=0., dip=90.,
+                      rake=None, zbot=None):
+    '''
+    Compute Repi, Rhypo, Rjb, Rrup, Rx and Ry0 (km) for arrays of sites.
+
+    lon and lat are arrays of any (matching) shape; the returned dict holds
+    arrays of that shape. Rx is positive on the hanging wall.
+    '''
+    lon = asarray(lon, dtype=float)
+    lat = asarray(lat, dtype=float)
+    plane = rupture_plane(mag, eqdep, ztor, dip, rake, zbot)
+    length = plane['length']
+    width = plane['width']
+    ztor = plane['ztor']
+    sindip = sin(radians(dip))
+    cosdip = cos(radians(dip))
+
+    # sites on the local plane about the epicentre
+    repi = haversine(lon, lat, eqlon, eqlat)
+    az = radians(azimuth(lon, lat, eqlon, eqlat) - strike)
+
+    # u along strike from the top-edge start corner, w horizontally down dip
+    u = repi * cos(az) - plane['u0']
+    w = repi * sin(az) - plane['w0']
+
+    # Rx and Ry0 relative to the top-edge trace
+    rx = w
+    ry0 = maximum(maximum(-u, u - length), 0.)
+
+    # Rjb is the distance to the surface projection of the rupture
+    du = u - clip(u, 0., length)
+    dw = w - clip(w, 0., width * cosdip)
+    rjb = hypot(du, dw)
+
+    # Rrup is the distance to the closest point on the rupture plane
+    v = clip(w * cosdip - ztor * sindip, 0., width)
+    rrup = sqrt(du**2 + (w - v * cosdip)**2 + (ztor + v * sindip)**2)
+
+    return {'repi': repi, 'rhypo': sqrt(repi**2 + eqdep**2), 'rjb': rjb,
+            'rrup': rrup, 'rx': rx, 'ry0': ry0}
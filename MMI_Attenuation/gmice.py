@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Ground-motion to intensity conversion equations (GMICEs), both directions
+
+Coefficients are held in one structured table like the IPEs in mmi.py. Each
+relation is bilinear in log10 of the ground motion:
+
+    mmi = c1 + c2*log10(Y)    for log10(Y) <= t1
+    mmi = c3 + c4*log10(Y)    for log10(Y) >  t1
+
+with an optional magnitude/distance term c5 + c6*log10(R) + c7*M, where
+the model has one. The inverse uses the same lines, switching at mmi = t2.
+Y is PGA or PSA in cm/s/s (multiply g by G_CMS2) or PGV in cm/s.
+
+Everything is elementwise numpy, so whole arrays and grids convert in one
+call. convert_grid streams a memory-mapped raster from mmi_grid through the
+conversion in row chunks.
+"""
+
+import sys
+import json
+from numpy import array, asarray, where, log10, sqrt, clip, broadcast_to, nan, arange, memmap, float32
+
+G_CMS2 = 980.665  # standard gravity in cm/s/s
+
+# smmi is the sigma of mmi given the ground motion; spgm is the sigma of
+# log10(Y) given mmi (nan where not published)
+GMICE_DTYPE = [('model', 'U8'), ('imt', 'U6'), ('c1', 'f8'), ('c2', 'f8'), ('c3', 'f8'), ('c4', 'f8'),
+               ('c5', 'f8'), ('c6', 'f8'), ('c7', 'f8'), ('t1', 'f8'), ('t2', 'f8'),
+               ('smmi', 'f8'), ('spgm', 'f8')]
+
+GMICE_COEFFS = array([
+    # Worden et al. (2012)
+    ('W12', 'PGA',   1.78, 1.55, -1.60, 3.70, -0.91,  1.02, -0.17, 1.57, 4.22, 0.66, 0.35),
+    ('W12', 'PGV',   3.78, 1.47,  2.89, 3.16,  0.90,  0.00, -0.18, 0.53, 4.56, 0.63, 0.38),
+    ('W12', 'SA0.3', 1.26, 1.69, -4.15, 4.14, -1.05,  0.60,  0.00, 2.21, 4.99, 0.82, 0.44),
+    ('W12', 'SA1.0', 2.50, 1.51,  0.20, 2.90,  2.27, -0.49, -0.29, 1.65, 4.98, 0.75, 0.47),
+    ('W12', 'SA3.0', 3.81, 1.17,  1.99, 3.01,  1.91, -0.57, -0.21, 0.99, 4.96, 0.89, 0.64),
+    # Wald et al. (1999); the two lines cross at mmi 5
+    ('W99', 'PGA',   1.00, 2.20, -1.66, 3.66,  0.,    0.,    0.,   1.822, 5.01, 1.08, nan),
+    ('W99', 'PGV',   3.40, 2.10,  2.35, 3.47,  0.,    0.,    0.,   0.766, 5.01, 0.98, nan),
+], dtype=GMICE_DTYPE)
+
+def gmice_coeffs(model, imt):
+    # coefficient record for a model and intensity measure
+    rows = where((GMICE_COEFFS['model'] == model) & (GMICE_COEFFS['imt'] == imt))[0]
+    if len(rows) == 0:
+        raise ValueError(f'No {model} GMICE for {imt}')
+
+    return GMICE_COEFFS[rows[0]]
+
+def _mag_dist_term(c, mag, rrup):
+    # magnitude/distance adjustment, zero unless both are given
+    if mag is None or rrup is None:
+        return 0.
+
+    return c['c5'] + c['c6'] * log10(rrup) + c['c7'] * asarray(mag)
+
+def pgm2mmi(pgm, imt='PGA', model='W12', mag=None, rrup=None, clip_range=(1., 10.)):
+    '''
+    Intensity from ground motion (cm/s/s or cm/s), returning (mmi, sig).
+    mag and rrup (km) add the magnitude/distance term of models that have
+    one. mmi is clipped to clip_range unless it is None.
+    '''
+    c = gmice_coeffs(model, imt)
+    logy = log10(asarray(pgm, dtype=float))
+
+    mmi = where(logy <= c['t1'], c['c1'] + c['c2'] * logy, c['c3'] + c['c4'] * logy) \
+          + _mag_dist_term(c, mag, rrup)
+    if clip_range is not None:
+        mmi = clip(mmi, *clip_range)
+
+    return mmi, broadcast_to(c['smmi'], mmi.shape)
+
+def mmi2pgm(mmi, imt='PGA', model='W12', mag=None, rrup=None):
+    '''
+    Ground motion (cm/s/s or cm/s) from intensity, returning (pgm, sig)
+    with sig in log10 units.
+    '''
+    c = gmice_coeffs(model, imt)
+    mmi = asarray(mmi, dtype=float) - _mag_dist_term(c, mag, rrup)
+
+    logy = where(mmi <= c['t2'], (mmi - c['c1']) / c['c2'], (mmi - c['c3']) / c['c4'])
+
+    return 10.**logy, broadcast_to(c['spgm'], logy.shape)
+
+def pgm2mmi_worden12(pgm, imt, mag=None, rrup=None):
+    # Worden et al. (2012) in the call form of the old mmi_tools function
+    return pgm2mmi(pgm, imt, 'W12', mag, rrup)
+
+def convert_grid(infile, outfile, imt='PGA', model='W12', inverse=False, mag_dist=False, scale=1.,
+                 chunk_rows=256):
+    '''
+    Convert a raster in the mmi_grid layout (memmap plus JSON header) row
+    chunk by row chunk. Forward conversion reads ground motion, multiplied
+    by scale first (e.g. G_CMS2 for a raster in g), and writes mmi; inverse
+    reads mmi and writes ground motion. With mag_dist, the magnitude and
+    hypocentral distance term uses the event in the header. Returns the
+    memory-mapped output grid.
+    '''
+    from mmi_grid import load_scenario_grid
+    from fault_distance import haversine
+
+    grid, header = load_scenario_grid(infile)
+    nrows, ncols = grid.shape
+    extent, res = header['extent'], header['res']
+    lons = extent[0] + res * (arange(ncols) + 0.5)
+    lats = extent[3] - res * (arange(nrows) + 0.5)
+
+    out = memmap(outfile, dtype=float32, mode='w+', shape=(nrows, ncols))
+    for r0 in range(0, nrows, chunk_rows):
+        r1 = min(r0 + chunk_rows, nrows)
+
+        mag = rrup = None
+        if mag_dist:
+            mag = header['mag']
+            repi = haversine(lons[None, :], lats[r0:r1, None], header['eqlon'], header['eqlat'])
+            rrup = sqrt(repi**2 + header['eqdep']**2)
+
+        if inverse:
+            out[r0:r1] = mmi2pgm(grid[r0:r1], imt, model, mag, rrup)[0]
+        else:
+            out[r0:r1] = pgm2mmi(grid[r0:r1] * scale, imt, model, mag, rrup)[0]
+
+    out.flush()
+
+    header = dict(header, dtype='float32', imt='MMI' if not inverse else imt, gmice=model, source=infile)
+    with open(outfile + '.json', 'w') as f:
+        json.dump(header, f, indent=1)
+
+    return out
+
+####################################################################################
+# Round trip between the Woods Point scenario intensity grid and PGA
+
+if __name__ == '__main__':
+    infile = sys.argv[1] if len(sys.argv) > 1 else 'scenario_AW07_CEUS_mmi.dat'
+    imt = sys.argv[2] if len(sys.argv) > 2 else 'PGA'
+
+    pgafile = infile.replace('_mmi.dat', '_' + imt.lower() + '.dat')
+    convert_grid(infile, pgafile, imt, inverse=True)
+    mmi = convert_grid(pgafile, infile.replace('.dat', '_w12.dat'), imt)
+
+    print(f"{imt} grid saved as {pgafile}; maximum {imt} = {memmap(pgafile, dtype=float32, mode='r').max() / G_CMS2:.3f} g, "
+          f"maximum round-trip MMI = {mmi.max():.2f}")
@@ -1,12 +1,8 @@
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-from numpy import arange, log10, sqrt, exp, log, where, zeros_like
-mpl.style.use('classic')
-
-plt.rcParams['pdf.fonttype'] = 42
-
-fig = plt.figure(figsize=(10, 6))
-plt.tick_params(labelsize=12)
+# Only numpy is imported here so the IPEs load quickly in other programs;
+# matplotlib and pandas are imported by the plotting and CSV functions below
+import sys
+from numpy import array, arange, log10, sqrt, exp, log, where, maximum, asarray, broadcast_arrays, \
+                  broadcast_to, concatenate, empty, empty_like, nan
 
 # event details
 mag = 5.9
@@ -14,158 +10,282 @@ eqdep = 12
 eqlat = -37.5063
 eqlon = 146.4022
 ztor = 4.
+strike = 0.
+dip = 90.
+rake = 0.
 vs30 = 760  # Vs30 value in m/s
 maxrrup = 1000  # Set to 200 km
 rjb = arange(0.01, maxrrup + 1, 0.1)  # Values from 0 to 200 km in 1 km increments
 rrup = sqrt(rjb**2 + eqdep**2)
 
 ####################################################################################
-# Plot models using explicit equations
+# IPE coefficient tables
 
-def atkinson_wald_ceus_ipe(mag, rrup):
-    c1 = 11.72
-    c2 = 2.36
-    c3 = 0.1155
-    c4 = -0.44
-    c5 = -0.002044
-    c6 = 2.31
-    c7 = -0.479
-    h  = 17.
-    Rt = 80.
-    sig = 0.4
+# Coefficients for the functional form shared by AW07 and WWW14:
+#   mmi = c1 + c2*(M - m0) + c3*(M - m0)**2 + c4*log10(R) + c5*R + c6*B + c7*M*log10(R)
+# where R = sqrt(rrup**2 + h**2) and B = max(log10(R / Rt), 0).
+# site is 'all' for models without a site term, otherwise 'rock' (Vs30 >= 760 m/s)
+# and 'soil' (Vs30 < 760 m/s)
+IPE_DTYPE = [('model', 'U8'), ('region', 'U8'), ('site', 'U4'), ('m0', 'f8'),
+             ('c1', 'f8'), ('c2', 'f8'), ('c3', 'f8'), ('c4', 'f8'), ('c5', 'f8'),
+             ('c6', 'f8'), ('c7', 'f8'), ('h', 'f8'), ('Rt', 'f8'), ('sig', 'f8')]
+
+IPE_COEFFS = array([
+    # Atkinson and Wald (2007)
+    ('AW07',  'CEUS', 'all',  6., 11.72, 2.36, 0.1155, -0.44, -0.002044, 2.31, -0.479, 17., 80., 0.4),
+    ('AW07',  'CA',   'all',  6., 12.27, 2.27, 0.1304, -1.30, -0.0007070, 1.95, -0.577, 14., 30., 0.4),
+    # Worden, Wald, and others (2014)
+    ('WWW14', 'CA',   'rock', 0., 0.309, 1.864, 0., -1.672, -0.00219, 1.77, -0.383, 14., 50., 0.15),
+    ('WWW14', 'CA',   'soil', 0., 0.289, 1.784, 0., -1.672, -0.00210, 1.60, -0.350, 14., 50., 0.15),
+    ('WWW14', 'CEUS', 'all',  0., 0.7,   1.864, 0., -1.672, -0.00219, 1.77, -0.383, 14., 50., 0.15),
+], dtype=IPE_DTYPE)
+
+# Leonard (2015): mmi = c0 + c1*M + c2*ln(sqrt(rrup**2 + (1 + c3*exp(M - 5))**2))
+L15_COEFFS = {'c0': 3.5, 'c1': 1.05, 'c2': -1.09, 'c3': 1.1}
+
+# registered IPEs: name -> (model, region)
+# L15 does not provide a sigma, so it is returned as nan
+IPE_MODELS = {
+    'AW07_CEUS': ('AW07', 'CEUS'),
+    'AW07_CA': ('AW07', 'CA'),
+    'L15_AU': ('L15', 'AU'),
+    'WWW14_CA': ('WWW14', 'CA'),
+    'WWW14_CEUS': ('WWW14', 'CEUS'),
+}
+
+def register_ipe(name, model, region, rows):
+    '''
+    Add a model to the registry. rows is a list of coefficient tuples in
+    IPE_DTYPE field order, either one 'all' row or a 'rock' and 'soil' pair.
+    '''
+    global IPE_COEFFS
+    
+    IPE_COEFFS = concatenate((IPE_COEFFS, array(rows, dtype=IPE_DTYPE)))
+    IPE_MODELS[name] = (model, region)
+
+def ipe_coeffs(model, region, vs30=760.):
+    '''
+    Return coefficient records for model and region, selecting the site class
+    from vs30 (scalar or array) where the model has one.
+    '''
+    rows = where((IPE_COEFFS['model'] == model) & (IPE_COEFFS['region'] == region))[0]
+    if len(rows) == 0:
+        raise ValueError(f'No coefficients for {model} {region}')
     
-    R = sqrt(rrup**2 + h**2)
-    B = zeros_like(R)
-    idx = where(R > Rt)[0]
-    B[idx] = log10(R[idx] / Rt)
-        
-    mmi = c1 + c2 * (mag - 6) + c3 * (mag - 6)**2 + c4 * log10(R) + c5 * R + c6 * B + c7 * mag * log10(R)
+    site = IPE_COEFFS['site'][rows]
+    if len(rows) == 1 and site[0] == 'all':
+        return IPE_COEFFS[rows[0]]
     
-    return mmi, sig
+    rock = rows[site == 'rock'][0]
+    soil = rows[site == 'soil'][0]
+    return IPE_COEFFS[where(asarray(vs30) >= 760, rock, soil)]
 
-def atkinson_wald_cal_ipe(mag, rrup):
-    c1 = 12.27
-    c2 = 2.27
-    c3 = 0.1304
-    c4 = -1.30
-    c5 = -0.0007070
-    c6 = 1.95
-    c7 = -0.577
-    h  = 14.
-    Rt = 30.
-    sig = 0.4
+####################################################################################
+# Evaluate models
+
+def aw07_form(coeffs, mag, rrup):
+    # shared evaluator for the AW07/WWW14 functional form; coeffs may be a single
+    # record or an array of records that broadcasts against mag and rrup
+    R = sqrt(rrup**2 + coeffs['h']**2)
+    logR = log10(R)
+    B = maximum(logR - log10(coeffs['Rt']), 0.)
+    dm = mag - coeffs['m0']
     
-    R = sqrt(rrup**2 + h**2)
-    B = zeros_like(R)
-    idx = where(R > Rt)[0]
-    B[idx] = log10(R[idx] / Rt)
-        
-    mmi = c1 + c2 * (mag - 6) + c3 * (mag - 6)**2 + c4 * log10(R) + c5 * R + c6 * B + c7 * mag * log10(R)
+    mmi = coeffs['c1'] + coeffs['c2'] * dm + coeffs['c3'] * dm**2 + coeffs['c4'] * logR \
+          + coeffs['c5'] * R + coeffs['c6'] * B + coeffs['c7'] * mag * logR
     
-    return mmi, sig
+    return mmi, coeffs['sig']
+
+def ipe(name, mag, rrup, vs30=760.):
+    # evaluate a registered IPE by name, returning (mmi, sig)
+    model, region = IPE_MODELS[name]
+    if model == 'L15':
+        return leonard15_ipe(mag, rrup), nan
+    
+    return aw07_form(ipe_coeffs(model, region, vs30), mag, rrup)
+
+def atkinson_wald_ceus_ipe(mag, rrup):
+    return ipe('AW07_CEUS', mag, rrup)
+
+def atkinson_wald_cal_ipe(mag, rrup):
+    return ipe('AW07_CA', mag, rrup)
 
 def leonard15_ipe(mw, rrup):
-    c0 = 3.5
-    c1 = 1.05
-    c2 = -1.09
-    c3 = 1.1
+    c = L15_COEFFS
     
-    return c0 + c1 * mw + c2 * log(sqrt(rrup**2 + (1 + c3 * exp(mw - 5))**2))
+    return c['c0'] + c['c1'] * mw + c['c2'] * log(sqrt(rrup**2 + (1 + c['c3'] * exp(mw - 5))**2))
 
 def www14_ipe(mag, rrup, vs30, region='CA'):
-    from numpy import log10, sqrt, where, zeros_like
+    return aw07_form(ipe_coeffs('WWW14', region, vs30), mag, rrup)
+
+####################################################################################
+# Batch evaluation of all registered models
+
+def batch_ipe(mag, eqdep, vs30, rjb, models=None, rrup=None):
+    '''
+    Evaluate IPEs for many events in a single broadcast pass.
+
+    mag, eqdep and vs30 are scalars or arrays of length nev; rjb is either a
+    1-D array of distances shared by all events or an (nev, ndist) array.
+    rrup, in the same layout, overrides the point-source rupture distance
+    (e.g. from fault_distance.rupture_distances). Returns mmi and sig arrays of shape (nmodel, nev, ndist).
+    '''
+    if models is None:
+        models = list(IPE_MODELS)
     
-    # Coefficients from Worden, Wald, and others (2014)
-    if region == 'CA':
-        if vs30 >= 760:
-            c1 = 0.309
-            c2 = 1.864
-            c3 = -1.672
-            c4 = -0.00219
-            c5 = 1.77
-            c6 = -0.383
-        else:
-            # Coefficients for Vs30 < 760 m/s
-            c1 = 0.289
-            c2 = 1.784
-            c3 = -1.672
-            c4 = -0.00210
-            c5 = 1.60
-            c6 = -0.350
-    elif region == 'CEUS':
-        c1 = 0.7
-        c2 = 1.864
-        c3 = -1.672
-        c4 = -0.00219
-        c5 = 1.77
-        c6 = -0.383
+    mag, eqdep, vs30 = broadcast_arrays(asarray(mag, dtype=float).reshape(-1), 
+                                        asarray(eqdep, dtype=float).reshape(-1),
+                                        asarray(vs30, dtype=float).reshape(-1))
+    mag = mag[:, None]
+    vs30 = vs30[:, None]
     
-    h = 14.
-    sig = 0.15
+    # point-source rupture distance for every event/distance pair; shared 1-D
+    # distances are repeated for every event
+    if rrup is None:
+        rjb = asarray(rjb, dtype=float)
+        rrup = sqrt(rjb**2 + eqdep[:, None]**2)
+    else:
+        rrup = asarray(rrup, dtype=float)
+    rrup = broadcast_to(rrup, (len(mag), rrup.shape[-1]))
     
-    R = sqrt(rrup**2 + h**2)
-    Rt = log10(R / 50.)
-    B = zeros_like(R)
-    idx = where(Rt > 0)[0]
-    B[idx] = Rt[idx]
-        
-    mmi = c1 + c2 * mag + c3 * log10(R) + c4 * R + c5 * B + c6 * mag * log10(R)
+    mmi = empty((len(models),) + rrup.shape)
+    sig = empty_like(mmi)
+    for i, model in enumerate(models):
+        mmi[i], sig[i] = ipe(model, mag, rrup, vs30)
     
     return mmi, sig
 
-# Calculate MMI for different models
-AW07ceus, sig = atkinson_wald_ceus_ipe(mag, rrup)
-AW07cal, sig = atkinson_wald_cal_ipe(mag, rrup)
-L15 = leonard15_ipe(mag, rrup)
-WWW14_CA, sig = www14_ipe(mag, rrup, vs30, region='CA')
-WWW14_CEUS, sig = www14_ipe(mag, rrup, vs30, region='CEUS')
-
-# Plot models
-cl = ['b', 'g', 'r', 'c', 'm']  # Define some colors
-syms = ['o', '^', 's', 'd', 'x']
-
-h1 = plt.plot(rjb, AW07ceus, syms[0], color=cl[0], ls='-', ms=5, mec=cl[0], markevery=5)
-h2 = plt.plot(rjb, AW07cal, syms[1], color=cl[1], ls='-', ms=5, mec=cl[1], markevery=5)
-h3 = plt.plot(rjb, L15, syms[2], color=cl[2], ls='-', ms=5, mec=cl[2], markevery=5)
-h4 = plt.plot(rjb, WWW14_CA, syms[3], color=cl[3], ls='-', ms=5, mec=cl[3], markevery=5)
-h5 = plt.plot(rjb, WWW14_CEUS, syms[4], color=cl[4], ls='-', ms=5, mec=cl[4], markevery=5)
-
-##################################################################################
-
-leg1 = plt.legend([h1[0], h2[0], h3[0], h4[0], h5[0]], 
-           ['AW07 CEUS', 'AW07 CA', 'L15 AU', 'WWW14 CA', 'WWW14 CEUS'], fontsize=12, loc=3, numpoints=1)
-
-plt.grid(which='both', color='0.5')
-plt.xlim([0, maxrrup])
-plt.ylim([1, 8])
-plt.xlabel('Epicentral Distance (km)', fontsize=14)
-plt.ylabel('Macroseismic Intensity', fontsize=14)
-
-xtic = [10, 20, 50, 100, 200]
-xlab = ['10', '20', '50', '100', '200']
-plt.xticks(xtic, xlab)
-ylab = ['I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII']
-ytic = range(1, 9)
-plt.yticks(ytic, ylab)
-
-import pandas as pd
-
-# Data to save
-data = {
-    'rjb': rjb,
-    'AW07_CEUS': AW07ceus,
-    'AW07_CA': AW07cal,
-    'L15_AU': L15,
-    'WWW14_CA': WWW14_CA,
-    'WWW14_CEUS': WWW14_CEUS
-}
+####################################################################################
+# Attenuation curves for the event above
+
+MODEL_STYLES = {'AW07_CEUS': ('b', 'o'), 'AW07_CA': ('g', '^'), 'L15_AU': ('r', 's'),
+                'WWW14_CA': ('c', 'd'), 'WWW14_CEUS': ('m', 'x')}
+
+def profile_ipe(models=None):
+    # intensities of models (nmodel, ndist) at finite-fault distances along a profile perpendicular to strike
+    from fault_distance import destination, rupture_distances
+
+    if models is None:
+        models = list(IPE_MODELS)
+
+    prflon, prflat = destination(eqlon, eqlat, strike + 90., rjb)
+    dists = rupture_distances(prflon, prflat, eqlon, eqlat, eqdep, mag, ztor, strike, dip, rake)
+
+    return batch_ipe(mag, eqdep, vs30, rjb, models, rrup=dists['rrup'])[0][:, 0]
+
+def save_csv(outfile, models, mmi):
+    # write rjb and the intensity of every model as CSV (imports pandas)
+    import pandas as pd
+
+    data = {'rjb': rjb}
+    data.update(zip(models, mmi))
+    pd.DataFrame(data).to_csv(outfile, index=False)
+
+def plot_attenuation(outfile, models, mmi):
+    # plot the attenuation curves and save them (imports matplotlib); returns the figure
+    import matplotlib.pyplot as plt
+    import matplotlib as mpl
+
+    mpl.style.use('classic')
+    plt.rcParams['pdf.fonttype'] = 42
+
+    fig = plt.figure(figsize=(10, 6))
+    plt.tick_params(labelsize=12)
+
+    handles = []
+    for model, curve in zip(models, mmi):
+        colour, sym = MODEL_STYLES.get(model, ('k', 'o'))
+        handles.append(plt.plot(rjb, curve, sym, color=colour, ls='-', ms=5, mec=colour, markevery=5)[0])
+
+    plt.legend(handles, [model.replace('_', ' ') for model in models], fontsize=12, loc=3, numpoints=1)
+
+    plt.grid(which='both', color='0.5')
+    plt.xlim([0, maxrrup])
+    plt.ylim([1, 8])
+    plt.xlabel('Epicentral Distance (km)', fontsize=14)
+    plt.ylabel('Macroseismic Intensity', fontsize=14)
 
-# Create a DataFrame and save to CSV
-df = pd.DataFrame(data)
-df.to_csv('WP_attenuation_results.csv', index=False)
+    xtic = [10, 20, 50, 100, 200]
+    xlab = ['10', '20', '50', '100', '200']
+    plt.xticks(xtic, xlab)
+    ylab = ['I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII']
+    ytic = range(1, 9)
+    plt.yticks(ytic, ylab)
+
+    plt.savefig(outfile, format='png', dpi=300, bbox_inches='tight')
+    #plt.savefig('figures/moe_mmi_atten.svg', format='svg', dpi=300, bbox_inches='tight')
+
+    return fig
+
+def product_key(kind, models):
+    # product cache key of the attenuation CSV or plot for models and the event above
+    import os
+    import product_cache
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = [product_cache.file_digest(os.path.join(here, name)) for name in ('mmi.py', 'fault_distance.py')]
+    event = {'mag': mag, 'eqdep': eqdep, 'eqlat': eqlat, 'eqlon': eqlon, 'ztor': ztor, 'strike': strike, 'dip': dip,
+             'rake': rake, 'vs30': vs30, 'maxrrup': maxrrup, 'nrjb': len(rjb)}
+
+    return product_cache.product_key(kind, models=list(models), event=event, code=code)
+
+def main(argv=None):
+    '''
+    Compute the attenuation curves for the event above, save them as CSV and
+    plot them. --no-plot skips matplotlib, and --no-csv skips pandas, for a
+    fast start. Products unchanged since an earlier run are served from the
+    product cache unless --no-cache.
+    '''
+    import argparse
+    import product_cache
+    from pipeline_stats import stage, enable_from_argv
+
+    # Per-stage timings with --stats or PIPELINE_STATS=1
+    argv = [sys.argv[0]] + (sys.argv[1:] if argv is None else list(argv))
+    enable_from_argv(argv)
+
+    parser = argparse.ArgumentParser(description='Attenuation curves for the Woods Point event.')
+    parser.add_argument('--models', nargs='+', choices=list(IPE_MODELS), default=list(MODEL_STYLES))
+    parser.add_argument('--csv', default='WP_attenuation_results.csv')
+    parser.add_argument('--plot', default='wp_mmi_atten.png')
+    parser.add_argument('--no-csv', action='store_true')
+    parser.add_argument('--no-plot', action='store_true')
+    parser.add_argument('--no-show', action='store_true', help='save the plot without showing it')
+    parser.add_argument('--no-cache', action='store_true', help='rebuild the products, ignoring the product cache')
+    args = parser.parse_args(argv[1:])
+
+    # products still to build, after serving unchanged ones from the cache
+    todo = []
+    for kind, outfile, skip in (('attenuation csv', args.csv, args.no_csv), ('attenuation plot', args.plot, args.no_plot)):
+        if skip:
+            continue
+        key = product_key(kind, args.models)
+        if not args.no_cache and product_cache.restore(key, [outfile]):
+            print(f"{outfile} is unchanged (served from the product cache)")
+        else:
+            todo.append((kind, outfile, key))
+
+    if todo:
+        with stage('ipe', models=len(args.models), sites=len(rjb)):
+            mmi = profile_ipe(args.models)
+
+    for kind, outfile, key in todo:
+        if kind == 'attenuation csv':
+            with stage('save csv', rows=len(rjb)):
+                save_csv(outfile, args.models, mmi)
+            print(f"Attenuation curves saved as {outfile}")
+        else:
+            with stage('savefig', dpi=300):
+                plot_attenuation(outfile, args.models, mmi)
+            print(f"Attenuation plot saved as {outfile}")
 
+        if not args.no_cache:
+            product_cache.store(key, [outfile])
 
-plt.savefig('wp_mmi_atten.png', format='png', dpi=300, bbox_inches='tight')
-#plt.savefig('figures/moe_mmi_atten.svg', format='svg', dpi=300, bbox_inches='tight')
+    # show the plot when it was drawn in this run
+    if not args.no_show and any(kind == 'attenuation plot' for kind, _, _ in todo):
+        import matplotlib.pyplot as plt
+        plt.show()
 
-plt.show()
+if __name__ == '__main__':
+    main()
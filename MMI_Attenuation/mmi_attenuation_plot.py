@@ -7,16 +7,21 @@ Created on Thu Aug 27 11:28:54 2015
 
 # created bt Talllen, modifed by JLG
 
-import sys
-sys.path.append(r"C:\Users\Admin\OneDrive - The University of Melbourne\PhD\Github\my_codes")
-
-from mmi_tools import allen_etal_2012_rrup_ipe, allen_etal_2012_rhypo_ipe, \
-                      atkinson_wald_ceus_ipe, atkinson_wald_cal_ipe, pgm2mmi_worden12, \
-                      atkinson_worden_wald14_cal_ipe, leonard15_ipe
-from misc_tools import get_mpl2_colourlist
-from numpy import array, arange, log10, sqrt, logspace
+from mmi import atkinson_wald_ceus_ipe, atkinson_wald_cal_ipe, www14_ipe, leonard15_ipe
+from numpy import log10, logspace
 import matplotlib.pyplot as plt
 import matplotlib as mpl
+from matplotlib.colors import TABLEAU_COLORS
+from pipeline_stats import stage, enable_from_argv
+
+# Per-stage timings with --stats or PIPELINE_STATS=1
+enable_from_argv()
+
+# Allen et al. (2012) is only in Trevor Allen's mmi_tools; plotted when that is on the path
+try:
+    from mmi_tools import allen_etal_2012_rrup_ipe
+except ImportError:
+    allen_etal_2012_rrup_ipe = None
 mpl.style.use('classic')
 
 plt.rcParams['pdf.fonttype'] = 42
@@ -31,49 +36,60 @@ eqlat = -37.5063
 eqlon = 146.4022
 ztor = 4.
 maxrrup = 510.
-rjb = logspace(0, log10(maxrrup), 60)
-rrup = sqrt(rjb**2 + eqdep**2)
-rhypo = rrup
-repi = rjb
 rake = 0. # USGS CMT
 dip  = 90.
+strike = 0.
 vs30 = 360.
 
+# finite-fault distances for sites along a profile perpendicular to strike
+from fault_distance import destination, rupture_distances
+
+repi = logspace(0, log10(maxrrup), 60)
+with stage('distances', sites=len(repi)):
+    prflon, prflat = destination(eqlon, eqlat, strike + 90., repi)
+    dists = rupture_distances(prflon, prflat, eqlon, eqlat, eqdep, mag, ztor, strike, dip, rake)
+rjb = dists['rjb']
+rrup = dists['rrup']
+rhypo = dists['rhypo']
+
 ####################################################################################
 # plot models   
 
-# do AW07 CEUS
-AW07ceus, sig = atkinson_wald_ceus_ipe(mag, rrup)
-
-# do AW07 CA
-AW07cal, sig = atkinson_wald_cal_ipe(mag, rrup)
+with stage('ipe', sites=len(repi)):
+    # do AW07 CEUS
+    AW07ceus, sig = atkinson_wald_ceus_ipe(mag, rrup)
 
-# do Allen et al 2012 Rrup
-Aea12rup, Aea12sig = allen_etal_2012_rrup_ipe(mag, rrup, eqdep)
+    # do AW07 CA
+    AW07cal, sig = atkinson_wald_cal_ipe(mag, rrup)
 
-# do Allen et al 2012 Rhypo
-Aea12hypo, Aea12sig = allen_etal_2012_rhypo_ipe(mag, rrup, eqdep)
+    # do AWW14 CA
+    AWW14cal, sig = www14_ipe(mag, rhypo, vs30, 'CA')
 
-# do AWW14 CA
-AWW14cal, sig = atkinson_worden_wald14_cal_ipe(mag, rhypo)
+    # do Leonard 2015
+    L15 = leonard15_ipe(mag, rrup)
 
-# do Leonard 2015
-L15 = leonard15_ipe(mag, rrup)
+    # do Allen et al 2012 Rrup
+    if allen_etal_2012_rrup_ipe is not None:
+        Aea12rup, Aea12sig = allen_etal_2012_rrup_ipe(mag, rrup, eqdep)
 
-# plot models
-cl = get_mpl2_colourlist()
+# plot models with the matplotlib 2 colour cycle
+cl = list(TABLEAU_COLORS.values())
 syms = ['o', '^', 's', 'd', 'v', '<', 'h', '>', 'p']
 
 # make secondary plots to get around color issues
-h1 = plt.semilogx(rjb, Aea12rup, syms[0], color=cl[0], ls='-', ms=7, mec=cl[0], markevery=5)
-h2 = plt.semilogx(rjb, AW07ceus, syms[1], color=cl[1], ls='-', ms=7, mec=cl[1], markevery=5)
-h3 = plt.semilogx(rjb, AWW14cal, syms[2], color=cl[2], ls='-', ms=7, mec=cl[2], markevery=5)
-h4 = plt.semilogx(rjb, L15, syms[3], color=cl[3], ls='-', ms=7, mec=cl[3], markevery=5)
+handles = []
+labels = []
+if allen_etal_2012_rrup_ipe is not None:
+    handles += plt.semilogx(repi, Aea12rup, syms[0], color=cl[0], ls='-', ms=7, mec=cl[0], markevery=5)
+    labels.append('AWW12 ATR')
+handles += plt.semilogx(repi, AW07ceus, syms[1], color=cl[1], ls='-', ms=7, mec=cl[1], markevery=5)
+handles += plt.semilogx(repi, AWW14cal, syms[2], color=cl[2], ls='-', ms=7, mec=cl[2], markevery=5)
+handles += plt.semilogx(repi, L15, syms[3], color=cl[3], ls='-', ms=7, mec=cl[3], markevery=5)
+labels += ['AW07 CEUS', 'AWW14 CA', 'L15 AU']
 
 ##################################################################################
 
-leg1 = plt.legend([h1[0], h2[0], h3[0], h4[0]], 
-           ['AWW12 ATR', 'AW07 CEUS', 'AWW14 CA', 'L15 AU'], fontsize=12, loc=3, numpoints=1)
+leg1 = plt.legend(handles, labels, fontsize=12, loc=3, numpoints=1)
 
 plt.grid(which='both', color='0.5')
 plt.xlim([8, maxrrup])
@@ -88,7 +104,8 @@ ylab = ['I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII']
 ytic = range(1, 9)
 plt.yticks(ytic, ylab)
 
-plt.savefig('wp_mmi_atten.png', format='png', dpi=300, bbox_inches='tight')
+with stage('savefig', dpi=300):
+    plt.savefig('wp_mmi_atten.png', format='png', dpi=300, bbox_inches='tight')
 #plt.savefig('figures/moe_mmi_atten.svg', format='svg', dpi=300, bbox_inches='tight')
 
 plt.show()
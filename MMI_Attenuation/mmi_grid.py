@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Gridded (ShakeMap-style) scenario intensity maps from the IPEs in mmi.py
+
+The grid is computed in row chunks and written to a memory-mapped float32
+array, with the grid geometry stored in a JSON header next to it, so large
+fine-resolution grids can be built and plotted in bounded memory.
+"""
+
+import sys
+import json
+from numpy import arange, sqrt, asarray, memmap, float32
+
+from mmi import ipe, mag, eqdep, eqlat, eqlon, vs30, ztor
+from fault_distance import haversine, rupture_distances
+from pipeline_stats import stage, enable_from_argv
+
+def grid_shape(extent, res):
+    # number of rows and columns for an [lon0, lon1, lat0, lat1] extent
+    ncols = int(round((extent[1] - extent[0]) / res))
+    nrows = int(round((extent[3] - extent[2]) / res))
+
+    return nrows, ncols
+
+def scenario_grid(model, mag, eqlat, eqlon, eqdep, extent, res=0.01, vs30=760.,
+                  outfile='scenario_mmi.dat', chunk_rows=256, fault=None):
+    '''
+    Compute MMI for a registered model over a lon/lat raster.
+
+    extent is [llcrnrlon, urcrnrlon, llcrnrlat, urcrnrlat] as used by
+    ax.set_extent. Rows run from north to south (image order). vs30 is a
+    scalar or an array with the grid shape (e.g. another memmap). fault is an
+    optional dict of ztor, strike, dip, rake (and zbot) keywords for
+    fault_distance.rupture_distances; without it a point source is used.
+    Returns the memory-mapped grid.
+    '''
+    nrows, ncols = grid_shape(extent, res)
+
+    # cell centres
+    lons = extent[0] + res * (arange(ncols) + 0.5)
+    lats = extent[3] - res * (arange(nrows) + 0.5)
+
+    grid = memmap(outfile, dtype=float32, mode='w+', shape=(nrows, ncols))
+
+    vs30 = asarray(vs30, dtype=float)
+    with stage('scenario grid', cells=nrows * ncols, model=model):
+        for r0 in range(0, nrows, chunk_rows):
+            r1 = min(r0 + chunk_rows, nrows)
+
+            if fault is None:
+                repi = haversine(lons[None, :], lats[r0:r1, None], eqlon, eqlat)
+                rrup = sqrt(repi**2 + eqdep**2)
+            else:
+                rrup = rupture_distances(lons[None, :], lats[r0:r1, None], eqlon, eqlat, eqdep, mag, 
+                                         **fault)['rrup']
+
+            site_vs30 = vs30[r0:r1] if vs30.ndim == 2 else vs30
+            grid[r0:r1] = ipe(model, mag, rrup, site_vs30)[0]
+
+        grid.flush()
+
+    # write grid geometry so the raster can be reloaded and placed on a map
+    header = {'model': model, 'mag': mag, 'eqlat': eqlat, 'eqlon': eqlon, 'eqdep': eqdep,
+              'fault': fault, 'extent': list(extent), 'res': res, 'shape': [nrows, ncols], 'dtype': 'float32'}
+    with open(outfile + '.json', 'w') as f:
+        json.dump(header, f, indent=1)
+
+    return grid
+
+def load_scenario_grid(outfile):
+    # reopen a grid written by scenario_grid read-only, returning (grid, header)
+    with open(outfile + '.json') as f:
+        header = json.load(f)
+
+    grid = memmap(outfile, dtype=header['dtype'], mode='r', shape=tuple(header['shape']))
+
+    return grid, header
+
+####################################################################################
+# Make a scenario grid for the event in mmi.py over the DYFI map extent
+
+if __name__ == '__main__':
+    # Per-stage timings with --stats or PIPELINE_STATS=1
+    enable_from_argv()
+
+    model = sys.argv[1] if len(sys.argv) > 1 else 'AW07_CEUS'
+    degrng = 5.9
+
+    extent = [eqlon - degrng, eqlon + degrng, eqlat - degrng, eqlat + degrng]
+    outfile = '_'.join(('scenario', model, 'mmi.dat'))
+
+    # Woods Point USGS CMT, strike-slip on a vertical plane
+    fault = {'ztor': ztor, 'strike': 0., 'dip': 90., 'rake': 0.}
+
+    scenario_grid(model, mag, eqlat, eqlon, eqdep, extent, res=0.01, vs30=vs30, outfile=outfile, fault=fault)
+
+    print(f"Scenario grid saved as {outfile}")
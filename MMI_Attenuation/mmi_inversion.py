@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Magnitude, epicentre and depth from DYFI intensities by grid search
+
+Candidate hypocentres (lon, lat, depth) and magnitudes are scored by the
+nresp-weighted misfit between observed cell intensities and an IPE from
+mmi.py. Candidates are evaluated in batches as (magnitude, location, cell)
+arrays sized to a memory budget. The search starts on a coarse grid over
+the felt area and is refined around the best candidate a few times. The
+uncertainty is the likelihood-weighted mean and standard deviation of each
+parameter on a final grid around the best fit.
+
+Weights are nresp normalised to a mean of one, so each cell counts as about
+one observation and well-sampled cells count for more.
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+from mmi import ipe
+from fault_distance import haversine
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DYFI_Reports'))
+
+PARAMS = ('eqlo', 'eqla', 'eqdep', 'mag')
+
+def grid_misfit(model, obs, lons, lats, deps, mags, vs30=760., max_bytes=1 << 27):
+    '''
+    Weighted sum of squared residuals for every candidate location
+    (lons, lats, deps of equal length nloc) and magnitude, shape (nloc, nmag).
+    '''
+    w = obs['nresp'] / obs['nresp'].mean()
+    ncell = len(w)
+    mags = np.asarray(mags, dtype=float)
+
+    chi2 = np.empty((len(lons), len(mags)))
+    batch = int(max(1, max_bytes // (8 * ncell * (len(mags) + 3))))
+    for b0 in range(0, len(lons), batch):
+        b1 = min(b0 + batch, len(lons))
+        repi = haversine(obs['lon'][None, :], obs['lat'][None, :], lons[b0:b1, None], lats[b0:b1, None])
+        rrup = np.sqrt(repi**2 + deps[b0:b1, None]**2)
+
+        res = obs['intensity'] - ipe(model, mags[:, None, None], rrup[None], vs30)[0]
+        chi2[b0:b1] = ((res**2) @ w).T
+
+    return chi2
+
+def _candidates(centre, steps, npts, bounds):
+    # regular grid of npts values per parameter centred on centre with spacing steps, within bounds
+    axes = [c + s * (np.arange(n) - (n - 1) / 2.) for c, s, n in zip(centre, steps, npts)]
+
+    return [np.unique(np.clip(a, lo, hi)) for a, (lo, hi) in zip(axes, bounds)]
+
+def _search(model, obs, axes, vs30, max_bytes):
+    # misfit on the product grid of axes (lon, lat, depth, mag)
+    lo, la, de = [a.ravel() for a in np.meshgrid(axes[0], axes[1], axes[2], indexing='ij')]
+    chi2 = grid_misfit(model, obs, lo, la, de, axes[3], vs30, max_bytes)
+
+    return lo, la, de, chi2
+
+def invert_dyfi(obs, model='AW07_CEUS', vs30=760., centre=None, radius=1.5, depth_range=(2., 30.),
+                mag_range=(3., 7.5), nlevels=4, max_bytes=1 << 27):
+    '''
+    Grid search for the hypocentre and magnitude that best fit the DYFI cells
+    in obs (dict of lon, lat, intensity and nresp arrays, e.g. from
+    dyfi_io.load_dyfi). The coarse search covers radius degrees around centre
+    (default: the nresp-weighted centroid of the most strongly felt cells)
+    and depth_range and mag_range, and the refinement stays within them.
+    Returns a dict of the best eqlo, eqla, eqdep and mag, their
+    likelihood-weighted mean and std, the weighted rms misfit and the number
+    of candidates evaluated.
+    '''
+    obs = {key: np.asarray(obs[key], dtype=float) for key in ('lon', 'lat', 'intensity', 'nresp')}
+    if centre is None:
+        strong = obs['intensity'] >= np.percentile(obs['intensity'], 90)
+        centre = (np.average(obs['lon'][strong], weights=obs['nresp'][strong]),
+                  np.average(obs['lat'][strong], weights=obs['nresp'][strong]))
+
+    # coarse grid over the whole search space
+    npts = (11, 11, 4, 19)
+    steps = np.array([2. * radius / (npts[0] - 1), 2. * radius / (npts[1] - 1),
+                      (depth_range[1] - depth_range[0]) / (npts[2] - 1), (mag_range[1] - mag_range[0]) / (npts[3] - 1)])
+    best = np.array([centre[0], centre[1], np.mean(depth_range), np.mean(mag_range)])
+    bounds = [(centre[0] - radius, centre[0] + radius), (centre[1] - radius, centre[1] + radius),
+              (max(depth_range[0], 1.), depth_range[1]), mag_range]
+    coarse_steps = steps.copy()
+
+    ncand = 0
+    for level in range(nlevels):
+        axes = _candidates(best, steps, npts if level == 0 else (5, 5, 5, 5), bounds)
+        lo, la, de, chi2 = _search(model, obs, axes, vs30, max_bytes)
+        ncand += chi2.size
+
+        i, j = np.unravel_index(np.argmin(chi2), chi2.shape)
+        best = np.array([lo[i], la[i], de[i], axes[3][j]])
+        # next level: 5 points spanning one step of this level either side of the best fit
+        steps = steps / 2.
+
+    sig = ipe(model, best[3], 10., vs30)[1]
+
+    # likelihood on a grid around the best fit, starting at the finest spacing and widened
+    # in each parameter until its marginal likelihood has fallen off at the grid edges
+    for _ in range(6):
+        axes = _candidates(best, steps, (9, 9, 9, 9), bounds)
+        lo, la, de, chi2 = _search(model, obs, axes, vs30, max_bytes)
+        ncand += chi2.size
+
+        if np.isnan(sig):
+            sig = np.sqrt(chi2.min() / len(obs['lon']))
+        like = np.exp(-(chi2 - chi2.min()) / (2. * sig**2))
+        like /= like.sum()
+
+        like4 = like.reshape([len(a) for a in axes])
+        wide = False
+        for k in range(4):
+            marginal = like4.sum(axis=tuple(a for a in range(4) if a != k))
+            if max(marginal[0], marginal[-1]) > 0.01 * marginal.max() and steps[k] < coarse_steps[k]:
+                steps[k] *= 2.
+                wide = True
+        if not wide:
+            break
+
+    values = [lo[:, None], la[:, None], de[:, None], axes[3][None, :]]
+    mean = [float((like * v).sum()) for v in values]
+    std = [float(np.sqrt((like * (v - m)**2).sum())) for v, m in zip(values, mean)]
+
+    i, j = np.unravel_index(np.argmin(chi2), chi2.shape)
+    best = [float(lo[i]), float(la[i]), float(de[i]), float(axes[3][j])]
+
+    return {'best': dict(zip(PARAMS, best)), 'mean': dict(zip(PARAMS, mean)), 'std': dict(zip(PARAMS, std)),
+            'rms': float(np.sqrt(chi2[i, j] / len(obs['lon']))), 'ncandidates': ncand, 'model': model}
+
+def synthetic_obs(source, model='AW07_CEUS', ncell=1834, radius=3., scatter=0.5, vs30=760., seed=None):
+    '''
+    DYFI-like cells for checking the inversion: ncell random cell centres
+    within radius degrees of source (a dict of eqlo, eqla, eqdep and mag),
+    with intensities from the IPE plus normal scatter shrinking with the
+    number of responses, which fall off with distance. Only felt cells
+    (intensity of 2 or more) are kept.
+    '''
+    rng = np.random.default_rng(seed)
+    lon = source['eqlo'] + rng.uniform(-radius, radius, ncell)
+    lat = source['eqla'] + rng.uniform(-radius, radius, ncell)
+    repi = haversine(lon, lat, source['eqlo'], source['eqla'])
+    rrup = np.sqrt(repi**2 + source['eqdep']**2)
+
+    nresp = 1 + rng.poisson(50. / (1. + repi / 20.))
+    intensity = ipe(model, source['mag'], rrup, vs30)[0] + rng.normal(0., scatter, ncell) / np.sqrt(nresp)
+    felt = intensity >= 2.
+
+    return {'lon': lon[felt], 'lat': lat[felt], 'intensity': np.round(intensity[felt], 1),
+            'nresp': nresp[felt].astype(float)}
+
+####################################################################################
+# Invert a DYFI GeoJSON file for its source, or synthetic cells with --synthetic
+
+if __name__ == '__main__':
+    model = sys.argv[2] if len(sys.argv) > 2 else 'AW07_CEUS'
+    if sys.argv[1] == '--synthetic':
+        # cells from a known source near Woods Point, to check the parameters are recovered
+        true = {'eqlo': 146.4022, 'eqla': -37.5063, 'eqdep': 12., 'mag': 5.9}
+        obs = synthetic_obs(true, model, seed=1)
+    else:
+        from dyfi_io import load_dyfi
+
+        true = None
+        dyfi = load_dyfi(sys.argv[1])
+        keep = dyfi['nresp'] > 0
+        obs = {key: dyfi[key][keep] for key in ('lon', 'lat', 'intensity', 'nresp')}
+
+    t0 = time.time()
+    result = invert_dyfi(obs, model)
+    print(f"{len(obs['lon'])} cells, {result['ncandidates']} candidates in {time.time() - t0:.1f} s "
+          f"(rms misfit {result['rms']:.2f})")
+    for key in PARAMS:
+        print(f"{key}: best {result['best'][key]:.3f}, mean {result['mean'][key]:.3f} +/- {result['std'][key]:.3f}"
+              + (f" (true {true[key]:.3f})" if true is not None else ''))
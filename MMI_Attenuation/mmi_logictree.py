@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Logic-tree combination of the IPEs in mmi.py
+
+A logic tree is a list of weighted branches, each a registered model with an
+optional site Vs30 and sigma override:
+
+    [{'model': 'AW07_CEUS', 'weight': 0.3},
+     {'model': 'WWW14_CA', 'vs30': 400., 'weight': 0.2}, ...]
+
+All branches are evaluated into (nbranch, ...) arrays. The weighted mean and
+fractiles are then taken across the branch axis in array operations, with no
+Python loop over branches or sites. Fractiles either include the aleatory
+sigma of every branch or are epistemic only. With sigma, fractiles are
+found by bisection on the weighted mixture of normals, all sites and
+fractiles at once. Without it, they are weighted quantiles of the branch
+medians.
+"""
+
+import sys
+import numpy as np
+
+from mmi import ipe, mag, eqdep, vs30, rjb
+from mmi_hazard import norm_sf, hazard_curves
+
+def check_weights(branches, tol=1e-6):
+    # branch weights as an array, raising unless they are non-negative and sum to one
+    weights = np.array([b['weight'] for b in branches], dtype=float)
+    if (weights < 0).any() or abs(weights.sum() - 1.) > tol:
+        raise ValueError(f'Logic tree weights must be non-negative and sum to 1, not {weights.sum()}')
+
+    return weights
+
+def branch_ipe(branches, mag, rrup, vs30=760.):
+    # median and sigma of every branch, each of shape (nbranch,) + broadcast shape
+    shape = np.broadcast(mag, rrup, vs30).shape
+    preds = [ipe(b['model'], mag, rrup, b.get('vs30', vs30)) for b in branches]
+    mu = np.array([np.broadcast_to(m, shape) for m, _ in preds])
+    sig = np.array([np.broadcast_to(b.get('sigma', s), shape) for b, (_, s) in zip(branches, preds)])
+
+    return mu, sig
+
+def weighted_mean(values, weights):
+    # weighted mean over the leading (branch) axis
+    return np.tensordot(weights, values, axes=1)
+
+def weighted_quantile(values, weights, q):
+    '''
+    Weighted quantiles (0-1) over the leading (branch) axis, taking the
+    smallest value whose cumulative weight reaches q. Returns an array of
+    shape (nq,) + values.shape[1:].
+    '''
+    q = np.atleast_1d(np.asarray(q, dtype=float))
+    order = np.argsort(values, axis=0)
+    sorted_vals = np.take_along_axis(values, order, axis=0)
+    cumw = np.cumsum(np.asarray(weights)[order], axis=0)
+
+    # first branch in sorted order with cumulative weight >= q, per site and fractile
+    k = (cumw[None, ...] < q.reshape((-1,) + (1,) * values.ndim) - 1e-12).sum(axis=1)
+    k = np.minimum(k, len(values) - 1)
+
+    return np.take_along_axis(sorted_vals[None, ...], k[:, None, ...], axis=1)[:, 0]
+
+def mixture_fractiles(mu, sig, weights, q, tol=1e-4):
+    '''
+    Fractiles (0-1) of the weighted mixture of normal distributions
+    N(mu[i], sig[i]) over the leading axis, by bisection on the mixture CDF
+    for all sites and fractiles together. Returns (nq,) + mu.shape[1:].
+    '''
+    q = np.atleast_1d(np.asarray(q, dtype=float)).reshape((-1,) + (1,) * (mu.ndim - 1))
+    w = np.asarray(weights).reshape((-1,) + (1,) * (mu.ndim - 1))
+
+    lo = np.broadcast_to((mu - 8. * sig).min(axis=0), q.shape[:1] + mu.shape[1:]).copy()
+    hi = np.broadcast_to((mu + 8. * sig).max(axis=0), lo.shape).copy()
+    niter = int(np.ceil(np.log2(max(np.max(hi - lo), tol) / tol)))
+    for _ in range(niter):
+        mid = (lo + hi) / 2.
+        cdf = 1. - (w[:, None] * norm_sf((mid[None] - mu[:, None]) / sig[:, None])).sum(axis=0)
+        below = cdf < q
+        lo = np.where(below, mid, lo)
+        hi = np.where(below, hi, mid)
+
+    return (lo + hi) / 2.
+
+def logic_tree_ipe(branches, mag, rrup, vs30=760., fractiles=(0.16, 0.5, 0.84), aleatory=True):
+    '''
+    Weighted mean intensity and fractiles of a logic tree. With aleatory,
+    fractiles are of the full mixture including each branch's sigma (which
+    must be defined; give L15 branches a 'sigma'); otherwise they are
+    epistemic fractiles of the branch medians. Returns a dict of mean and
+    fractiles with shape (nfractile,) + broadcast shape.
+    '''
+    weights = check_weights(branches)
+    mu, sig = branch_ipe(branches, mag, rrup, vs30)
+
+    if aleatory:
+        if np.isnan(sig).any():
+            missing = [b['model'] for b, s in zip(branches, sig) if np.isnan(s).any()]
+            raise ValueError(f"Sigma is undefined for {', '.join(missing)}; give those branches a sigma")
+        values = mixture_fractiles(mu, np.maximum(sig, 1e-6), weights, fractiles)
+    else:
+        values = weighted_quantile(mu, weights, fractiles)
+
+    return {'mean': weighted_mean(mu, weights), 'fractiles': values, 'levels': np.asarray(fractiles)}
+
+def logic_tree_hazard(branches, sources, lons, lats, levels=np.arange(2., 10.05, 0.1), vs30=760.,
+                      fractiles=(0.16, 0.5, 0.84), **kwargs):
+    '''
+    Weighted mean hazard curves and epistemic fractile curves over the
+    branches, each of shape (nsite, nlevel) (fractiles lead with nfractile).
+    Extra keywords are passed to mmi_hazard.hazard_curves.
+    '''
+    weights = check_weights(branches)
+    curves = np.array([hazard_curves(sources, lons, lats, b['model'], levels, b.get('vs30', vs30),
+                                     sigma=b.get('sigma'), **kwargs) for b in branches])
+
+    return {'mean': weighted_mean(curves, weights), 'fractiles': weighted_quantile(curves, weights, fractiles),
+            'levels': np.asarray(fractiles)}
+
+####################################################################################
+# Combine the IPEs for the event in mmi.py
+
+if __name__ == '__main__':
+    aleatory = not (len(sys.argv) > 1 and sys.argv[1] == 'epistemic')
+
+    branches = [{'model': 'AW07_CEUS', 'weight': 0.3},
+                {'model': 'AW07_CA', 'weight': 0.1},
+                {'model': 'L15_AU', 'weight': 0.2, 'sigma': 0.5},  # L15 has no sigma; assumed
+                {'model': 'WWW14_CA', 'weight': 0.1},
+                {'model': 'WWW14_CEUS', 'weight': 0.3}]
+
+    rrup = np.sqrt(rjb**2 + eqdep**2)
+    tree = logic_tree_ipe(branches, mag, rrup, vs30, fractiles=(0.16, 0.5, 0.84), aleatory=aleatory)
+
+    np.savetxt('WP_logic_tree_results.csv', np.column_stack((rjb, tree['mean'], tree['fractiles'].T)),
+               delimiter=',', header='rjb,mean,p16,p50,p84', comments='', fmt='%.4f')
+
+    print("Logic tree intensities saved as WP_logic_tree_results.csv")
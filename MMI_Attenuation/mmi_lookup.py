@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed magnitude / log-distance lookup tables for the IPEs in mmi.py
+
+Each registered model (and each site class of models that have one), or any
+other function of (mag, rrup, vs30) returning (mmi, sig), is tabulated once
+on a regular grid of magnitude and log10(rrup) shared by all tables. The
+grid is refined until bilinear interpolation is within a stated tolerance of
+every function on a 5x5 sample inside every cell. Tables are saved as
+float32 .npy files with a JSON index and memory-mapped on load, so later
+evaluations read only the table pages they touch.
+
+The log-distance bin and weight of every site are computed once with
+distance_bins and reused for every model and magnitude. The row of a
+magnitude is interpolated once per call onto a fine sub-grid of the
+distance bins, so a warm lookup is one gather per site from a small
+contiguous array, with no logarithm, clipping or search. This is cheaper
+than the closed-form IPEs, which each evaluate a logarithm (and L15 a
+square root) per site. Passing plain distances to lookup_ipe bins them on
+every call, which costs more than the closed form.
+
+Inputs outside the tabulated range are clamped to its edges, so keep the
+range to what the tables are used for.
+"""
+
+import os
+import sys
+import json
+import time
+import numpy as np
+
+from mmi import ipe, IPE_MODELS, IPE_COEFFS, mag, rjb, eqdep
+
+TABLE_DIR = 'ipe_tables'
+
+# tables loaded in this process, keyed by directory
+_loaded = {}
+
+def site_classes(name):
+    # (site class, representative vs30) pairs of a registered model
+    if name not in IPE_MODELS:
+        return [('all', 760.)]
+
+    model, region = IPE_MODELS[name]
+    sites = IPE_COEFFS['site'][(IPE_COEFFS['model'] == model) & (IPE_COEFFS['region'] == region)]
+    if 'rock' in sites:
+        return [('rock', 760.), ('soil', 400.)]
+
+    return [('all', 760.)]
+
+def tabulate(func, vs30, mag_range, logr_range, dm, dlogr):
+    # intensities from func(mag, rrup, vs30) on the (nmag, ndist) grid
+    mags = np.arange(mag_range[0], mag_range[1] + dm / 2, dm)
+    logr = np.arange(logr_range[0], logr_range[1] + dlogr / 2, dlogr)
+
+    return func(mags[:, None], 10.**logr[None, :], vs30)[0], mags, logr
+
+class DistanceBins:
+    '''
+    Position of every distance in the tables' log-distance grid, as an index
+    into nsub sub-steps per bin, computed once so lookups need no logarithm,
+    clipping or search. Rounding the linear weight to 1/nsub adds at most
+    half a sub-step's change in intensity to the interpolation error.
+    '''
+    def __init__(self, rrup, logr0, dlogr, nr, nsub=64):
+        fr = np.clip((np.log10(rrup) - logr0) / dlogr, 0., nr - 1.)
+        self.k = np.rint(fr * nsub).astype(np.intp)
+        self.nsub = nsub
+        self.shape = self.k.shape
+        self.grid = (logr0, dlogr, nr)
+
+def distance_bins(rrup, outdir=TABLE_DIR):
+    # distance bins of rrup in the grid of the tables in outdir, for repeated lookup_ipe calls
+    grid = load_tables(outdir)['logr_grid']
+
+    return DistanceBins(np.asarray(rrup, dtype=float), grid['logr0'], grid['dlogr'], grid['n'])
+
+def interp_table(table, m0, dm, mag, bins):
+    # interpolation in a (nmag, ndist) table at distance bins, clamped in magnitude
+    nm, nr = table.shape
+    mag = np.asarray(mag, dtype=float)
+    fm = np.clip((mag - m0) / dm, 0., nm - 1.)
+    i = np.minimum(fm.astype(np.intp), nm - 2)
+    tm = (fm - i).astype(np.float32)
+
+    lead = max(mag.ndim - bins.k.ndim, 0)
+    if all(n == 1 for n in mag.shape[lead:]):
+        # magnitudes only vary across the leading axes: interpolate their distance rows at every
+        # sub-step, then gather once per site
+        i = i.reshape(mag.shape[:lead])
+        rows = table[i] + (table[i + 1] - table[i]) * tm.reshape(mag.shape[:lead] + (1,))
+        w = np.arange(bins.nsub, dtype=np.float32) / bins.nsub
+        fine = (rows[..., :-1, None] + np.diff(rows, axis=-1)[..., None] * w).reshape(rows.shape[:-1] + (-1,))
+        fine = np.concatenate((fine, rows[..., -1:]), axis=-1)
+
+        return fine[..., bins.k]
+
+    # magnitude varies by site: bilinear from the four surrounding table values
+    j = np.minimum(bins.k // bins.nsub, nr - 2)
+    tr = ((bins.k - j * bins.nsub) / bins.nsub).astype(np.float32)
+    flat = table.reshape(-1)
+    k = i * nr + j
+    v00 = flat[k]
+    v01 = flat[k + 1]
+    v10 = flat[k + nr]
+    v11 = flat[k + nr + 1]
+
+    return (v00 * (1. - tr) + v01 * tr) * (1. - tm) + (v10 * (1. - tr) + v11 * tr) * tm
+
+def max_error(func, vs30, table, mags, logr, nsub=5):
+    # largest interpolation error over an nsub x nsub sample inside every cell
+    dm = mags[1] - mags[0]
+    dlogr = logr[1] - logr[0]
+    sub = np.arange(1, nsub + 1) / (nsub + 1.)
+    mm = (mags[:-1, None] + sub * dm).ravel()
+    rm = (logr[:-1, None] + sub * dlogr).ravel()
+    exact = func(mm[:, None], 10.**rm[None, :], vs30)[0]
+    approx = interp_table(table, mags[0], dm, mm[:, None], DistanceBins(10.**rm, logr[0], dlogr, len(logr)))
+
+    return float(np.max(np.abs(approx - exact)))
+
+def build_tables(outdir=TABLE_DIR, models=None, funcs=None, mag_range=(2.5, 8.5), rrup_range=(1., 1500.),
+                 tol=0.01, dm=0.1, dlogr=0.02):
+    '''
+    Tabulate each registered model and site class, plus any functions in
+    funcs (name -> func(mag, rrup, vs30) returning (mmi, sig)), on one
+    magnitude / log-distance grid. The grid spacing is halved until the
+    interpolation error of every table is below tol (MMI units). The tables
+    and an index are written to outdir. Returns the index.
+    '''
+    if models is None:
+        models = list(IPE_MODELS)
+
+    funcs = dict(funcs or {})
+    for name in models:
+        funcs[name] = lambda mag, rrup, vs30, name=name: ipe(name, mag, rrup, vs30)
+
+    logr_range = (np.log10(rrup_range[0]), np.log10(rrup_range[1]))
+    os.makedirs(outdir, exist_ok=True)
+
+    # refine the shared grid until every table meets tol
+    while True:
+        tables = {}
+        for name, func in funcs.items():
+            for site, vs30 in site_classes(name):
+                table, mags, logr = tabulate(func, vs30, mag_range, logr_range, dm, dlogr)
+                table = table.astype(np.float32)
+                tables[name, site] = table, max_error(func, vs30, table, mags, logr), func(mags[0], 10., vs30)[1]
+        if max(err for _, err, _ in tables.values()) <= tol:
+            break
+        dm /= 2.
+        dlogr /= 2.
+
+    index = {}
+    for (name, site), (table, err, sig) in tables.items():
+        filename = f'{name}_{site}.npy'
+        np.save(os.path.join(outdir, filename), table)
+        index.setdefault(name, {})[site] = {'file': filename, 'mag0': float(mags[0]), 'dm': float(mags[1] - mags[0]),
+                                            'shape': list(table.shape), 'sig': float(np.mean(sig)), 'max_error': err}
+
+    with open(os.path.join(outdir, 'index.json'), 'w') as f:
+        json.dump({'mag_range': list(mag_range), 'rrup_range': list(rrup_range), 'tol': tol,
+                   'logr_grid': {'logr0': float(logr[0]), 'dlogr': float(logr[1] - logr[0]), 'n': len(logr)},
+                   'models': index}, f, indent=1)
+
+    return index
+
+def load_tables(outdir=TABLE_DIR):
+    # index of the tables in outdir with each table memory-mapped, loaded once per process
+    if outdir in _loaded:
+        return _loaded[outdir]
+
+    with open(os.path.join(outdir, 'index.json')) as f:
+        tables = json.load(f)
+
+    for sites in tables['models'].values():
+        for entry in sites.values():
+            entry['table'] = np.load(os.path.join(outdir, entry['file']), mmap_mode='r')
+
+    _loaded[outdir] = tables
+
+    return tables
+
+def lookup_ipe(name, mag, rrup, vs30=760., outdir=TABLE_DIR):
+    '''
+    Interpolate (mmi, sig) for a tabulated model or function, as a drop-in
+    for mmi.ipe within the tabulated magnitude and distance range. rrup is
+    either distances or, for the fast warm path, their DistanceBins from
+    distance_bins. mmi is float32, the precision of the tables.
+    '''
+    tables = load_tables(outdir)
+    sites = tables['models'][name]
+    bins = rrup if isinstance(rrup, DistanceBins) else distance_bins(rrup, outdir)
+
+    def interp(entry):
+        return interp_table(entry['table'], entry['mag0'], entry['dm'], mag, bins)
+
+    if 'all' in sites:
+        return interp(sites['all']), sites['all']['sig']
+
+    rock = np.asarray(vs30) >= 760
+    if rock.ndim == 0:
+        entry = sites['rock'] if rock else sites['soil']
+        return interp(entry), entry['sig']
+
+    mmi = np.where(rock, interp(sites['rock']), interp(sites['soil']))
+    sig = np.where(rock, sites['rock']['sig'], sites['soil']['sig'])
+
+    return mmi, sig
+
+####################################################################################
+# Build the tables and compare the warm lookup with the closed-form equations
+
+if __name__ == '__main__':
+    outdir = sys.argv[1] if len(sys.argv) > 1 else TABLE_DIR
+
+    # equally weighted mean of the registered models, as an expensive function to tabulate
+    def ipe_mean(mag, rrup, vs30):
+        names = [name for name in IPE_MODELS if not name.startswith('L15')]
+        return np.mean([ipe(name, mag, rrup, vs30)[0] for name in names], axis=0), np.nan
+
+    index = build_tables(outdir, funcs={'MEAN': ipe_mean})
+
+    # distances are binned once, outside the timed lookups
+    rrup = np.sqrt(rjb**2 + eqdep**2)
+    bins = distance_bins(rrup, outdir)
+    mags = np.random.default_rng(1).uniform(4., 7., (200, 1))
+    for name in index:
+        errs = ', '.join(f"{site} {entry['max_error']:.4f}" for site, entry in index[name].items())
+        func = ipe_mean if name == 'MEAN' else lambda m, r, v: ipe(name, m, r, v)
+
+        t0 = time.perf_counter()
+        exact = func(mags, rrup, 760.)[0]
+        t1 = time.perf_counter()
+        approx = lookup_ipe(name, mags, bins, outdir=outdir)[0]
+        t2 = time.perf_counter()
+
+        print(f"{name}: max table error {errs}; closed form {t1 - t0:.3f} s, lookup {t2 - t1:.3f} s, "
+              f"max difference {np.max(np.abs(approx - exact)):.4f}")
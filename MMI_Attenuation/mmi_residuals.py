@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Residuals of the IPEs in mmi.py against DYFI observations, and refitting of
+the AW07/WWW14 functional form
+
+The DYFI cells of any number of events are loaded into one set of flat
+arrays tagged with an event index. Residuals for every model, and the
+per-event and per-model biases, then come from single array passes
+(bincount over the event index), weighted by the number of responses per
+cell. With h, Rt and m0 held fixed, the AW07/WWW14 form is linear in
+c1..c7, so a regional refit is one weighted least-squares solve over the
+cells of all events.
+"""
+
+import os
+import sys
+import numpy as np
+
+from mmi import ipe, ipe_coeffs, IPE_MODELS, IPE_DTYPE
+from fault_distance import haversine
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DYFI_Reports'))
+
+COEFF_NAMES = ['c1', 'c2', 'c3', 'c4', 'c5', 'c6', 'c7']
+
+def load_observations(events, min_resp=0):
+    '''
+    Load the DYFI cells with nresp > min_resp of events (dicts with geojson,
+    mag, eqdep, eqla and eqlo, as in DYFI_Reports/dyfi_events.py) into flat
+    arrays: intensity, nresp, lon, lat, event (index into events) and the
+    hypocentral rrup of every cell.
+    '''
+    from dyfi_io import load_dyfi
+
+    parts = []
+    for i, event in enumerate(events):
+        dyfi = load_dyfi(event['geojson'])
+        keep = dyfi['nresp'] > min_resp
+        parts.append({'intensity': dyfi['intensity'][keep], 'nresp': dyfi['nresp'][keep],
+                      'lon': dyfi['lon'][keep], 'lat': dyfi['lat'][keep],
+                      'event': np.full(np.count_nonzero(keep), i)})
+
+    obs = {key: np.concatenate([p[key] for p in parts]) for key in parts[0]}
+
+    # per-event parameters broadcast to cells
+    for key in ('mag', 'eqdep', 'eqla', 'eqlo'):
+        obs[key] = np.array([event[key] for event in events], dtype=float)[obs['event']]
+
+    repi = haversine(obs['lon'], obs['lat'], obs['eqlo'], obs['eqla'])
+    obs['rrup'] = np.sqrt(repi**2 + obs['eqdep']**2)
+    obs['nevent'] = len(events)
+
+    return obs
+
+def ipe_residuals(models, obs, vs30=760.):
+    '''
+    Observed minus predicted intensity for every model and cell, shape
+    (nmodel, ncell), with nresp-weighted summaries: bias and std per model,
+    and event_bias (nmodel, nevent) per model and event.
+    '''
+    if models is None:
+        models = list(IPE_MODELS)
+
+    pred = np.array([ipe(model, obs['mag'], obs['rrup'], vs30)[0] for model in models])
+    res = obs['intensity'][None, :] - pred
+    w = obs['nresp'].astype(float)
+
+    bias = res @ w / w.sum()
+    std = np.sqrt(((res - bias[:, None])**2) @ w / w.sum())
+
+    # per-event weighted means for all models in one bincount
+    nev = obs['nevent']
+    flat = (np.arange(len(models))[:, None] * nev + obs['event'][None, :]).ravel()
+    wsum = np.bincount(obs['event'], weights=w, minlength=nev)
+    event_bias = np.bincount(flat, weights=(res * w).ravel(), minlength=len(models) * nev).reshape(len(models), nev)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        event_bias /= wsum
+
+    return {'models': list(models), 'residuals': res, 'bias': bias, 'std': std, 'event_bias': event_bias}
+
+def design_matrix(coeffs, mag, rrup):
+    # columns of the AW07/WWW14 form multiplying c1..c7, for fixed h, Rt and m0
+    R = np.sqrt(rrup**2 + coeffs['h']**2)
+    logR = np.log10(R)
+    B = np.maximum(logR - np.log10(coeffs['Rt']), 0.)
+    dm = mag - coeffs['m0']
+
+    return np.column_stack((np.ones_like(R), dm, dm**2, logR, R, B, mag * logR))
+
+def free_coefficients(mag):
+    # coefficients the magnitudes in the data can constrain
+    nmag = len(np.unique(np.round(mag, 1)))
+    if nmag < 2:
+        return ['c1', 'c4', 'c5', 'c6']
+    if nmag < 3:
+        return ['c1', 'c2', 'c4', 'c5', 'c6', 'c7']
+
+    return list(COEFF_NAMES)
+
+def refit_ipe(base, obs, region, free=None, vs30=760.):
+    '''
+    Refit c1..c7 of the AW07/WWW14 form to the observations by nresp-weighted
+    least squares, starting from the coefficients of base (a registered
+    model name) with h, Rt and m0 held fixed. Coefficients not in free
+    (default: those the spread of magnitudes can constrain) keep their base
+    values. Returns a coefficient row for mmi.register_ipe, with sig set to
+    the weighted residual standard deviation.
+    '''
+    model, base_region = IPE_MODELS[base]
+    if model == 'L15':
+        raise ValueError('Only models with the AW07/WWW14 form can be refitted')
+
+    coeffs = ipe_coeffs(model, base_region, vs30)
+    if free is None:
+        free = free_coefficients(obs['mag'])
+
+    A = design_matrix(coeffs, obs['mag'], obs['rrup'])
+    base_c = np.array([coeffs[name] for name in COEFF_NAMES])
+    cols = np.array([name in free for name in COEFF_NAMES])
+
+    # move the fixed terms to the right-hand side and solve for the free ones
+    y = obs['intensity'] - A[:, ~cols] @ base_c[~cols]
+    sw = np.sqrt(obs['nresp'].astype(float))
+    sol = np.linalg.lstsq(A[:, cols] * sw[:, None], y * sw, rcond=None)[0]
+
+    c = base_c.copy()
+    c[cols] = sol
+    res = obs['intensity'] - A @ c
+    w = obs['nresp'].astype(float)
+    sig = np.sqrt((res**2) @ w / w.sum())
+
+    return (model, region, 'all', float(coeffs['m0'])) + tuple(float(v) for v in c) \
+           + (float(coeffs['h']), float(coeffs['Rt']), float(sig))
+
+####################################################################################
+# Residuals and an Australian refit for a directory or manifest of DYFI events
+
+if __name__ == '__main__':
+    from dyfi_events import find_events, load_manifest
+
+    source = sys.argv[1] if len(sys.argv) > 1 else '.'
+    events = find_events(source) if os.path.isdir(source) else load_manifest(source)
+    obs = load_observations(events)
+
+    models = [name for name in IPE_MODELS]
+    res = ipe_residuals(models, obs)
+    print(f"{len(obs['intensity'])} cells from {len(events)} events")
+    for i, model in enumerate(models):
+        print(f"{model}: bias {res['bias'][i]:+.2f}, std {res['std'][i]:.2f}")
+
+    row = refit_ipe('AW07_CEUS', obs, 'AU')
+    print('Refitted AW07 AU coefficients:')
+    print(dict(zip([name for name, _ in IPE_DTYPE], row)))
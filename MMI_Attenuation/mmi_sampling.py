@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo sampling of IPE intensities with aleatory variability
+
+Each realisation adds a between-event term, common to all sites, and a
+within-event term, spatially correlated between sites, to the median
+intensity of every model:
+
+    mmi = median + tau * eta + phi * z
+
+where the total IPE sigma is split as tau**2 = between_frac * sig**2 and
+phi**2 = (1 - between_frac) * sig**2, and z is a standard normal field with
+exponential correlation exp(-3 d / corr_range). The same standard normal
+draws are used for every model, so model results are comparable.
+
+On a regular lon/lat grid of sites, z is drawn by circulant embedding: the
+correlation of the grid, projected to km about its centre, is embedded in a
+periodic grid whose covariance is diagonalised by the 2-D FFT, so memory
+and time grow with the number of sites rather than its square. Other site
+sets use the Cholesky factor of the dense correlation matrix, which is only
+built while it fits in the memory budget.
+
+Realisations are drawn in chunks and reduced into per-site exceedance
+counts and fixed-width intensity histograms, so memory does not grow with
+the number of realisations. The statistics arrays, correlation factor and
+chunk together are kept within max_bytes. Percentiles are interpolated
+from the histograms.
+"""
+
+import sys
+import numpy as np
+
+from mmi import ipe, mag, eqdep, eqlat, eqlon, vs30
+from fault_distance import haversine, EARTH_RADIUS
+
+MMI_RANGE = (0., 13.)
+
+def site_correlation(lons, lats, corr_range):
+    # exponential within-event correlation matrix between sites
+    d = haversine(lons[:, None], lats[:, None], lons[None, :], lats[None, :])
+
+    return np.exp(-3. * d / corr_range)
+
+def correlation_factor(lons, lats, corr_range, jitter=1e-10, max_bytes=1 << 27):
+    '''
+    Lower Cholesky factor of the site correlation matrix, or None if
+    uncorrelated. The factor is a dense nsite x nsite matrix, so raise
+    rather than exhaust memory when it would not fit in max_bytes.
+    '''
+    if corr_range is None or corr_range <= 0:
+        return None
+
+    nsite = len(lons)
+    if 8 * nsite**2 > max_bytes:
+        raise ValueError(f'The correlation matrix of {nsite} sites needs {8 * nsite**2 / 2.**20:.0f} MB, '
+                         f'over max_bytes ({max_bytes / 2.**20:.0f} MB); sample on a regular lon/lat grid, '
+                         'use fewer sites or raise max_bytes')
+
+    corr = site_correlation(np.asarray(lons, dtype=float), np.asarray(lats, dtype=float), corr_range)
+    corr[np.diag_indices_from(corr)] += jitter
+
+    return np.linalg.cholesky(corr)
+
+def site_grid(lons, lats):
+    '''
+    If the sites are the nodes of a regular lon/lat grid (in any order),
+    return the grid row and column of every site and the grid lons and lats,
+    else None.
+    '''
+    glon, ix = np.unique(lons, return_inverse=True)
+    glat, iy = np.unique(lats, return_inverse=True)
+    if len(glon) * len(glat) != len(lons) or len(glon) < 2 or len(glat) < 2:
+        return None
+    if not (np.allclose(np.diff(glon), glon[1] - glon[0]) and np.allclose(np.diff(glat), glat[1] - glat[0])):
+        return None
+    if len(np.unique(iy * len(glon) + ix)) != len(lons):
+        return None
+
+    return iy.ravel(), ix.ravel(), glon, glat
+
+class DenseField:
+    '''
+    Correlated standard normal draws at any sites through the dense
+    Cholesky factor of their correlation matrix.
+    '''
+    def __init__(self, lons, lats, corr_range, max_bytes):
+        self.chol = correlation_factor(lons, lats, corr_range, max_bytes=max_bytes)
+        self.nsite = len(lons)
+        self.nbytes = self.chol.nbytes
+        self.real_bytes = 16 * self.nsite  # the draws and their product with the factor
+
+    def draw(self, rng, n):
+        return rng.standard_normal((n, self.nsite)) @ self.chol.T
+
+class GridField:
+    '''
+    Correlated standard normal draws on a regular lon/lat grid by circulant
+    embedding. The grid is projected to km about its centre (equirectangular,
+    so distances are within a few per cent over a few degrees) and the
+    exponential correlation is wrapped onto a periodic grid, padded until
+    its FFT eigenvalues are non-negative; any remaining negative eigenvalues
+    are set to zero, which slightly smooths the field.
+    '''
+    def __init__(self, grid, corr_range, max_bytes, max_pad=8):
+        self.iy, self.ix, glon, glat = grid
+        ny, nx = len(glat), len(glon)
+        dy = EARTH_RADIUS * np.radians(glat[1] - glat[0])
+        dx = EARTH_RADIUS * np.radians(glon[1] - glon[0]) * np.cos(np.radians(glat.mean()))
+
+        if 8 * 4 * (ny - 1) * (nx - 1) > max_bytes:
+            raise ValueError(f'The circulant embedding of a {ny} x {nx} grid does not fit in max_bytes '
+                             f'({max_bytes / 2.**20:.0f} MB); use a coarser grid or raise max_bytes')
+
+        for pad in 2**np.arange(int(np.log2(max_pad)) + 1):
+            my, mx = 2 * (ny - 1) * pad, 2 * (nx - 1) * pad
+            if pad > 1 and 8 * my * mx > max_bytes:
+                break  # keep the largest embedding that fits
+            ly = np.minimum(np.arange(my), my - np.arange(my)) * dy
+            lx = np.minimum(np.arange(mx), mx - np.arange(mx)) * dx
+            eig = np.fft.fft2(np.exp(-3. * np.hypot(ly[:, None], lx[None, :]) / corr_range)).real
+            if eig.min() >= -1e-8 * eig.max():
+                break
+
+        self.shape = (ny, nx)
+        self.scale = np.sqrt(np.maximum(eig, 0.) / eig.size)
+        self.nbytes = self.scale.nbytes
+        self.real_bytes = 16 * eig.size + 16 * len(self.iy)  # half a complex draw and its FFT, and the draws
+
+    def draw(self, rng, n):
+        # each complex field gives two independent realisations, its real and imaginary parts
+        npair = (n + 1) // 2
+        z = np.empty((npair,) + self.scale.shape, dtype=complex)
+        rng.standard_normal(out=z.view(float))
+        z *= self.scale
+
+        # 2-D FFT, transforming along the second axis only the columns that cover the grid
+        field = np.fft.fft(z, axis=2)
+        del z
+        field = np.fft.fft(field[:, :, :self.shape[1]], axis=1)
+
+        out = np.empty((2 * npair, len(self.iy)))
+        out[:npair] = field.real[:, self.iy, self.ix]
+        out[npair:] = field.imag[:, self.iy, self.ix]
+
+        return out[:n]
+
+def correlated_field(lons, lats, corr_range, max_bytes=1 << 27):
+    # within-event field sampler for the sites: circulant embedding on a regular grid, else dense Cholesky
+    lons = np.asarray(lons, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+    grid = site_grid(lons, lats)
+    if grid is not None:
+        return GridField(grid, corr_range, max_bytes)
+
+    return DenseField(lons, lats, corr_range, max_bytes)
+
+def histogram_bins(bin_width, mmi_range=MMI_RANGE):
+    # number of intensity histogram bins per site
+    return int(np.ceil((mmi_range[1] - mmi_range[0]) / bin_width))
+
+def stats_bytes(nmodel, nsite, nthresh, nbins):
+    # memory of StreamingStats: exceedance counts, histograms and the two running sums, and the counts of one chunk
+    return nmodel * nsite * (8 * nthresh + 4 * nbins + 16) + 8 * nsite * (nthresh + 1 + nbins)
+
+class StreamingStats:
+    '''
+    Per-model, per-site exceedance counts and intensity histograms,
+    accumulated one chunk of realisations at a time.
+    '''
+    def __init__(self, nmodel, nsite, thresholds, bin_width=0.05, mmi_range=MMI_RANGE):
+        self.thresholds = np.sort(np.asarray(thresholds, dtype=float))
+        self.bin_width = bin_width
+        self.lo = mmi_range[0]
+        self.nbins = histogram_bins(bin_width, mmi_range)
+        self.nsite = nsite
+        self.nreal = 0
+
+        self.exceed = np.zeros((nmodel, nsite, len(self.thresholds)), dtype=np.int64)
+        self.hist = np.zeros((nmodel, nsite, self.nbins), dtype=np.int32)
+        self.total = np.zeros((nmodel, nsite))
+        self.total_sq = np.zeros((nmodel, nsite))
+
+    def update(self, i, sims):
+        # add a (nchunk, nsite) block of realisations of model i
+        site = np.arange(self.nsite)
+        nt = len(self.thresholds)
+
+        # number of thresholds below each sample, counted per site; a sample
+        # exceeds threshold k if more than k thresholds are below it
+        k = np.searchsorted(self.thresholds, sims)
+        k += site * (nt + 1)
+        counts = np.bincount(k.ravel(), minlength=self.nsite * (nt + 1)).reshape(self.nsite, nt + 1)
+        self.exceed[i] += np.cumsum(counts[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        del k
+
+        # histogram bin of every sample, computed in place to keep the chunk's temporaries small
+        b = sims - self.lo
+        b /= self.bin_width
+        b = b.astype(np.int64)
+        np.clip(b, 0, self.nbins - 1, out=b)
+        b += site * self.nbins
+        self.hist[i] += np.bincount(b.ravel(), minlength=self.nsite * self.nbins).reshape(self.nsite, self.nbins)
+        del b
+
+        self.total[i] += sims.sum(axis=0)
+        self.total_sq[i] += np.einsum('ij,ij->j', sims, sims)
+
+    def percentiles(self, q):
+        # percentiles (0-100) of every model and site, linear within histogram bins; one model at a time
+        # so the cumulative histogram stays within the chunk counts' memory
+        out = np.empty(self.hist.shape[:2] + (len(q),))
+        for i, hist in enumerate(self.hist):
+            cum = np.cumsum(hist, axis=-1, dtype=np.int32)
+            for k, p in enumerate(q):
+                target = p / 100. * self.nreal
+                b = np.minimum((cum < target).sum(axis=-1), self.nbins - 1)
+                below = np.take_along_axis(cum, b[:, None], -1)[:, 0] - np.take_along_axis(hist, b[:, None], -1)[:, 0]
+                count = np.maximum(np.take_along_axis(hist, b[:, None], -1)[:, 0], 1)
+                out[i, :, k] = self.lo + (b + np.clip((target - below) / count, 0., 1.)) * self.bin_width
+
+        return out
+
+def sample_ipe(models, mag, rrup, vs30=760., lons=None, lats=None, nreal=10000, thresholds=range(2, 10),
+               percentiles=(5, 16, 50, 84, 95), between_frac=0.3, corr_range=None, sigma=None,
+               chunk=None, max_bytes=1 << 27, bin_width=0.05, seed=None):
+    '''
+    Sample nreal realisations of intensity at nsite sites for each model.
+
+    rrup and vs30 are per-site arrays (or scalars). lons and lats are only
+    needed for spatially correlated within-event terms (corr_range in km).
+    sigma overrides the model sigma, and is required for models without one
+    (L15). Correlated draws use circulant embedding on a regular lon/lat
+    grid of sites and a dense Cholesky factor otherwise (see
+    correlated_field). chunk realisations are drawn at a time, by default as
+    many as fit in max_bytes after the statistics arrays and correlation
+    factor, and a ValueError is raised if those alone do not fit. Returns a
+    dict of poe (nmodel, nsite, nthresh) exceedance probabilities,
+    percentiles (nmodel, nsite, npct), mean and std (nmodel, nsite), and the
+    thresholds and percentile levels used.
+    '''
+    if isinstance(models, str):
+        models = [models]
+
+    rrup = np.atleast_1d(np.asarray(rrup, dtype=float))
+    nsite = len(rrup)
+    site_vs30 = np.broadcast_to(np.asarray(vs30, dtype=float), rrup.shape)
+
+    # median and total sigma of every model at every site
+    median = np.empty((len(models), nsite))
+    sig = np.empty((len(models), nsite))
+    for i, model in enumerate(models):
+        median[i], s = ipe(model, mag, rrup, site_vs30)
+        sig[i] = s if sigma is None else sigma
+    if np.isnan(sig).any():
+        raise ValueError('Sigma is undefined for ' + ', '.join(m for m, s in zip(models, sig) if np.isnan(s).any())
+                         + '; pass sigma to sample it')
+
+    tau = np.sqrt(between_frac) * sig
+    phi = np.sqrt(1. - between_frac) * sig
+
+    field = None
+    if corr_range is not None and corr_range > 0:
+        field = correlated_field(lons, lats, corr_range, max_bytes)
+
+    # memory held for the whole run: the statistics, the per-site model terms and the correlation factor
+    fixed = stats_bytes(len(models), nsite, len(thresholds), histogram_bins(bin_width)) + 4 * median.nbytes
+    if field is not None:
+        fixed += field.nbytes
+    if fixed >= max_bytes:
+        raise ValueError(f'The statistics of {len(models)} models at {nsite} sites and their correlation factor need {fixed / 2.**20:.0f} MB, '
+                         f'over max_bytes ({max_bytes / 2.**20:.0f} MB); use fewer sites, a wider bin_width '
+                         'or raise max_bytes')
+
+    # realisations per chunk: the draws plus one model's samples and temporaries
+    if chunk is None:
+        real_bytes = 8 * nsite * 4 + (field.real_bytes if field is not None else 0)
+        chunk = int(max(1, min(nreal, (max_bytes - fixed) // real_bytes)))
+
+    stats = StreamingStats(len(models), nsite, thresholds, bin_width)
+    rng = np.random.default_rng(seed)
+    for n0 in range(0, nreal, chunk):
+        n = min(chunk, nreal - n0)
+
+        eta = rng.standard_normal((n, 1))
+        eps = rng.standard_normal((n, nsite)) if field is None else field.draw(rng, n)
+
+        for i in range(len(models)):
+            sims = phi[i] * eps
+            sims += tau[i] * eta
+            sims += median[i]
+            stats.update(i, sims)
+            del sims
+        stats.nreal += n
+
+    mean = stats.total / stats.nreal
+    std = np.sqrt(np.maximum(stats.total_sq / stats.nreal - mean**2, 0.))
+
+    return {'models': list(models), 'thresholds': stats.thresholds, 'poe': stats.exceed / stats.nreal,
+            'levels': np.asarray(percentiles, dtype=float), 'percentiles': stats.percentiles(percentiles),
+            'mean': mean, 'std': std, 'nreal': stats.nreal}
+
+####################################################################################
+# Sample intensities on a coarse grid around the event in mmi.py
+
+if __name__ == '__main__':
+    nreal = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    degrng = 2.
+    res = 0.1
+
+    lons, lats = np.meshgrid(np.arange(eqlon - degrng, eqlon + degrng + res / 2, res),
+                             np.arange(eqlat - degrng, eqlat + degrng + res / 2, res))
+    lons = lons.ravel()
+    lats = lats.ravel()
+    rrup = np.sqrt(haversine(lons, lats, eqlon, eqlat)**2 + eqdep**2)
+
+    models = ['AW07_CEUS', 'AW07_CA', 'WWW14_CA', 'WWW14_CEUS']
+    result = sample_ipe(models, mag, rrup, vs30, lons, lats, nreal=nreal, corr_range=20., seed=1)
+
+    np.savez('WP_mmi_samples.npz', lon=lons, lat=lats, **result)
+
+    for i, model in enumerate(models):
+        k = list(result['thresholds']).index(5)
+        print(f"{model}: {np.count_nonzero(result['poe'][i, :, k] > 0.1)} sites with P(MMI > V) > 10%")
+
+    print("Sampled intensities saved as WP_mmi_samples.npz")
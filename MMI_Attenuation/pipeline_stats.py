@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing and memory instrumentation for the DYFI and attenuation scripts
+
+Code marks its stages with
+
+    with stage('draw cells', cells=len(dyfi['lon'])) as s:
+        ...
+        s.count(labels=len(texts))
+
+and, when instrumentation is on, each stage records its wall time, CPU time,
+resident memory at exit, peak RSS of the process so far and any item counts.
+Stages may nest. Instrumentation is switched on by the PIPELINE_STATS
+environment variable (1, or the path of the JSON report) or a --stats[=path]
+command line flag read by enable_from_argv. When it is off, stage returns a
+shared no-op context, so marked code costs one function call per stage.
+
+The report is written as JSON at exit, or on demand with write_report.
+"""
+
+import os
+import sys
+import time
+import json
+import atexit
+import resource
+
+_stages = []
+_stack = []
+_enabled = False
+_report_path = None
+
+class _NullStage(object):
+    # stand-in for Stage when instrumentation is off
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def count(self, **counts):
+        pass
+
+_NULL = _NullStage()
+
+def _rss_mb():
+    # current resident set size in MB (Linux), or None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2.**20
+    except (OSError, ValueError):
+        return None
+
+def _peak_rss_mb():
+    # peak resident set size of this process in MB (ru_maxrss is KB on Linux, bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak / 2.**20 if sys.platform == 'darwin' else peak / 2.**10
+
+class Stage(object):
+    # one timed stage; the record is appended to the report on exit
+    def __init__(self, name, counts):
+        self.record = {'name': name, 'depth': len(_stack), 'counts': dict(counts)}
+
+    def __enter__(self):
+        _stack.append(self.record['name'])
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+        return self
+
+    def __exit__(self, *exc):
+        self.record['wall_s'] = time.perf_counter() - self._wall
+        self.record['cpu_s'] = time.process_time() - self._cpu
+        self.record['rss_mb'] = _rss_mb()
+        self.record['peak_rss_mb'] = _peak_rss_mb()
+        if exc[0] is not None:
+            self.record['error'] = exc[0].__name__
+        _stack.pop()
+        _stages.append(self.record)
+
+        return False
+
+    def count(self, **counts):
+        # add item counts (cells drawn, places labelled, ...) found inside the stage
+        self.record['counts'].update(counts)
+
+def stage(name, **counts):
+    # context manager timing a named stage, or a no-op when instrumentation is off
+    if not _enabled:
+        return _NULL
+
+    return Stage(name, counts)
+
+def enabled():
+    return _enabled
+
+def enable(path=None):
+    '''
+    Switch instrumentation on, writing the report to path (default
+    <script>_stats.json) when the process exits.
+    '''
+    global _enabled, _report_path
+
+    if not _enabled:
+        atexit.register(lambda: _stages and write_report())
+    _enabled = True
+    _report_path = path or _report_path
+
+def enable_from_argv(argv=None):
+    '''
+    Enable instrumentation if argv (default sys.argv) has a --stats or
+    --stats=path flag, removing the flag so positional arguments are unchanged.
+    '''
+    argv = sys.argv if argv is None else argv
+    for arg in list(argv[1:]):
+        if arg == '--stats' or arg.startswith('--stats='):
+            argv.remove(arg)
+            enable(arg.partition('=')[2] or None)
+
+def reset():
+    # drop the stages recorded so far (e.g. between events in one process)
+    del _stages[:]
+
+def report():
+    # the recorded stages with run details, as a dict
+    return {'script': os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else None,
+            'pid': os.getpid(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'peak_rss_mb': _peak_rss_mb(), 'stages': list(_stages)}
+
+def write_report(path=None):
+    '''
+    Write the report as JSON to path, the enabled path, or
+    <script>_stats.json, and return the path.
+    '''
+    if path is None:
+        path = _report_path
+    if path is None:
+        script = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+        path = script + '_stats.json'
+
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=1)
+
+    return path
+
+# switch on from the environment at import
+_env = os.environ.get('PIPELINE_STATS', '')
+if _env and _env != '0':
+    enable(None if _env == '1' else _env)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of output products (maps, plots and CSV files)
+
+A product is keyed by a sha256 over everything that determines it: digests
+of the input files or arrays, the event and drawing parameters, and the
+source files of the code that draws it. Built products are copied into
+CACHE_DIR under their key. A later run with the same key is served from disk:
+nothing is done if the output file is still the one recorded for that key,
+otherwise the cached copy is put in place. Only products whose key changed
+are rebuilt.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+CACHE_DIR = os.environ.get('DYFI_PRODUCT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'dyfi_products'))
+
+# file digests computed in this process, keyed by (path, size, mtime)
+_digests = {}
+
+def file_digest(path, chunk_size=1 << 20):
+    # sha256 of a file's bytes
+    st = os.stat(path)
+    memo = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if memo not in _digests:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+        _digests[memo] = h.hexdigest()
+
+    return _digests[memo]
+
+def array_digest(arrays):
+    # sha256 of a dict of numpy arrays (e.g. from dyfi_io.load_dyfi), by key order
+    h = hashlib.sha256()
+    for key in sorted(arrays):
+        value = arrays[key]
+        h.update(key.encode())
+        h.update(str((getattr(value, 'dtype', ''), getattr(value, 'shape', ''))).encode())
+        h.update(memoryview(np.ascontiguousarray(value)).cast('B') if hasattr(value, 'dtype') else repr(value).encode())
+
+    return h.hexdigest()
+
+def package_version(name):
+    # installed version of a package from its metadata, without importing it; None if not installed
+    from importlib import metadata
+
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+def product_key(kind, **spec):
+    # sha256 of the product kind and its JSON-serialisable spec
+    text = json.dumps({'kind': kind, 'spec': spec}, sort_keys=True, default=str)
+
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def _entry(key, cachedir):
+    return os.path.join(cachedir, key[:2], key)
+
+def _record_path(outfile, cachedir):
+    # record of the key each output file was last written for
+    name = hashlib.sha256(os.path.abspath(outfile).encode()).hexdigest()
+
+    return os.path.join(cachedir, 'outputs', name + '.json')
+
+def _copy(src, dst):
+    # copy through a temporary file so readers never see a partial product
+    tmpfile = f'{dst}.{os.getpid()}.tmp'
+    shutil.copyfile(src, tmpfile)
+    os.replace(tmpfile, dst)
+
+def _record(key, outfile, cachedir):
+    st = os.stat(outfile)
+    path = _record_path(outfile, cachedir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmpfile = f'{path}.{os.getpid()}.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump({'key': key, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}, f)
+    os.replace(tmpfile, path)
+
+def _is_current(key, outfile, cachedir):
+    # output file unchanged since it was written for key
+    try:
+        with open(_record_path(outfile, cachedir)) as f:
+            rec = json.load(f)
+        st = os.stat(outfile)
+    except (OSError, ValueError):
+        return False
+
+    return rec['key'] == key and rec['size'] == st.st_size and rec['mtime_ns'] == st.st_mtime_ns
+
+def restore(key, outfiles, cachedir=CACHE_DIR):
+    '''
+    Put the products of key at outfiles from the cache. Returns False (and
+    changes nothing) unless every file is current or cached.
+    '''
+    entry = _entry(key, cachedir)
+    stale = [i for i, outfile in enumerate(outfiles) if not _is_current(key, outfile, cachedir)]
+    if any(not os.path.exists(os.path.join(entry, str(i))) for i in stale):
+        return False
+
+    for i in stale:
+        _copy(os.path.join(entry, str(i)), outfiles[i])
+        _record(key, outfiles[i], cachedir)
+
+    return True
+
+def store(key, outfiles, cachedir=CACHE_DIR):
+    # copy freshly built products into the cache under key
+    entry = _entry(key, cachedir)
+    os.makedirs(entry, exist_ok=True)
+    for i, outfile in enumerate(outfiles):
+        _copy(outfile, os.path.join(entry, str(i)))
+        _record(key, outfile, cachedir)